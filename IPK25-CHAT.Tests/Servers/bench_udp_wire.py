@@ -0,0 +1,125 @@
+"""
+Microbenchmark: UDP datagram parsing, datagrams/sec.
+
+"before" is the dict-building parse_message that the UDP server used:
+unpack with a format string per field, decode every string eagerly.
+"after" is udp_wire.parse_datagram, which uses precompiled Structs, a
+dispatch table and slotted messages with lazily decoded strings.
+
+"parse" only parses. "parse + fields" also reads every field, which is
+what a handler that uses all of them pays.
+
+Usage: python3 bench_udp_wire.py [repeat]
+"""
+
+import re
+import struct
+import sys
+import timeit
+
+from udp_wire import (TYPE_AUTH, TYPE_BYE, TYPE_CONFIRM, TYPE_ERR, TYPE_JOIN, TYPE_MSG, TYPE_PING,
+                      TYPE_REPLY, TYPE_UNKNOWN, parse_datagram)
+
+DATAGRAMS = {
+    'AUTH': b'\x02\x00\x00user1\x00Display_1\x00s3cr3t\x00',
+    'JOIN': b'\x03\x00\x01channel.42\x00Display_1\x00',
+    'MSG': b'\x04\x00\x02Display_1\x00Hello everyone, this is a fairly ordinary chat message.\x00',
+    'CONFIRM': b'\x00\x00\x05',
+}
+FIELDS = {
+    'AUTH': ('msg_id', 'username', 'display_name', 'secret'),
+    'JOIN': ('msg_id', 'channel_id', 'display_name'),
+    'MSG': ('msg_id', 'display_name', 'content'),
+    'CONFIRM': ('ref_msg_id',),
+}
+
+# --- The parser as it was in udp_ipk25_server.py (log calls dropped) ---
+def read_ushort_be(data, offset):
+    if offset + 2 > len(data): raise ValueError("Not enough data for ushort")
+    return struct.unpack_from('>H', data, offset)[0]
+_find_nul = re.compile(b'\x00').search
+def read_string(data, offset):
+    match = _find_nul(data, offset)
+    if match is None: raise ValueError("Null terminator not found")
+    end_offset = match.start()
+    value = str(data[offset:end_offset], 'ascii')
+    return value, end_offset + 1
+
+def legacy_parse_message(data):
+    try:
+        if len(data) < 3: raise ValueError(f"too short ({len(data)}B)")
+        msg_type = data[0]; msg_id = read_ushort_be(data, 1); offset = 3
+        result = {'raw_type': msg_type, 'msg_id': msg_id}
+        if msg_type == TYPE_CONFIRM:
+            result['type'] = TYPE_CONFIRM; result['ref_msg_id'] = msg_id
+        elif msg_type == TYPE_REPLY:
+            result['type'] = TYPE_REPLY
+            if offset + 3 > len(data): raise ValueError("REPLY too short")
+            result['success'] = data[offset] == 0x01
+            result['ref_msg_id'] = read_ushort_be(data, offset + 1)
+            result['content'], offset = read_string(data, offset + 3)
+        elif msg_type == TYPE_AUTH:
+            result['type'] = TYPE_AUTH
+            result['username'], offset = read_string(data, offset)
+            result['display_name'], offset = read_string(data, offset)
+            result['secret'], offset = read_string(data, offset)
+        elif msg_type == TYPE_JOIN:
+            result['type'] = TYPE_JOIN
+            result['channel_id'], offset = read_string(data, offset)
+            result['display_name'], offset = read_string(data, offset)
+        elif msg_type == TYPE_MSG:
+            result['type'] = TYPE_MSG
+            result['display_name'], offset = read_string(data, offset)
+            result['content'], offset = read_string(data, offset)
+        elif msg_type == TYPE_ERR:
+            result['type'] = TYPE_ERR
+            result['display_name'], offset = read_string(data, offset)
+            result['content'], offset = read_string(data, offset)
+        elif msg_type == TYPE_BYE:
+            result['type'] = TYPE_BYE
+            result['display_name'], offset = read_string(data, offset)
+        elif msg_type == TYPE_PING: result['type'] = TYPE_PING
+        else: result['type'] = TYPE_UNKNOWN
+        return result
+    except (ValueError, IndexError, UnicodeDecodeError, struct.error):
+        return None
+
+
+def bench(kind, func, read_fields):
+    datagrams = [memoryview(bytearray(DATAGRAMS[kind]))] * 10000 # As handed out by the receive pool
+    fields = FIELDS[kind]
+    if read_fields and func is legacy_parse_message:
+        def run():
+            for data in datagrams:
+                msg = func(data)
+                for name in fields: msg[name]
+    elif read_fields:
+        def run():
+            for data in datagrams:
+                msg = func(data)
+                for name in fields: getattr(msg, name)
+    else:
+        def run():
+            for data in datagrams:
+                func(data)
+    return run, len(datagrams)
+
+
+def compare(kind, repeat, read_fields):
+    """Alternates before/after runs so CPU frequency drift hits both alike; best of each."""
+    before, n = bench(kind, legacy_parse_message, read_fields)
+    after, _ = bench(kind, parse_datagram, read_fields)
+    best_before = best_after = float('inf')
+    for _ in range(repeat):
+        best_before = min(best_before, timeit.timeit(before, number=1))
+        best_after = min(best_after, timeit.timeit(after, number=1))
+    return n / best_before, n / best_after
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for read_fields in (False, True):
+        print("parse + fields:" if read_fields else "parse:")
+        for kind in DATAGRAMS:
+            before, after = compare(kind, repeat, read_fields)
+            print(f"  {kind:<8} before {before:12,.0f}/s   after {after:12,.0f}/s   ({after / before:.2f}x)")
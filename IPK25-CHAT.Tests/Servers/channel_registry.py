@@ -0,0 +1,144 @@
+"""
+========================================
+ IPK25 channel registry
+========================================
+
+Channel membership shared by every connection of a mock server. A member is
+any object with a `deliver(data, log_prefix)` method (for TCP the
+connection's OutboundQueue). A broadcast is encoded once by the caller, and
+the same bytes object is handed to every recipient.
+
+When a server runs as several worker processes, each worker keeps its own
+registry for its own connections. A WorkerRelay forwards every broadcast to
+the sibling workers, which then deliver it to their local members of the
+channel. No membership state has to be shared between processes. A sibling
+whose inbox is full loses the broadcast rather than stalling the sender;
+those drops are counted as relay_dropped in ipk25_events_total.
+"""
+
+import socket
+import threading
+import time
+
+from server_log import LOG
+from server_metrics import METRICS
+
+DEFAULT_CHANNEL = 'default'
+DROP_WARNING_INTERVAL = 5.0 # Seconds between warnings about dropped relay packets
+
+
+class ChannelRegistry:
+    """Maps channels to their members and fans messages out to them."""
+
+    def __init__(self):
+        self._channels = {} # channel -> set of members
+        self._member_channel = {} # member -> channel
+        self._lock = threading.Lock() # Threaded server mode touches this from many threads
+        self.relay = None # WorkerRelay when running as one of several worker processes
+
+    def join(self, member, channel):
+        """Moves member into channel. Returns the channel it left, or None."""
+        with self._lock:
+            previous = self._member_channel.get(member)
+            if previous is not None:
+                self._remove(member, previous)
+            self._channels.setdefault(channel, set()).add(member)
+            self._member_channel[member] = channel
+        return previous
+
+    def leave(self, member):
+        """Removes member from its channel. Returns that channel, or None."""
+        with self._lock:
+            channel = self._member_channel.pop(member, None)
+            if channel is not None:
+                self._remove(member, channel)
+        return channel
+
+    def _remove(self, member, channel):
+        members = self._channels.get(channel)
+        if members is not None:
+            members.discard(member)
+            if not members:
+                del self._channels[channel]
+
+    def channel_of(self, member):
+        return self._member_channel.get(member)
+
+    def members(self, channel):
+        with self._lock:
+            return tuple(self._channels.get(channel, ()))
+
+    def broadcast(self, channel, data, exclude=None, local_only=False):
+        """
+        Delivers the pre-encoded data to every member of channel except exclude.
+        Returns the number of local recipients; sibling workers get it via the relay.
+        """
+        if self.relay is not None and not local_only:
+            self.relay.publish(channel, data)
+        delivered = 0
+        for member in self.members(channel): # Deliver outside the lock; members lock their own queues
+            if member is not exclude:
+                member.deliver(data, None)
+                delivered += 1
+        return delivered
+
+    def __len__(self):
+        return len(self._channels)
+
+
+class WorkerRelay:
+    """
+    Forwards channel broadcasts between worker processes.
+    create_pairs() is called before forking. Worker i reads its inbox end of
+    pair i and writes into the other end of every sibling's pair.
+    """
+
+    def __init__(self, index, pairs, transport='tcp'):
+        self.index = index
+        self.transport = transport # Metrics label
+        self.inbox = pairs[index][0]
+        self.outboxes = [pair[1] for i, pair in enumerate(pairs) if i != index]
+        self.dropped = 0
+        self._reported = 0 # dropped at the last warning
+        self._last_warning = float('-inf')
+        for sock in [self.inbox] + self.outboxes:
+            sock.setblocking(False)
+
+    @staticmethod
+    def create_pairs(workers):
+        return [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+
+    def publish(self, channel, data):
+        packet = channel.encode() + b'\x00' + data
+        for outbox in self.outboxes:
+            try:
+                outbox.send(packet)
+            except BlockingIOError:
+                self._drop() # A saturated sibling loses this broadcast rather than stalling us
+            except OSError as e: # EMSGSIZE for an oversized broadcast, or a sibling that is gone
+                LOG.error(f"[!] Worker {self.index}: relaying {len(packet)} bytes on {channel} failed: {e}")
+                METRICS.event(self.transport, 'relay_failed')
+
+    def _drop(self):
+        self.dropped += 1
+        METRICS.event(self.transport, 'relay_dropped')
+        now = time.monotonic()
+        if now - self._last_warning >= DROP_WARNING_INTERVAL:
+            LOG.warning(f"[!] Worker {self.index}: {self.dropped - self._reported} relayed broadcasts dropped, "
+                        f"sibling inbox full ({self.dropped} in total)")
+            self._reported = self.dropped
+            self._last_warning = now
+
+    def attach(self, loop, registry):
+        """Delivers relayed broadcasts to the local members of registry from loop."""
+        registry.relay = self
+        loop.add_reader(self.inbox, self._drain, registry)
+
+    def _drain(self, registry):
+        while True:
+            try:
+                packet = self.inbox.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                return
+            channel, _, data = packet.partition(b'\x00')
+            registry.broadcast(channel.decode(), data, local_only=True)
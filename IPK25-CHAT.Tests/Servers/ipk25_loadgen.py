@@ -0,0 +1,369 @@
+"""
+========================================
+ IPK25 load generator (TCP / UDP)
+========================================
+
+Simulates N concurrent IPK25 clients against one of the mock servers:
+
+  1. every client connects, AUTHs and JOINs channel load<i % --channels>
+  2. once all are in, each sends --bursts bursts of --burst-size MSGs,
+     pausing --burst-gap ms between bursts
+  3. once no delivery has arrived for --drain seconds, every client sends BYE
+
+TCP clients speak the text grammar (tcp_grammar / LineFramer). MSG latency
+is send -> delivery to the other members of the channel. The send
+timestamp travels in the content, so fan-out is measured end to end.
+
+UDP clients follow UdpFsm: one message in flight, retransmitted every
+--timeout ms up to --retries times until CONFIRMed. Every server message is
+CONFIRMed, and repeated server MessageIDs are not processed again. MSG
+latency is send -> CONFIRM, including retransmissions. The wire format
+comes from udp_ipk25_server (build_* / parse_message) and, for AUTH and
+JOIN, from udp_wire.
+
+AUTH and JOIN latency is request -> REPLY on both transports.
+
+Usage: python3 ipk25_loadgen.py --transport udp --clients 500 --bursts 20
+"""
+
+import argparse
+import asyncio
+import collections
+import sys
+import time
+
+from line_framer import LineFramer
+from server_metrics import LatencyHistogram
+from server_util import raise_fd_limit
+from tcp_grammar import Bye, Err, Msg, Reply, parse_line
+from udp_ipk25_server import build_bye, build_confirm, build_msg, parse_message
+from udp_wire import TYPE_BYE, TYPE_CONFIRM, TYPE_ERR, TYPE_MSG, TYPE_REPLY, build_auth, build_join
+
+PAYLOAD_TAG = "lg" # Content prefix of generated MSGs: "lg <send perf_counter_ns>"
+
+
+class LoadStats:
+    """Counters and latency histograms shared by all clients of a run."""
+
+    def __init__(self):
+        self.latency = {kind: LatencyHistogram() for kind in ('AUTH', 'JOIN', 'MSG')}
+        self.sent = 0
+        self.delivered = 0
+        self.received = 0
+        self.retransmits = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.expected = 0
+        self.last_delivery_ns = 0
+
+    def observe(self, kind, start_ns, end_ns=None):
+        end_ns = end_ns or time.perf_counter_ns()
+        self.latency[kind].record(max(0, end_ns - start_ns) // 1000)
+
+
+class ClientFailed(Exception):
+    """The server rejected, dropped or stopped confirming a client."""
+
+
+# --- TCP client ---
+class TcpLoadClient:
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.name = f"load{index}"
+        self.channel = f"load{index % args.channels}"
+        self.reader = None
+        self.writer = None
+        self.reply_waiter = None
+        self.reader_task = None
+
+    async def setup(self):
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        self.reader_task = asyncio.create_task(self._read_loop())
+        await self._request('AUTH', f"AUTH {self.name} AS {self.name} USING secret\r\n")
+        await self._request('JOIN', f"JOIN {self.channel} AS {self.name}\r\n")
+
+    async def _request(self, kind, line):
+        """Sends AUTH/JOIN and waits for its REPLY."""
+        self.reply_waiter = asyncio.get_running_loop().create_future()
+        start_ns = time.perf_counter_ns()
+        self.writer.write(line.encode())
+        try:
+            reply = await asyncio.wait_for(self.reply_waiter, self.args.reply_timeout)
+        except asyncio.TimeoutError:
+            raise ClientFailed(f"{self.name}: no REPLY to {kind}")
+        if not reply.success:
+            raise ClientFailed(f"{self.name}: {kind} refused: {reply.content}")
+        self.stats.observe(kind, start_ns)
+
+    async def _read_loop(self):
+        framer = LineFramer()
+        stats = self.stats
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                now_ns = time.perf_counter_ns()
+                for line in framer.feed(data):
+                    msg = parse_line(line)
+                    if type(msg) is Msg:
+                        stats.received += 1
+                        if msg.content.startswith(PAYLOAD_TAG):
+                            stats.delivered += 1
+                            stats.observe('MSG', int(msg.content[len(PAYLOAD_TAG) + 1:]), now_ns)
+                            stats.last_delivery_ns = now_ns
+                    elif type(msg) is Reply:
+                        if self.reply_waiter and not self.reply_waiter.done():
+                            self.reply_waiter.set_result(msg)
+                    elif type(msg) is Err or type(msg) is Bye:
+                        stats.errors += type(msg) is Err
+                        break
+        except (ConnectionError, OSError):
+            pass
+        if self.reply_waiter and not self.reply_waiter.done():
+            self.reply_waiter.set_exception(ClientFailed(f"{self.name}: connection closed"))
+
+    async def run_bursts(self):
+        args = self.args
+        for burst in range(args.bursts):
+            if burst:
+                await asyncio.sleep(args.burst_gap / 1000)
+            lines = [f"MSG FROM {self.name} IS {PAYLOAD_TAG} {time.perf_counter_ns()}\r\n"
+                     for _ in range(args.burst_size)]
+            self.writer.write(''.join(lines).encode()) # A burst leaves as one write
+            self.stats.sent += len(lines)
+            await self.writer.drain()
+
+    async def finish(self):
+        try:
+            self.writer.write(f"BYE FROM {self.name}\r\n".encode())
+            await self.writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        self.close()
+
+    def close(self):
+        if self.reader_task:
+            self.reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+# --- UDP client ---
+class UdpLoadClient(asyncio.DatagramProtocol):
+    def __init__(self, index, args, stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.name = f"load{index}"
+        self.channel = f"load{index % args.channels}"
+        self.peer = (args.host, args.port) # Switches to the dynamic port on the AUTH REPLY
+        self.transport = None
+        self.next_id = 0
+        self.confirm_waiter = None # (MessageID, future) of the one message in flight
+        self.reply_waiter = None # (Ref_MessageID, future)
+        self.seen_ids = set() # Server MessageIDs already processed
+        self.closed = None
+
+    # Protocol callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        msg = parse_message(data, addr, self.name)
+        if not msg:
+            return
+        msg_type = msg.type
+        if msg_type == TYPE_CONFIRM:
+            waiter = self.confirm_waiter
+            if waiter and waiter[0] == msg.ref_msg_id and not waiter[1].done():
+                waiter[1].set_result(time.perf_counter_ns())
+            return
+        self.transport.sendto(build_confirm(msg.msg_id), addr) # Confirm every copy, like UdpFsm
+        if msg.msg_id in self.seen_ids:
+            self.stats.duplicates += 1
+            return
+        self.seen_ids.add(msg.msg_id)
+        if msg_type == TYPE_REPLY:
+            self.peer = addr
+            waiter = self.confirm_waiter # A REPLY proves the request arrived even if its CONFIRM is late
+            if waiter and waiter[0] == msg.ref_msg_id and not waiter[1].done():
+                waiter[1].set_result(time.perf_counter_ns())
+            waiter = self.reply_waiter
+            if waiter and waiter[0] == msg.ref_msg_id and not waiter[1].done():
+                waiter[1].set_result(msg)
+        elif msg_type == TYPE_MSG:
+            self.stats.received += 1
+        elif msg_type in (TYPE_ERR, TYPE_BYE):
+            self.stats.errors += msg_type == TYPE_ERR
+            self.closed = f"{self.name}: server sent {'ERR' if msg_type == TYPE_ERR else 'BYE'}"
+
+    def error_received(self, exc):
+        self.closed = f"{self.name}: {exc}"
+
+    # Client flow
+    async def setup(self):
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', 0))
+        await self._request('AUTH', lambda msg_id: build_auth(msg_id, self.name, self.name, "secret"))
+        await self._request('JOIN', lambda msg_id: build_join(msg_id, self.channel, self.name))
+
+    async def _request(self, kind, build):
+        """Sends AUTH/JOIN reliably and waits for the REPLY that references it."""
+        msg_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.reply_waiter = (msg_id, future)
+        start_ns = time.perf_counter_ns()
+        await self._send_reliable(build(msg_id))
+        try:
+            reply = await asyncio.wait_for(future, self.args.reply_timeout)
+        except asyncio.TimeoutError:
+            raise ClientFailed(f"{self.name}: no REPLY to {kind}")
+        if not reply.success:
+            raise ClientFailed(f"{self.name}: {kind} refused: {reply.content}")
+        self.stats.observe(kind, start_ns)
+
+    async def _send_reliable(self, data):
+        """Sends one message, retransmitting until CONFIRMed; returns (first send, CONFIRM) times."""
+        msg_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFF
+        future = asyncio.get_running_loop().create_future()
+        self.confirm_waiter = (msg_id, future)
+        timeout = self.args.timeout / 1000
+        start_ns = time.perf_counter_ns()
+        for attempt in range(1 + self.args.retries):
+            if self.closed:
+                raise ClientFailed(self.closed)
+            if attempt:
+                self.stats.retransmits += 1
+            self.transport.sendto(data, self.peer)
+            try:
+                return start_ns, await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                continue
+        raise ClientFailed(f"{self.name}: MessageID {msg_id} not confirmed after {self.args.retries} retries")
+
+    async def run_bursts(self):
+        args = self.args
+        for burst in range(args.bursts):
+            if burst:
+                await asyncio.sleep(args.burst_gap / 1000)
+            for _ in range(args.burst_size):
+                start_ns, confirm_ns = await self._send_reliable(build_msg(self.next_id, self.name, f"{PAYLOAD_TAG} {burst}"))
+                self.stats.sent += 1
+                self.stats.delivered += 1
+                self.stats.observe('MSG', start_ns, confirm_ns)
+                self.stats.last_delivery_ns = confirm_ns
+
+    async def finish(self):
+        try:
+            await self._send_reliable(build_bye(self.next_id, self.name))
+        except ClientFailed:
+            pass
+        self.close()
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+
+# --- Driver ---
+async def _phase(name, clients, step):
+    """Runs step(client) on every client concurrently; returns the clients that failed."""
+    results = await asyncio.gather(*(step(c) for c in clients), return_exceptions=True)
+    failed = []
+    for client, result in zip(clients, results):
+        if isinstance(result, BaseException):
+            print(f"[!] {name}: {result!r}", file=sys.stderr)
+            client.close()
+            failed.append(client)
+    return failed
+
+
+async def run_load(args):
+    stats = LoadStats()
+    client_class = TcpLoadClient if args.transport == 'tcp' else UdpLoadClient
+    clients = [client_class(i, args, stats) for i in range(args.clients)]
+
+    async def setup(client):
+        if args.ramp:
+            await asyncio.sleep(args.ramp * client.index / args.clients)
+        await client.setup()
+
+    t_setup = time.perf_counter()
+    failed = await _phase('setup', clients, setup)
+    ready = [c for c in clients if c not in failed]
+    setup_secs = time.perf_counter() - t_setup
+    print(f"[~] {len(ready)}/{len(clients)} {args.transport.upper()} clients ready in {setup_secs:.2f}s")
+
+    t_start_ns = time.perf_counter_ns()
+    failed += await _phase('bursts', ready, lambda c: c.run_bursts())
+    send_secs = (time.perf_counter_ns() - t_start_ns) / 1e9
+    ready = [c for c in ready if c not in failed]
+    stats.expected = expected_deliveries(args, ready)
+    await wait_for_deliveries(stats, args.drain)
+    await _phase('finish', ready, lambda c: c.finish())
+
+    report(args, stats, len(clients), len(failed), send_secs, t_start_ns)
+    return 1 if failed else 0
+
+
+def expected_deliveries(args, clients):
+    """TCP fans each MSG out to the other members of its channel; UDP only CONFIRMs it."""
+    if args.transport == 'udp':
+        return len(clients) * args.bursts * args.burst_size
+    members = collections.Counter(c.channel for c in clients)
+    return sum(n * (n - 1) for n in members.values()) * args.bursts * args.burst_size
+
+
+async def wait_for_deliveries(stats, idle_secs):
+    """Returns once every MSG arrived or no server message arrived for idle_secs."""
+    last, idle = -1, 0.0
+    while stats.delivered < stats.expected and idle < idle_secs:
+        await asyncio.sleep(0.05)
+        idle = idle + 0.05 if stats.received == last else 0.0
+        last = stats.received
+
+
+def report(args, stats, total, failed, send_secs, t_start_ns):
+    print(f"[~] clients: {total} ({failed} failed), channels: {args.channels}")
+    print(f"[~] sent {stats.sent} MSG in {send_secs:.2f}s: {stats.sent / max(send_secs, 1e-9):,.0f} msgs/sec")
+    if args.transport == 'tcp':
+        deliver_secs = max(stats.last_delivery_ns - t_start_ns, 1) / 1e9
+        print(f"[~] delivered {stats.delivered}/{stats.expected} MSG to channel members: {stats.delivered / deliver_secs:,.0f} msgs/sec")
+    else:
+        print(f"[~] retransmits: {stats.retransmits}, duplicate server messages: {stats.duplicates}")
+    print(f"[~] server messages received: {stats.received}, ERR: {stats.errors}")
+    print(f"    {'type':<5} {'count':>9} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9}")
+    for kind, hist in stats.latency.items():
+        if hist.count:
+            p50, p99, p999 = (hist.quantile(q) / 1000 for q in (0.5, 0.99, 0.999))
+            print(f"    {kind:<5} {hist.count:>9} {p50:>9.3f} {p99:>9.3f} {p999:>9.3f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IPK25 load generator")
+    parser.add_argument('--transport', choices=('tcp', 'udp'), default='tcp')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=4567)
+    parser.add_argument('-n', '--clients', type=int, default=100, help="concurrent clients (default 100)")
+    parser.add_argument('--channels', type=int, default=10, help="clients are spread over this many channels (default 10)")
+    parser.add_argument('--bursts', type=int, default=10, help="MSG bursts per client (default 10)")
+    parser.add_argument('--burst-size', type=int, default=10, help="MSGs per burst (default 10)")
+    parser.add_argument('--burst-gap', type=float, default=100, help="pause between bursts in ms (default 100)")
+    parser.add_argument('--ramp', type=float, default=0, help="spread client setup over this many seconds")
+    parser.add_argument('--drain', type=float, default=1.0, help="give up waiting for deliveries after this many idle seconds (default 1)")
+    parser.add_argument('--timeout', type=int, default=250, help="UDP confirmation timeout in ms (default 250)")
+    parser.add_argument('--retries', type=int, default=3, help="UDP retransmissions (default 3)")
+    parser.add_argument('--reply-timeout', type=float, default=5.0, help="seconds to wait for a REPLY (default 5)")
+    args = parser.parse_args(argv)
+    args.channels = max(1, args.channels)
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    raise_fd_limit()
+    sys.exit(asyncio.run(run_load(args)))
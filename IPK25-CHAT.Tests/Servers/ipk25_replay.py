@@ -0,0 +1,421 @@
+"""
+========================================
+ IPK25 capture replay (TCP / UDP)
+========================================
+
+Re-drives the sessions of a capture file (session_capture, --capture on
+the mock servers) at their original pace, N times faster, or as fast as
+possible:
+
+  --role client  (default) every captured session connects to --host
+                 again and sends what its client sent: a server under test
+                 gets the same session mix as during the capture
+  --role server  listens on --host like a server; every client that
+                 connects gets the server side of the next captured session
+                 of its transport, e.g. to re-drive a client under test
+
+--speed 1 keeps the captured gaps, --speed N divides them by N, --speed max
+drops them. Session starts keep their offsets too, so sessions overlap as
+they did. After a session's last captured event the replayer waits up to
+--linger seconds for the peer to close (TCP) or fall silent (UDP).
+
+TCP records are sent as captured, one write per captured read or write, so
+the line splitting of the original run is replayed too. For UDP, captured
+CONFIRMs are not replayed. The replayer CONFIRMs every datagram it receives
+itself, because MessageIDs of the peer differ between runs (they count
+channel traffic too). Captured retransmissions are replayed. As a client,
+datagrams after the AUTH wait until the server's dynamic port is known. As a server,
+each session answers from a socket of its own, the listener only CONFIRMs.
+
+The report counts sessions, messages and bytes each way, and how late the
+sends were against the schedule. If that lag grows, the replayer, not
+the peer, is the bottleneck.
+
+Usage: python3 ipk25_replay.py run.cap --speed 10
+       python3 ipk25_replay.py run.cap --role server --speed max
+       python3 ipk25_replay.py run.cap --dump
+"""
+
+import argparse
+import asyncio
+import collections
+import signal
+import struct
+import sys
+import time
+
+from server_metrics import LatencyHistogram
+from server_util import raise_fd_limit
+from session_capture import CLOSE, EVENTS, IN, OPEN, OUT, TCP, TRANSPORTS, UDP, lines, read_capture
+from tcp_ipk25_server import PORT
+from udp_ipk25_server import DEFAULT_PORT, build_confirm
+from udp_wire import TYPE_CONFIRM, TYPE_NAMES
+
+LINGER = 0.5 # Seconds to wait for the peer after a session's last event
+
+
+class CapturedSession:
+    """One session of the capture: its transport, client address and events after OPEN."""
+    __slots__ = ('id', 'transport', 'addr', 'start_ns', 'records')
+
+    def __init__(self, session_id, transport, start_ns):
+        self.id = session_id
+        self.transport = transport
+        self.addr = '?'
+        self.start_ns = start_ns
+        self.records = [] # session_capture.Record, IN/OUT/CLOSE
+
+def load_sessions(path, transports):
+    """Sessions of the capture on the given transports, by start time."""
+    sessions = {}
+    for record in read_capture(path):
+        session = sessions.get(record.session)
+        if session is None:
+            session = sessions[record.session] = CapturedSession(record.session, record.transport, record.time_ns)
+        if record.event == OPEN:
+            session.addr = record.data.decode('ascii', 'replace')
+        else:
+            session.records.append(record)
+    selected = [s for s in sessions.values() if TRANSPORTS[s.transport] in transports]
+    for session in selected:
+        session.records.sort(key=lambda record: record.time_ns) # Worker processes interleave in the file
+    selected.sort(key=lambda session: session.start_ns)
+    return selected
+
+
+class ReplayFailed(Exception):
+    """A session could not be replayed (connection refused, no dynamic port, ...)."""
+
+
+class ReplayStats:
+    """Counters shared by all sessions of a run, and the schedule lag of every send."""
+
+    def __init__(self, speed):
+        self.speed = speed # None: as fast as possible
+        self.lag = LatencyHistogram()
+        self.max_lag_us = 0
+        self.sent = self.sent_bytes = 0
+        self.received = self.received_bytes = 0
+        self.confirms = 0 # Sent by the replayer itself (UDP)
+
+    def sent_data(self, transport, data):
+        self.sent += len(lines(data)) if transport == TCP else 1
+        self.sent_bytes += len(data)
+
+    def received_data(self, transport, data):
+        self.received += data.count(b'\n') if transport == TCP else 1
+        self.received_bytes += len(data)
+
+
+class Clock:
+    """Maps capture timestamps of one session onto the event loop clock, scaled by --speed."""
+
+    def __init__(self, stats, origin_ns, base):
+        self.stats = stats
+        self.origin_ns = origin_ns # Capture time that maps to base
+        self.base = base # loop.time()
+
+    async def wait(self, time_ns):
+        stats = self.stats
+        if stats.speed is None:
+            return
+        loop = asyncio.get_running_loop()
+        due = self.base + (time_ns - self.origin_ns) / 1e9 / stats.speed
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        lag_us = max(0, int((loop.time() - due) * 1e6))
+        stats.lag.record(lag_us)
+        stats.max_lag_us = max(stats.max_lag_us, lag_us)
+
+
+# --- TCP ---
+async def _read_tcp(reader, stats):
+    """Counts what the peer sends until it closes."""
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                return
+            stats.received_data(TCP, data)
+    except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+        pass
+
+async def _play_tcp(session, direction, reader, writer, clock, stats, linger):
+    """Sends the session's records of direction, then waits for the peer to close."""
+    reading = asyncio.ensure_future(_read_tcp(reader, stats))
+    try:
+        for record in session.records:
+            if record.event == CLOSE:
+                break
+            if record.event != direction:
+                continue
+            await clock.wait(record.time_ns)
+            if reading.done():
+                break # The peer closed early
+            writer.write(record.data)
+            stats.sent_data(TCP, record.data)
+            await writer.drain()
+        if writer.can_write_eof() and not writer.is_closing():
+            writer.write_eof()
+        await asyncio.wait_for(asyncio.shield(reading), linger)
+    except (asyncio.TimeoutError, ConnectionResetError, BrokenPipeError):
+        pass
+    finally:
+        reading.cancel()
+        writer.close()
+
+async def tcp_client(session, args, stats, clock):
+    await clock.wait(session.start_ns)
+    try:
+        reader, writer = await asyncio.open_connection(args.host, args.tcp_port)
+    except OSError as e:
+        raise ReplayFailed(f"session {session.id:x}: {e}")
+    await _play_tcp(session, IN, reader, writer, clock, stats, args.linger)
+
+
+# --- UDP ---
+class UdpPeer(asyncio.DatagramProtocol):
+    """One UDP endpoint of the replay; CONFIRMs everything it receives."""
+
+    def __init__(self, stats, on_datagram=None):
+        self.stats = stats
+        self.on_datagram = on_datagram # Server role: called with (data, addr) of every datagram
+        self.transport = None
+        self.peer = None # Client role: the server's dynamic port once known
+        self.dynamic = asyncio.get_running_loop().create_future()
+        self.last_seen = {} # Address -> time.monotonic() of the last datagram to or from it
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.stats.received_data(UDP, data)
+        self.last_seen[addr] = time.monotonic()
+        if len(data) >= 3 and data[0] != TYPE_CONFIRM:
+            self.transport.sendto(build_confirm(struct.unpack_from('>H', data, 1)[0]), addr)
+            self.stats.confirms += 1
+        if self.on_datagram is not None:
+            self.on_datagram(data, addr)
+        elif addr != self.peer and not self.dynamic.done():
+            self.peer = addr
+            self.dynamic.set_result(addr)
+
+    def send(self, data, addr):
+        self.transport.sendto(data, addr)
+        self.last_seen[addr] = time.monotonic()
+
+    async def settle(self, linger, addr=None):
+        """Returns once nothing was sent or received (to or from addr) for linger seconds."""
+        while True:
+            last = self.last_seen.get(addr, 0.0) if addr else max(self.last_seen.values(), default=0.0)
+            quiet = time.monotonic() - last
+            if quiet >= linger:
+                return
+            await asyncio.sleep(linger - quiet)
+
+async def _play_udp(session, direction, send, clock, stats, before_send=None):
+    for record in session.records:
+        if record.event == CLOSE:
+            return
+        if record.event != direction or not record.data or record.data[0] == TYPE_CONFIRM:
+            continue
+        await clock.wait(record.time_ns)
+        if before_send is not None:
+            await before_send(record)
+        send(record.data)
+        stats.sent_data(UDP, record.data)
+
+async def udp_client(session, args, stats, clock):
+    await clock.wait(session.start_ns)
+    loop = asyncio.get_running_loop()
+    listener = (args.host, args.udp_port)
+    transport, peer = await loop.create_datagram_endpoint(lambda: UdpPeer(stats), local_addr=('0.0.0.0', 0))
+    peer.peer = listener
+    first = True
+
+    async def wait_for_dynamic_port(record):
+        nonlocal first
+        if first:
+            first = False # The AUTH goes to the listener
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(peer.dynamic), args.reply_timeout)
+        except asyncio.TimeoutError:
+            raise ReplayFailed(f"session {session.id:x}: no answer from a dynamic port")
+
+    try:
+        await _play_udp(session, IN, lambda data: peer.send(data, peer.peer), clock, stats,
+                        wait_for_dynamic_port)
+        await peer.settle(args.linger)
+    finally:
+        transport.close()
+
+
+# --- Roles ---
+async def run_clients(args, sessions, stats):
+    """Client role: every session replays its client against the server. Returns the failures."""
+    loop = asyncio.get_running_loop()
+    origin_ns = sessions[0].start_ns
+    clock = Clock(stats, origin_ns, loop.time())
+    replay = {TCP: tcp_client, UDP: udp_client}
+    results = await asyncio.gather(*(replay[s.transport](s, args, stats, clock) for s in sessions),
+                                   return_exceptions=True)
+    failed = [r for r in results if isinstance(r, BaseException)]
+    for error in failed:
+        print(f"[!] {error}", file=sys.stderr)
+    return failed
+
+async def run_server(args, sessions, stats):
+    """Server role: serves the sessions to clients as they connect, until all were served or SIGINT."""
+    loop = asyncio.get_running_loop()
+    queued = {TCP: collections.deque(), UDP: collections.deque()}
+    for session in sessions:
+        queued[session.transport].append(session)
+    remaining = len(sessions)
+    all_done = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, all_done.set)
+    failed = []
+
+    def finished(task):
+        nonlocal remaining
+        if not task.cancelled() and task.exception() is not None:
+            failed.append(task.exception())
+            print(f"[!] {task.exception()}", file=sys.stderr)
+        remaining -= 1
+        if not remaining:
+            all_done.set()
+
+    async def serve_tcp(reader, writer):
+        if not queued[TCP]:
+            writer.close()
+            return
+        session = queued[TCP].popleft()
+        print(f"[+] {writer.get_extra_info('peername')} gets TCP session {session.id:x} (client was {session.addr})")
+        clock = Clock(stats, session.start_ns, loop.time())
+        task = asyncio.ensure_future(_play_tcp(session, OUT, reader, writer, clock, stats, args.linger))
+        task.add_done_callback(finished)
+        await task
+
+    udp_clients = {} # Client address -> its session, None once that ended
+
+    async def serve_udp(session, addr):
+        clock = Clock(stats, session.start_ns, loop.time())
+        # Like the mock server, answer from a dynamic port; the listener only CONFIRMs the AUTH
+        transport, peer = await loop.create_datagram_endpoint(lambda: UdpPeer(stats), local_addr=(args.host, 0))
+        try:
+            await _play_udp(session, OUT, lambda data: peer.send(data, addr), clock, stats)
+            await peer.settle(args.linger, addr)
+        finally:
+            transport.close()
+            udp_clients[addr] = None # Later datagrams of this client do not start another session
+
+    def new_udp_client(data, addr):
+        if addr in udp_clients or not queued[UDP]:
+            return
+        session = queued[UDP].popleft()
+        udp_clients[addr] = session
+        print(f"[+] {addr} gets UDP session {session.id:x} (client was {session.addr})")
+        asyncio.ensure_future(serve_udp(session, addr)).add_done_callback(finished)
+
+    tcp_server = udp_transport = None
+    if queued[TCP]:
+        tcp_server = await asyncio.start_server(serve_tcp, args.host, args.tcp_port, reuse_address=True)
+        print(f"[~] Serving {len(queued[TCP])} TCP session(s) on {args.host}:{args.tcp_port}")
+    if queued[UDP]:
+        udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: UdpPeer(stats, new_udp_client), local_addr=(args.host, args.udp_port))
+        print(f"[~] Serving {len(queued[UDP])} UDP session(s) on {args.host}:{args.udp_port}")
+    await all_done.wait()
+    if tcp_server is not None:
+        tcp_server.close()
+    if udp_transport is not None:
+        udp_transport.close()
+    failed.extend(ReplayFailed(f"session {s.id:x} was never served") for q in queued.values() for s in q)
+    return failed
+
+
+# --- Report / dump ---
+def report(args, stats, total, failed, secs):
+    speed = "max speed" if stats.speed is None else f"{stats.speed:g}x"
+    print(f"[~] replayed {total - len(failed)}/{total} sessions ({len(failed)} failed) as {args.role} at {speed} in {secs:.2f}s")
+    print(f"[~] sent {stats.sent:,} messages ({stats.sent_bytes:,} bytes): {stats.sent / max(secs, 1e-9):,.0f} msgs/sec")
+    print(f"[~] received {stats.received:,} messages ({stats.received_bytes:,} bytes), sent {stats.confirms:,} CONFIRMs")
+    if stats.lag.count:
+        # Quantiles are bucket upper bounds; the max is exact
+        p50, p99 = (min(stats.lag.quantile(q), stats.max_lag_us) / 1000 for q in (0.5, 0.99))
+        print(f"[~] schedule lag: p50 {p50:.3f} ms, p99 {p99:.3f} ms, max {stats.max_lag_us / 1000:.3f} ms")
+
+def describe(record):
+    data = record.data
+    if record.event == OPEN:
+        return data.decode('ascii', 'replace')
+    if not data:
+        return ''
+    if record.transport == TCP:
+        return ' '.join(repr(line) for line in lines(data))
+    kind = TYPE_NAMES.get(data[0], hex(data[0]))
+    msg_id = struct.unpack_from('>H', data, 1)[0] if len(data) >= 3 else None
+    return f"{kind} id={msg_id} {data[3:]!r}"
+
+def dump(path, transports):
+    origin_ns = None
+    for record in read_capture(path):
+        if TRANSPORTS[record.transport] not in transports:
+            continue
+        if origin_ns is None:
+            origin_ns = record.time_ns
+        print(f"{(record.time_ns - origin_ns) / 1e9:12.6f} {record.session:016x} {TRANSPORTS[record.transport]} "
+              f"{EVENTS[record.event]:<5} {describe(record)}")
+
+
+def parse_speed(text):
+    if text == 'max':
+        return None
+    speed = float(text)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IPK25 capture replay")
+    parser.add_argument('capture', help="capture file written by a server with --capture")
+    parser.add_argument('--role', choices=('client', 'server'), default='client',
+                        help="replay the clients against a server (default) or the server side to clients")
+    parser.add_argument('--host', default='127.0.0.1', help="server to connect to, or address to listen on (default 127.0.0.1)")
+    parser.add_argument('--tcp-port', type=int, default=PORT, help=f"TCP port (default {PORT})")
+    parser.add_argument('--udp-port', type=int, default=DEFAULT_PORT, help=f"UDP listener port (default {DEFAULT_PORT})")
+    parser.add_argument('--transport', choices=('tcp', 'udp', 'both'), default='both',
+                        help="replay only the sessions of one transport (default both)")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, metavar='N|max',
+                        help="1 keeps the captured timing, N runs N times faster, max does not wait (default 1)")
+    parser.add_argument('--linger', type=float, default=LINGER, metavar='S',
+                        help=f"after a session's last event, wait up to S seconds for the peer (default {LINGER})")
+    parser.add_argument('--reply-timeout', type=float, default=5.0, metavar='S',
+                        help="UDP client role: seconds to wait for the server's dynamic port (default 5)")
+    parser.add_argument('--dump', action='store_true', help="print the capture instead of replaying it")
+    return parser.parse_args(argv)
+
+async def replay(args, sessions):
+    stats = ReplayStats(args.speed)
+    start = time.perf_counter()
+    failed = await (run_clients if args.role == 'client' else run_server)(args, sessions, stats)
+    report(args, stats, len(sessions), failed, time.perf_counter() - start)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    transports = TRANSPORTS if args.transport == 'both' else (args.transport,)
+    try:
+        if args.dump:
+            dump(args.capture, transports)
+            sys.exit(0)
+        sessions = load_sessions(args.capture, transports)
+    except (OSError, ValueError) as e:
+        sys.exit(f"Cannot read {args.capture}: {e}")
+    if not sessions:
+        sys.exit(f"No {args.transport} sessions in {args.capture}")
+    raise_fd_limit()
+    sys.exit(asyncio.run(replay(args, sessions)))
@@ -0,0 +1,116 @@
+"""
+========================================
+ IPK25 Mock Server (Python) - TCP and UDP in one process
+========================================
+
+Serves IPK25-CHAT over TCP and UDP from one asyncio event loop, like the
+course server that the TcpFsm/UdpFsm clients talk to: a TCP client and a
+UDP client in the same channel see each other's messages.
+
+  TCP  handle_client_async and ClientSession from tcp_ipk25_server, as they
+       are; each connection is a channel member through its OutboundQueue.
+  UDP  a UdpServer from udp_ipk25_server attached to the same loop. The
+       listener and the dynamic ports are watched with add_reader, and its
+       timers (retransmits, scenario pauses, idle expiry, PINGs) share the
+       LoopTimerHeap of the TCP connections.
+
+Both transports use one ChannelRegistry. Broadcasts travel as text lines.
+A UDP member sends each line on as a binary MSG with its own MessageID, and
+a UDP client's MSG becomes a text line before it is broadcast (wire_bridge).
+Authenticating, JOIN and leaving are announced to the channel by clients of
+either transport.
+
+The test triggers of both servers keep working on their own transport; one
+scenarios file (--scenarios) holds them for both. The one difference to the
+standalone UDP server: an ordinary UDP MSG goes to the channel instead of
+being answered with "Got your MSG".
+
+--idle-timeout applies to both transports, and --capture records the
+sessions of both into one file. The UDP session, impairment, log and
+metrics options are those of udp_ipk25_server.
+"""
+
+import argparse
+import asyncio
+import functools
+import signal
+
+from scenarios import add_scenario_arguments, default_scenarios, scenarios_from_args
+from scheduler import IdleReaper, LoopTimerHeap
+from server_log import LOG, add_log_arguments, configure_from_args
+from server_metrics import add_metrics_arguments, start_http_server
+from server_util import raise_fd_limit
+from session_capture import add_capture_arguments, capture_from_args
+from tcp_ipk25_server import CHANNELS, LISTEN_BACKLOG, PORT, close_connections, handle_client_async
+from udp_impairment import add_impairment_arguments, impairment_from_args
+from udp_ipk25_server import DEFAULT_PORT, IDLE_TIMEOUT, UdpServer, add_session_arguments, session_options
+
+HOST = '0.0.0.0'
+
+
+async def serve(host=HOST, tcp_port=PORT, udp_port=DEFAULT_PORT, metrics_port=0, idle_timeout=IDLE_TIMEOUT,
+                impairment=None, scenarios=None, **udp_options):
+    """Serves TCP and UDP clients from one event loop until SIGINT/SIGTERM; scenarios is a ScenarioBook."""
+    if scenarios is None:
+        scenarios = default_scenarios()
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    timers = LoopTimerHeap(loop)
+    reaper = IdleReaper(timers, idle_timeout)
+    connections = {} # TCP handler task -> its writer
+    if metrics_port:
+        start_http_server(metrics_port)
+    try:
+        udp = UdpServer(host, udp_port, idle_timeout=idle_timeout, impairment=impairment, timers=timers,
+                        channels=CHANNELS, scenarios=scenarios.matcher('udp'), **udp_options)
+    except OSError as e:
+        LOG.error(f"[!] Failed to start UDP server: {e}")
+        return
+    try:
+        tcp = await asyncio.start_server(functools.partial(handle_client_async, timers=timers, reaper=reaper,
+                                                           scenarios=scenarios.matcher('tcp'), connections=connections),
+                                         host, tcp_port, reuse_address=True, backlog=LISTEN_BACKLOG)
+    except OSError as e:
+        LOG.error(f"[!] Failed to start TCP server: {e}")
+        udp.close()
+        return
+    udp.attach(loop)
+
+    LOG.info(f"[~] IPK25 Mock Server (TCP + UDP, event loop) running on {host}: TCP {tcp_port}, UDP {udp_port}")
+    LOG.info("[~] Waiting for clients...")
+    async with tcp:
+        await stop.wait()
+        LOG.info("\n[~] Server shutdown requested (Ctrl+C).")
+        await close_connections(connections)
+        udp.close()
+    timers.close()
+    LOG.info("[~] Server shut down.")
+
+def run_server(host=HOST, tcp_port=PORT, udp_port=DEFAULT_PORT, metrics_port=0, **options):
+    """Runs both transports on one event loop; options are serve()'s."""
+    raise_fd_limit()
+    asyncio.run(serve(host, tcp_port, udp_port, metrics_port, **options))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IPK25 Mock Server (TCP and UDP)")
+    parser.add_argument('--host', default=HOST, help=f"address to bind (default {HOST})")
+    parser.add_argument('--tcp-port', type=int, default=PORT, help=f"TCP port (default {PORT})")
+    parser.add_argument('--udp-port', type=int, default=DEFAULT_PORT, help=f"UDP listener port (default {DEFAULT_PORT})")
+    add_session_arguments(parser) # --idle-timeout covers TCP connections too
+    add_scenario_arguments(parser)
+    add_capture_arguments(parser)
+    add_impairment_arguments(parser)
+    add_log_arguments(parser)
+    add_metrics_arguments(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_from_args(args)
+    capture_from_args(args)
+    run_server(args.host, args.tcp_port, args.udp_port, args.metrics_port,
+               impairment=impairment_from_args(args), scenarios=scenarios_from_args(args), **session_options(args))
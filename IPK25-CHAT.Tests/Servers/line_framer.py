@@ -0,0 +1,53 @@
+"""
+========================================
+ IPK25 TCP line framer
+========================================
+
+Incremental splitter for the CRLF-terminated TCP variant of IPK25-CHAT.
+Received bytes are appended to one bytearray. The delimiter search resumes
+where the previous read stopped, and only completed lines are decoded.
+Pipelining many lines in a single read therefore stays linear in the amount
+of data, instead of copying the whole remaining buffer for every line.
+"""
+
+DELIMITER = b'\r\n'
+
+
+class LineFramer:
+    """Collects raw TCP reads and hands back complete, decoded lines."""
+
+    def __init__(self, delimiter=DELIMITER, encoding='utf-8'):
+        self._buffer = bytearray()
+        self._scan_from = 0 # Buffer offset where the next delimiter search starts
+        self._delimiter = delimiter
+        self._encoding = encoding
+
+    def feed(self, data):
+        """Appends one read and returns the list of lines it completed (delimiter stripped)."""
+        buffer = self._buffer
+        buffer += data
+        delimiter = self._delimiter
+        delimiter_len = len(delimiter)
+        lines = []
+
+        start = 0
+        end = buffer.find(delimiter, self._scan_from)
+        while end != -1:
+            lines.append(buffer[start:end].decode(self._encoding, errors='ignore')) # Ignore decode errors for simplicity
+            start = end + delimiter_len
+            end = buffer.find(delimiter, start)
+
+        if start:
+            del buffer[:start] # Drop consumed lines once per read, not once per line
+        # A delimiter may straddle two reads, so re-check its first bytes next time
+        self._scan_from = max(0, len(buffer) - delimiter_len + 1)
+        return lines
+
+    @property
+    def pending(self):
+        """Number of buffered bytes that do not form a complete line yet."""
+        return len(self._buffer)
+
+    def clear(self):
+        self._buffer.clear()
+        self._scan_from = 0
@@ -0,0 +1,144 @@
+"""
+========================================
+ IPK25 protocol core
+========================================
+
+The server side of the IPK25-CHAT state machine, shared by the TCP and UDP
+servers. Each transport parses into its own typed messages (tcp_grammar,
+udp_wire) and names every message with one of KINDS. TABLE says what a
+message kind does in each state:
+
+  state          AUTH   JOIN   MSG    ERR, BYE   PING   MALFORMED  UNKNOWN
+  START          auth   -      -      err, bye   ping   malformed  unknown
+  AUTH_WAIT      -      -      -      err, bye   ping   malformed  unknown
+  OPEN           -      join   msg    err, bye   ping   malformed  unknown
+  JOIN_WAIT      -      -      -      err, bye   ping   malformed  unknown
+  END_REQUESTED  ignore
+
+REPLY from a client and every "-" is a violation: the transport sends ERR
+with the VIOLATIONS text and ends the session. auth and join move to
+AUTH_WAIT and JOIN_WAIT before their handler runs, and err, bye and
+violations move to END_REQUESTED. The REPLY the server sends to a pending
+AUTH or JOIN decides the next state (replied()).
+
+compile_table() binds the actions to a transport's handlers once, at import
+time. A state's row then maps each kind straight to (handler, next state),
+so dispatching a message is one dict lookup, and that code is the same for
+both transports.
+"""
+
+import functools
+from typing import NamedTuple
+
+# --- States ---
+START = 'START'
+AUTH_WAIT = 'AUTH_WAIT'
+OPEN = 'OPEN'
+JOIN_WAIT = 'JOIN_WAIT'
+END = 'END_REQUESTED'
+STATES = (START, AUTH_WAIT, OPEN, JOIN_WAIT, END)
+AUTHENTICATED = frozenset((OPEN, JOIN_WAIT))
+
+# --- Message kinds (also the metrics labels) ---
+AUTH, JOIN, MSG, ERR, BYE, REPLY, PING = 'AUTH', 'JOIN', 'MSG', 'ERR', 'BYE', 'REPLY', 'PING'
+MALFORMED = 'MALFORMED' # Known keyword, bad syntax (TCP)
+UNKNOWN = 'UNKNOWN'
+KINDS = (AUTH, JOIN, MSG, ERR, BYE, REPLY, PING, MALFORMED, UNKNOWN)
+
+# --- Actions a transport implements ---
+ACTIONS = ('auth', 'join', 'msg', 'err', 'bye', 'ping', 'malformed', 'unknown', 'violation', 'ignore')
+
+
+class Transition(NamedTuple):
+    action: str
+    enter: str = None # State entered before the action runs, None stays
+    text: str = None # ERR text of a violation
+
+
+VIOLATIONS = {
+    AUTH: "Already authenticated or invalid state for AUTH.",
+    JOIN: "Must be in OPEN state to JOIN.",
+    MSG: "Not authorized or wrong state for MSG.",
+    REPLY: "Clients must not send REPLY.",
+}
+
+# Allowed in one state only
+_ALLOWED = {
+    (START, AUTH): Transition('auth', AUTH_WAIT),
+    (OPEN, JOIN): Transition('join', JOIN_WAIT),
+    (OPEN, MSG): Transition('msg'),
+}
+# Allowed in every state but END_REQUESTED
+_ALWAYS = {
+    ERR: Transition('err', END),
+    BYE: Transition('bye', END),
+    PING: Transition('ping'),
+    MALFORMED: Transition('malformed'), # The handler decides between REPLY NOK and ERR
+    UNKNOWN: Transition('unknown', END),
+}
+
+def _row(state):
+    if state == END:
+        return {kind: Transition('ignore') for kind in KINDS} # Waiting for the session to wind down
+    row = {}
+    for kind in KINDS:
+        row[kind] = (_ALLOWED.get((state, kind)) or _ALWAYS.get(kind)
+                     or Transition('violation', END, VIOLATIONS[kind]))
+    return row
+
+TABLE = {state: _row(state) for state in STATES}
+
+# State after the server's REPLY to a pending AUTH or JOIN: (state, success) -> state
+AFTER_REPLY = {
+    (AUTH_WAIT, True): OPEN,
+    (AUTH_WAIT, False): START,
+    (JOIN_WAIT, True): OPEN,
+    (JOIN_WAIT, False): OPEN,
+}
+
+
+def compile_table(handlers):
+    """
+    Binds TABLE to one transport. handlers maps every action to a function
+    (session, msg, arg); violation handlers also get text=. Returns
+    {state: {kind: (handler, state to enter or None)}}.
+    """
+    missing = set(ACTIONS) - handlers.keys()
+    if missing:
+        raise ValueError(f"no handler for action(s) {', '.join(sorted(missing))}")
+    def bind(transition):
+        handler = handlers[transition.action]
+        if transition.text is not None:
+            handler = functools.partial(handler, text=transition.text)
+        return handler, transition.enter
+    return {state: {kind: bind(t) for kind, t in row.items()} for state, row in TABLE.items()}
+
+
+class ProtocolState:
+    """Where one session is in the state machine, and the compiled row it dispatches from."""
+    __slots__ = ('table', 'state', 'row')
+
+    def __init__(self, table, state=START):
+        self.table = table
+        self.enter(state)
+
+    def enter(self, state):
+        self.state = state
+        self.row = self.table[state]
+
+    def dispatch(self, session, kind, msg, arg=None):
+        """Runs the action for msg in the current state and returns what the handler returns."""
+        handler, enter = self.row[kind]
+        if enter is not None:
+            self.enter(enter)
+        return handler(session, msg, arg)
+
+    def replied(self, success):
+        """The server answered the pending AUTH or JOIN with REPLY OK (True) or NOK."""
+        state = AFTER_REPLY.get((self.state, success))
+        if state is not None:
+            self.enter(state)
+
+    @property
+    def authenticated(self):
+        return self.state in AUTHENTICATED
@@ -0,0 +1,345 @@
+"""
+========================================
+ IPK25 test scenarios
+========================================
+
+The test triggers of the mock servers ("failauth", "noconfirm", "split",
+...), declared in a JSON or TOML file (default: scenarios.json next to this
+module) and compiled at startup. Both servers load the same file; each
+scenario says which transport it applies to.
+
+  {"name": "failjoin", "transport": "udp", "on": "JOIN",
+   "field": "channel_id", "contains": "failjoin",
+   "confirm": true,
+   "actions": [{"reply": "NOK", "text": "Join failed (channel trigger)."}]}
+
+  transport  "tcp", "udp" or "both" (default)
+  on         AUTH, JOIN or MSG
+  field      a field of that message (FIELDS)
+  equals / contains
+             the trigger; compared case-insensitively, equals after
+             stripping surrounding whitespace
+  confirm    UDP only; false leaves the triggering message unCONFIRMed
+  actions    run in order instead of the normal handling:
+    "standard"                           the normal handling; with
+                                         {"standard": true, "delay": S}
+                                         its first send waits S seconds, and
+                                         "duplicate": S repeats its REPLY/echo
+    {"reply": "OK"|"NOK", "text": T}     REPLY to the message; OK to AUTH or
+                                         JOIN enters the channel
+    {"send": "MSG"|"ERR"|"BYE", "text": T, "from": "Server"}
+                                         a server message; ERR and BYE end
+                                         the session
+    {"send": "MALFORMED", "text": T}     a MSG without its final terminator
+    {"send": "RAW", "text": T}           T as it is (TCP: split lines)
+    Every action takes "delay": S, counted from the previous send. T may
+    be a list (one is picked at random) and may use the message's fields
+    as {display_name}; literal braces are doubled. No actions at all means
+    no reply.
+
+When several scenarios match, the one listed first wins. Matching costs
+one dict lookup per field with equals triggers. Contains triggers are
+checked in priority order with C-level substring searches while there are
+few of them; from SCAN_THRESHOLD patterns on, they are compiled into one
+Aho-Corasick automaton, whose scan time depends on the length of the field,
+not on how many scenarios there are (bench_scenarios.py).
+"""
+
+import collections
+import functools
+import json
+import os
+import random
+import string
+from typing import NamedTuple
+
+from server_log import LOG
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scenarios.json')
+TRANSPORTS = ('tcp', 'udp')
+FIELDS = {
+    'AUTH': ('username', 'display_name', 'secret'),
+    'JOIN': ('channel_id', 'display_name'),
+    'MSG': ('display_name', 'content'),
+}
+SEND_KINDS = ('MSG', 'ERR', 'BYE', 'MALFORMED', 'RAW')
+SCAN_THRESHOLD = 64 # Contains patterns per field from which the automaton replaces the substring checks
+
+
+class Step(NamedTuple):
+    """One action of a scenario."""
+    action: str # 'send', 'reply' or 'standard'
+    kind: str = None # send: MSG/ERR/BYE/MALFORMED/RAW; reply: OK/NOK
+    texts: tuple = () # One is picked per send
+    sender: str = 'Server'
+    delay: float = 0.0
+    duplicate: float = None # standard: repeat the REPLY/echo after this many seconds
+
+    def render(self, msg):
+        """The text to send, with the message's fields filled in."""
+        texts = self.texts
+        text = texts[0] if len(texts) == 1 else random.choice(texts)
+        return text.format_map(_Fields(msg)) if '{' in text else text
+
+STANDARD = Step('standard') # The normal handling when no scenario matches
+
+
+class _Fields:
+    """Message fields for str.format_map; works for tcp_grammar and udp_wire messages alike."""
+    __slots__ = ('msg',)
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __getitem__(self, name):
+        return getattr(self.msg, name)
+
+
+class Scenario(NamedTuple):
+    name: str
+    index: int # Position in the file; the lower one wins
+    transports: tuple
+    kind: str
+    field: str
+    mode: str # 'equals' or 'contains'
+    pattern: str # Lower-cased
+    confirm: bool
+    steps: tuple
+    ends: bool # Sends ERR or BYE, so the session ends after the actions
+
+
+# --- Loading ---
+def _parse_step(name, raw, kind):
+    if raw == 'standard':
+        return Step('standard')
+    if not isinstance(raw, dict):
+        raise ValueError(f"scenario {name!r}: action must be \"standard\" or an object, not {raw!r}")
+    verbs = [verb for verb in ('send', 'reply', 'standard') if verb in raw]
+    if len(verbs) != 1:
+        raise ValueError(f"scenario {name!r}: action needs exactly one of send, reply, standard: {raw!r}")
+    unknown = raw.keys() - {'send', 'reply', 'standard', 'text', 'from', 'delay', 'duplicate'}
+    if unknown:
+        raise ValueError(f"scenario {name!r}: unknown action option(s) {', '.join(sorted(unknown))}")
+    verb = verbs[0]
+    delay = float(raw.get('delay', 0))
+    if verb == 'standard':
+        duplicate = raw.get('duplicate')
+        return Step('standard', delay=delay, duplicate=None if duplicate is None else float(duplicate))
+    step_kind = str(raw[verb]).upper()
+    if verb == 'send' and step_kind not in SEND_KINDS:
+        raise ValueError(f"scenario {name!r}: send must be one of {', '.join(SEND_KINDS)}")
+    if verb == 'reply' and step_kind not in ('OK', 'NOK'):
+        raise ValueError(f"scenario {name!r}: reply must be OK or NOK")
+    text = raw.get('text', '')
+    texts = tuple(text) if isinstance(text, list) else (text,)
+    if not texts or not all(isinstance(t, str) for t in texts):
+        raise ValueError(f"scenario {name!r}: text must be a string or a list of strings")
+    for t in texts: # Unknown {placeholders} fail here, not in the middle of a session
+        for _, placeholder, _, _ in string.Formatter().parse(t):
+            if placeholder is not None and placeholder not in FIELDS[kind]:
+                raise ValueError(f"scenario {name!r}: {kind} has no field {placeholder!r} for {{{placeholder}}}")
+    return Step(verb, step_kind, texts, str(raw.get('from', 'Server')), delay)
+
+def _parse_scenario(index, raw):
+    if not isinstance(raw, dict):
+        raise ValueError(f"scenario #{index + 1} is not an object")
+    name = str(raw.get('name', f"#{index + 1}"))
+    kind = str(raw.get('on', '')).upper()
+    if kind not in FIELDS:
+        raise ValueError(f"scenario {name!r}: 'on' must be one of {', '.join(FIELDS)}")
+    field = raw.get('field')
+    if field not in FIELDS[kind]:
+        raise ValueError(f"scenario {name!r}: {kind} has fields {', '.join(FIELDS[kind])}, not {field!r}")
+    modes = [mode for mode in ('equals', 'contains') if mode in raw]
+    if len(modes) != 1 or not isinstance(raw[modes[0]], str) or not raw[modes[0]]:
+        raise ValueError(f"scenario {name!r}: needs one non-empty 'equals' or 'contains' string")
+    transport = raw.get('transport', 'both')
+    if transport not in TRANSPORTS + ('both',):
+        raise ValueError(f"scenario {name!r}: transport must be tcp, udp or both")
+    actions = raw.get('actions', [])
+    if not isinstance(actions, list):
+        raise ValueError(f"scenario {name!r}: actions must be a list")
+    steps = tuple(_parse_step(name, step, kind) for step in actions)
+    pattern = raw[modes[0]].lower()
+    return Scenario(name, index, TRANSPORTS if transport == 'both' else (transport,), kind, field, modes[0],
+                    pattern.strip() if modes[0] == 'equals' else pattern, bool(raw.get('confirm', True)), steps,
+                    any(step.action == 'send' and step.kind in ('ERR', 'BYE') for step in steps))
+
+
+class ScenarioBook:
+    """Every scenario of one file; matcher(transport) compiles the ones for a transport."""
+
+    def __init__(self, scenarios, path=None):
+        self.scenarios = tuple(scenarios)
+        self.path = path
+        self._matchers = {}
+
+    @classmethod
+    def load(cls, path=DEFAULT_PATH):
+        """Reads a .json or .toml file. Raises OSError or ValueError."""
+        if path.endswith('.toml'):
+            try:
+                import tomllib
+            except ImportError:
+                raise ValueError("TOML scenario files need Python 3.11 or newer") from None
+            with open(path, 'rb') as f:
+                data = tomllib.load(f)
+        else:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        raw = data.get('scenarios') if isinstance(data, dict) else None
+        if not isinstance(raw, list):
+            raise ValueError("the file needs a 'scenarios' list")
+        return cls([_parse_scenario(index, item) for index, item in enumerate(raw)], path)
+
+    def matcher(self, transport):
+        matcher = self._matchers.get(transport)
+        if matcher is None:
+            matcher = self._matchers[transport] = Matcher(s for s in self.scenarios if transport in s.transports)
+        return matcher
+
+    def __len__(self):
+        return len(self.scenarios)
+
+@functools.lru_cache(maxsize=None)
+def default_scenarios():
+    """The scenarios.json shipped with the servers, loaded once."""
+    return ScenarioBook.load(DEFAULT_PATH)
+
+
+# --- Matching ---
+class _Automaton:
+    """
+    Aho-Corasick automaton over (pattern, scenario) pairs, flattened into a
+    DFA: each state's dict already holds the transitions its failure links
+    would lead to, so the scan does one dict lookup per character. Each
+    state also knows the best scenario that ends there or at any suffix.
+    """
+
+    def __init__(self, pairs):
+        goto = [{}]
+        best = [None]
+        for pattern, scenario in pairs:
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = goto[state][ch] = len(goto)
+                    goto.append({})
+                    best.append(None)
+                state = nxt
+            if best[state] is None or scenario.index < best[state].index:
+                best[state] = scenario
+        fail = [0] * len(goto)
+        delta = [None] * len(goto)
+        delta[0] = dict(goto[0])
+        queue = collections.deque(goto[0].values())
+        while queue: # Breadth first, so a state's failure target is complete before it
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                fail[nxt] = delta[fail[state]].get(ch, 0) if state else 0
+                inherited = best[fail[nxt]]
+                if inherited is not None and (best[nxt] is None or inherited.index < best[nxt].index):
+                    best[nxt] = inherited
+                queue.append(nxt)
+            if state:
+                delta[state] = {**delta[fail[state]], **goto[state]}
+        self.delta = delta
+        self.best = best
+
+    def search(self, text):
+        """Best scenario with a pattern somewhere in text, or None."""
+        delta, best = self.delta, self.best
+        state = 0
+        found = None
+        for ch in text:
+            state = delta[state].get(ch, 0)
+            hit = best[state]
+            if hit is not None and (found is None or hit.index < found.index):
+                found = hit
+        return found
+
+class _Substrings:
+    """Few contains patterns: checked in priority order with `in`, the first hit is the best."""
+    __slots__ = ('pairs',)
+
+    def __init__(self, pairs):
+        self.pairs = tuple(sorted(pairs, key=lambda pair: pair[1].index))
+
+    def search(self, text):
+        for pattern, scenario in self.pairs:
+            if pattern in text:
+                return scenario
+        return None
+
+
+class Matcher:
+    """
+    Compiled scenarios of one transport. Per message kind, one rule per field:
+    (field, exact dict, contains patterns in priority order, pattern -> scenario,
+    automaton). A message that triggers nothing costs one dict lookup and one
+    scan per field.
+    """
+
+    def __init__(self, scenarios):
+        by_field = {}
+        for scenario in scenarios:
+            exact, contains = by_field.setdefault((scenario.kind, scenario.field), ({}, []))
+            if scenario.mode == 'equals':
+                if scenario.pattern not in exact: # An earlier scenario keeps the key
+                    exact[scenario.pattern] = scenario
+            else:
+                contains.append((scenario.pattern, scenario))
+        rules = {}
+        for (kind, field), (exact, contains) in by_field.items():
+            automaton, first = None, {}
+            if len(contains) >= SCAN_THRESHOLD:
+                automaton = _Automaton(contains)
+            else:
+                for pattern, scenario in _Substrings(contains).pairs:
+                    first.setdefault(pattern, scenario)
+            rules.setdefault(kind, []).append((field, exact or None, tuple(first), first, automaton))
+        self._rules = {kind: tuple(field_rules) for kind, field_rules in rules.items()}
+
+    def match(self, kind, msg):
+        """The scenario msg (a message of kind) triggers, or None."""
+        rules = self._rules.get(kind)
+        if rules is None:
+            return None
+        best = None
+        for field, exact, patterns, first, automaton in rules:
+            value = getattr(msg, field).lower()
+            if exact is not None:
+                hit = exact.get(value.strip())
+                if hit is not None and (best is None or hit.index < best.index):
+                    best = hit
+            if automaton is not None:
+                hit = automaton.search(value)
+                if hit is None:
+                    continue
+            else: # Inlined _Substrings.search: with few patterns a call costs as much as the scan
+                for pattern in patterns:
+                    if pattern in value:
+                        break
+                else:
+                    continue
+                hit = first[pattern]
+            if best is None or hit.index < best.index:
+                best = hit
+        return best
+
+
+# --- Command line ---
+def add_scenario_arguments(parser):
+    group = parser.add_argument_group("test scenarios")
+    group.add_argument('--scenarios', default=DEFAULT_PATH, metavar='FILE',
+                       help="JSON or TOML file with the test triggers (default: scenarios.json next to the servers)")
+
+def scenarios_from_args(args):
+    """ScenarioBook of --scenarios; exits with a message if the file is unusable."""
+    try:
+        book = ScenarioBook.load(args.scenarios)
+    except (OSError, ValueError) as e: # json.JSONDecodeError and tomllib.TOMLDecodeError are ValueErrors
+        raise SystemExit(f"Cannot load scenarios from {args.scenarios}: {e}")
+    LOG.info("[~] Loaded %d test scenario(s) from %s", len(book), args.scenarios)
+    return book
@@ -0,0 +1,224 @@
+"""
+========================================
+ IPK25 mock server timer heap
+========================================
+
+One shared min-heap of pending callbacks per server process, used for every
+delayed action (scenario pauses, retransmits and idle expiry) instead of
+a sleeping handler or a thread per delay. Scheduling costs one
+heap push. Cancelling only flags the entry, and cancelled entries are
+skipped when they reach the top of the heap.
+
+Two drivers are provided:
+  LoopTimerHeap   - keeps a single asyncio loop handle armed at the earliest deadline.
+  ThreadTimerHeap - one background thread sleeping until the earliest deadline.
+
+IdleReaper ends sessions without client activity for a configurable time,
+for the TCP and UDP servers alike, on top of whichever heap drives them.
+"""
+
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+from server_log import LOG
+
+
+class Timer:
+    """Handle for one scheduled callback."""
+    __slots__ = ('deadline', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.callback = None
+        self.args = ()
+
+
+class TimerHeap:
+    """Pending callbacks ordered by deadline. Not thread-safe on its own."""
+
+    def __init__(self, clock=time.monotonic):
+        self._heap = [] # (deadline, sequence, Timer); sequence keeps FIFO order for equal deadlines
+        self._sequence = itertools.count()
+        self.clock = clock
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args)
+        heapq.heappush(self._heap, (deadline, next(self._sequence), timer))
+        if self._heap[0][2] is timer:
+            self._wakeup(deadline) # New earliest deadline; the driver must re-arm
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def next_deadline(self):
+        """Earliest live deadline, or None when nothing is pending."""
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def _pop_due(self, now):
+        heap = self._heap
+        due = []
+        while heap and heap[0][0] <= now:
+            timer = heapq.heappop(heap)[2]
+            if not timer.cancelled:
+                due.append(timer)
+        return due
+
+    @staticmethod
+    def _run(timers):
+        for timer in timers:
+            callback, args = timer.callback, timer.args
+            timer.cancel() # Fired timers count as done
+            if callback is None:
+                continue # Cancelled by an earlier callback of this batch
+            try:
+                callback(*args)
+            except Exception as e:
+                LOG.error("[!] Timer callback %s failed: %s", getattr(callback, '__qualname__', callback), e)
+
+    def run_due(self, now=None):
+        """Runs every callback whose deadline has passed. Returns how many were due."""
+        due = self._pop_due(self.clock() if now is None else now)
+        self._run(due)
+        return len(due)
+
+    def _wakeup(self, deadline):
+        """Hook for drivers; called when deadline became the earliest one."""
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class LoopTimerHeap(TimerHeap):
+    """Timer heap driven by an asyncio event loop through one armed handle."""
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        super().__init__(clock=self.loop.time)
+        self._handle = None
+        self._armed_at = None
+
+    def _wakeup(self, deadline):
+        if self._armed_at is not None and self._armed_at <= deadline:
+            return
+        if self._handle is not None:
+            self._handle.cancel()
+        self._armed_at = deadline
+        self._handle = self.loop.call_at(deadline, self._fire)
+
+    def _fire(self):
+        self._handle = self._armed_at = None
+        self.run_due()
+        deadline = self.next_deadline()
+        if deadline is not None:
+            self._wakeup(deadline)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._armed_at = None
+        self._heap.clear()
+
+
+class ThreadTimerHeap(TimerHeap):
+    """Thread-safe timer heap whose callbacks run on one background thread."""
+
+    def __init__(self, clock=time.monotonic, name="Timers"):
+        super().__init__(clock=clock)
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+
+    def call_at(self, deadline, callback, *args):
+        with self._cond:
+            return super().call_at(deadline, callback, *args)
+
+    def _wakeup(self, deadline):
+        self._cond.notify()
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                deadline = self.next_deadline()
+                now = self.clock()
+                if deadline is None or deadline > now:
+                    self._cond.wait(None if deadline is None else deadline - now)
+                    continue
+                due = self._pop_due(now)
+            self._run(due) # Outside the lock so callbacks may schedule more timers
+
+
+class IdleEntry:
+    """One session tracked by an IdleReaper. touch() on every client message."""
+    __slots__ = ('reaper', 'callback', 'args', 'last_activity', 'timer')
+
+    def __init__(self, reaper, callback, args):
+        self.reaper = reaper
+        self.callback = callback
+        self.args = args
+        self.last_activity = reaper.timers.clock()
+        self.timer = None
+
+    def touch(self):
+        self.last_activity = self.reaper.timers.clock()
+
+    def cancel(self):
+        self.callback = None # Also stops a re-arm racing with this on the timer thread
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+
+class IdleReaper:
+    """
+    Calls a session's expiry callback once it has been idle for `timeout`
+    seconds; a timeout of 0 never expires anything. touch() only stores a
+    timestamp. Each session has a single timer on the shared heap, which is
+    re-armed for the new deadline when it fires on a session that was active
+    in the meantime, so a busy session costs one heap push per timeout period,
+    not one per message.
+    """
+
+    def __init__(self, timers, timeout):
+        self.timers = timers
+        self.timeout = timeout
+
+    def add(self, callback, *args):
+        entry = IdleEntry(self, callback, args)
+        if self.timeout:
+            entry.timer = self.timers.call_at(entry.last_activity + self.timeout, self._check, entry)
+        return entry
+
+    def _check(self, entry):
+        if entry.callback is None:
+            return # Cancelled
+        deadline = entry.last_activity + self.timeout
+        if deadline > self.timers.clock():
+            entry.timer = self.timers.call_at(deadline, self._check, entry) # Activity since; re-arm
+            return
+        callback, entry.callback, entry.timer = entry.callback, None, None
+        callback(*entry.args)
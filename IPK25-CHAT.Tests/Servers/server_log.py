@@ -0,0 +1,175 @@
+"""
+========================================
+ IPK25 mock server logging
+========================================
+
+Replaces the synchronous print() calls of the mock servers.
+
+- Levels: DEBUG covers per-message events (lines, datagrams, CONFIRMs,
+  sends). INFO covers sessions and test triggers. WARNING and ERROR cover
+  problems.
+- Messages are passed as a format string plus arguments, and are only
+  formatted on the writer thread or when the ring buffer is dumped. A
+  disabled level costs one comparison.
+- Console output is written in batches by a background thread. With
+  --log-sample N, only every Nth DEBUG event reaches the console.
+- The last --log-ring events of every level are kept in memory. They are
+  dumped to stderr on SIGUSR1, or by calling LOG.dump().
+- --log-sync prints in the calling thread, exactly like the old print().
+"""
+
+import atexit
+import collections
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {value: name.upper() for name, value in LEVELS.items()}
+
+_STOP = object()
+
+
+class ServerLog:
+    """Level-filtered logger with a ring buffer and a background console writer."""
+
+    def __init__(self, level=DEBUG, sample=1, ring_size=10000, sync=False, max_pending=100000, stream=None):
+        self._stream = stream
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0 # Console events dropped because the writer fell behind
+        self.configure(level, sample, ring_size, sync, max_pending)
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.close)
+
+    def configure(self, level=DEBUG, sample=1, ring_size=10000, sync=False, max_pending=100000):
+        self.level = level
+        self.sample = max(1, sample)
+        self._sample_count = 0
+        self.sync = sync
+        self.max_pending = max_pending
+        self.ring = collections.deque(maxlen=ring_size) if ring_size else None
+
+    # --- Hot path ---
+    def log(self, level, fmt, *args):
+        ring = self.ring
+        if ring is not None:
+            ring.append((time.time(), level, fmt, args))
+        if level < self.level:
+            return
+        if level == DEBUG and self.sample > 1:
+            self._sample_count += 1
+            if self._sample_count % self.sample:
+                return
+        if self.sync:
+            self._write([(level, fmt, args)])
+            return
+        if self._thread is None:
+            self._start()
+        if self.max_pending and self._queue.qsize() >= self.max_pending:
+            self.dropped += 1
+            return
+        self._queue.put((level, fmt, args))
+
+    def debug(self, fmt, *args): self.log(DEBUG, fmt, *args)
+    def info(self, fmt, *args): self.log(INFO, fmt, *args)
+    def warning(self, fmt, *args): self.log(WARNING, fmt, *args)
+    def error(self, fmt, *args): self.log(ERROR, fmt, *args)
+
+    # --- Writer thread ---
+    @staticmethod
+    def _format(fmt, args):
+        try:
+            return fmt % args if args else fmt
+        except (TypeError, ValueError) as e:
+            return f"{fmt} {args!r} (log format error: {e})"
+
+    def _write(self, events):
+        stream = self._stream or sys.stdout
+        stream.write(''.join(self._format(fmt, args) + '\n' for _, fmt, args in events))
+        stream.flush()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        get, get_nowait = self._queue.get, self._queue.get_nowait
+        while True:
+            batch = [get()]
+            try:
+                while len(batch) < 1024:
+                    batch.append(get_nowait())
+            except queue.Empty:
+                pass
+            stop = batch[-1] is _STOP
+            events = [event for event in batch if event is not _STOP]
+            if events:
+                try:
+                    self._write(events)
+                except (OSError, ValueError):
+                    pass # Console closed; keep draining so producers never block
+            if stop:
+                return
+
+    def close(self):
+        """Flushes queued console output and stops the writer thread."""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout=2.0)
+        self._thread = None
+        if self.dropped:
+            sys.stderr.write(f"[!] Log writer fell behind; {self.dropped} console events dropped\n")
+            self.dropped = 0
+
+    def _after_fork(self):
+        # The writer thread does not survive fork(); the child starts its own on first use
+        self._thread = None
+        self._queue = queue.SimpleQueue()
+        self._lock = threading.Lock()
+
+    # --- Ring buffer ---
+    def dump(self, stream=None):
+        """Writes the ring buffer, oldest event first."""
+        stream = stream or sys.stderr
+        events = list(self.ring or ())
+        stream.write(f"--- last {len(events)} events (pid {os.getpid()}) ---\n")
+        for stamp, level, fmt, args in events:
+            clock = time.strftime('%H:%M:%S', time.localtime(stamp))
+            stream.write(f"{clock}.{int(stamp % 1 * 1000):03d} {LEVEL_NAMES.get(level, level):7} {self._format(fmt, args)}\n")
+        stream.write("--- end of ring buffer ---\n")
+        stream.flush()
+
+    def install_dump_signal(self, sig=getattr(signal, 'SIGUSR1', None)):
+        """Dumps the ring buffer to stderr whenever sig arrives."""
+        if sig is not None:
+            signal.signal(sig, lambda signum, frame: self.dump())
+
+
+LOG = ServerLog()
+
+
+def add_log_arguments(parser):
+    group = parser.add_argument_group("logging")
+    group.add_argument('--log-level', choices=LEVELS, default='debug',
+                       help="lowest level written to the console (default debug)")
+    group.add_argument('--log-sample', type=int, default=1, metavar='N',
+                       help="write only every Nth per-message (debug) event to the console")
+    group.add_argument('--log-ring', type=int, default=10000, metavar='N',
+                       help="keep the last N events in memory, dumped on SIGUSR1 (0 disables)")
+    group.add_argument('--log-sync', action='store_true',
+                       help="print in the calling thread like plain print() (interactive debugging)")
+
+
+def configure_from_args(args):
+    LOG.configure(level=LEVELS[args.log_level], sample=args.log_sample,
+                  ring_size=args.log_ring, sync=args.log_sync)
+    LOG.install_dump_signal()
@@ -0,0 +1,213 @@
+"""
+========================================
+ IPK25 mock server metrics
+========================================
+
+Counters and latency histograms for both mock servers, exposed on a local
+HTTP /metrics endpoint in Prometheus text format (--metrics-port).
+
+  ipk25_messages_total{transport,direction,type,state}  messages seen/sent
+  ipk25_bytes_total{transport,direction}                 payload bytes
+  ipk25_active_sessions{transport}                       open sessions
+  ipk25_retransmits_total{transport}                     duplicate client MessageIDs seen
+  ipk25_events_total{transport,event}                    server-side events (retransmits, ...)
+  ipk25_reply_latency_seconds{transport,type}            receive -> reply histogram
+  ipk25_reply_latency_quantile_seconds{...,quantile}     p50/p90/p99/p999 from it
+
+Updating a counter is one dict increment. Histograms are HDR-style
+log-linear: 8 sub-buckets per power of two of microseconds (<= 12.5%
+relative error), so recording is a bit_length() and a list increment.
+Without a lock, threaded servers may rarely lose an increment. That is
+acceptable for load-test telemetry.
+"""
+
+import collections
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from server_log import LOG
+
+SUB_BITS = 3 # 2**3 sub-buckets per power of two
+_DIRECT = 1 << (SUB_BITS + 1) # Values below this get one bucket each
+EXPORT_BOUNDS_US = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000,
+                    100000, 250000, 500000, 1000000, 2500000, 5000000, 10000000)
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class LatencyHistogram:
+    """Log-linear histogram of microsecond values."""
+    __slots__ = ('counts', 'count', 'total_us')
+
+    def __init__(self):
+        self.counts = [0] * 256
+        self.count = 0
+        self.total_us = 0
+
+    @staticmethod
+    def bucket(value_us):
+        if value_us < _DIRECT:
+            return value_us
+        shift = value_us.bit_length() - (SUB_BITS + 1)
+        return (shift << SUB_BITS) + (value_us >> shift)
+
+    @staticmethod
+    def upper_bound(index):
+        """Exclusive upper edge, in microseconds, of bucket index."""
+        if index < _DIRECT:
+            return index + 1
+        shift = (index >> SUB_BITS) - 1
+        return ((index - (shift << SUB_BITS)) + 1) << shift
+
+    def record(self, value_us):
+        index = self.bucket(value_us)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total_us += value_us
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, n in enumerate(other.counts):
+            self.counts[index] += n
+        self.count += other.count
+        self.total_us += other.total_us
+
+    def quantile(self, q):
+        """Upper bucket edge (microseconds) below which a fraction q of the values lie."""
+        if not self.count:
+            return 0
+        rank = max(1, int(q * self.count + 0.5))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.upper_bound(index)
+        return self.upper_bound(len(self.counts) - 1)
+
+    def cumulative(self, bounds_us):
+        """Counts of values below each bound, for Prometheus `le` buckets."""
+        result = []
+        seen = 0
+        index = 0
+        counts = self.counts
+        for bound in bounds_us:
+            while index < len(counts) and self.upper_bound(index) <= bound:
+                seen += counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+
+class Metrics:
+    """Process-wide counters; one instance (METRICS) per server process."""
+
+    def __init__(self):
+        self.messages = collections.defaultdict(int) # (transport, direction, type, state) -> count
+        self.bytes = collections.defaultdict(int) # (transport, direction) -> bytes
+        self.sessions = collections.defaultdict(int) # transport -> open sessions
+        self.retransmits = collections.defaultdict(int) # transport -> count
+        self.events = collections.defaultdict(int) # (transport, event) -> count
+        self.latency = collections.defaultdict(LatencyHistogram) # (transport, type) -> histogram
+
+    # --- Hot path ---
+    def message(self, transport, direction, kind, state='', count=1):
+        self.messages[transport, direction, kind, state] += count
+
+    def add_bytes(self, transport, direction, n):
+        self.bytes[transport, direction] += n
+
+    def session_opened(self, transport):
+        self.sessions[transport] += 1
+
+    def session_closed(self, transport):
+        self.sessions[transport] -= 1
+
+    def retransmit(self, transport):
+        self.retransmits[transport] += 1
+
+    def event(self, transport, name, count=1):
+        self.events[transport, name] += count
+
+    def observe(self, transport, kind, received_ns):
+        """Records the time from received_ns (perf_counter_ns) until now."""
+        self.latency[transport, kind].record((time.perf_counter_ns() - received_ns) // 1000)
+
+    # --- Exposition ---
+    def render(self):
+        lines = []
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        family("ipk25_messages_total", "counter", "Protocol messages by transport, direction, type and session state.")
+        for (transport, direction, kind, state), n in sorted(self.messages.items()):
+            lines.append(f'ipk25_messages_total{{transport="{transport}",direction="{direction}",type="{kind}",state="{state}"}} {n}')
+        family("ipk25_bytes_total", "counter", "Payload bytes by transport and direction.")
+        for (transport, direction), n in sorted(self.bytes.items()):
+            lines.append(f'ipk25_bytes_total{{transport="{transport}",direction="{direction}"}} {n}')
+        family("ipk25_active_sessions", "gauge", "Currently open client sessions.")
+        for transport, n in sorted(self.sessions.items()):
+            lines.append(f'ipk25_active_sessions{{transport="{transport}"}} {n}')
+        family("ipk25_retransmits_total", "counter", "Duplicate client MessageIDs (retransmissions) seen; re-confirmed, not handled again.")
+        for transport, n in sorted(self.retransmits.items()):
+            lines.append(f'ipk25_retransmits_total{{transport="{transport}"}} {n}')
+        family("ipk25_events_total", "counter", "Server-side events such as retransmits and delivery failures.")
+        for (transport, name), n in sorted(self.events.items()):
+            lines.append(f'ipk25_events_total{{transport="{transport}",event="{name}"}} {n}')
+
+        histograms = sorted(self.latency.items())
+        family("ipk25_reply_latency_seconds", "histogram", "Time from receiving a message to sending its reply.")
+        for (transport, kind), hist in histograms:
+            labels = f'transport="{transport}",type="{kind}"'
+            for bound, n in zip(EXPORT_BOUNDS_US, hist.cumulative(EXPORT_BOUNDS_US)):
+                lines.append(f'ipk25_reply_latency_seconds_bucket{{{labels},le="{bound / 1e6:g}"}} {n}')
+            lines.append(f'ipk25_reply_latency_seconds_bucket{{{labels},le="+Inf"}} {hist.count}')
+            lines.append(f'ipk25_reply_latency_seconds_sum{{{labels}}} {hist.total_us / 1e6:.6f}')
+            lines.append(f'ipk25_reply_latency_seconds_count{{{labels}}} {hist.count}')
+        family("ipk25_reply_latency_quantile_seconds", "gauge", "Latency quantiles from the HDR histogram.")
+        for (transport, kind), hist in histograms:
+            for q in QUANTILES:
+                lines.append(f'ipk25_reply_latency_quantile_seconds{{transport="{transport}",type="{kind}",quantile="{q}"}} '
+                             f'{hist.quantile(q) / 1e6:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would otherwise flood the console
+
+
+def start_http_server(port, host='127.0.0.1'):
+    """Serves METRICS on http://host:port/metrics from a daemon thread."""
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        LOG.error(f"[!] Could not start metrics endpoint on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    LOG.info(f"[~] Metrics on http://{host}:{port}/metrics")
+    return server
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, default=0, metavar='PORT',
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (0 disables, default)")
@@ -0,0 +1,23 @@
+"""
+========================================
+ IPK25 server utilities
+========================================
+
+Process setup shared by the mock servers, the load generator and the
+replay tool, kept here so none of them has to import a server module
+for it.
+"""
+
+import resource
+
+from server_log import LOG
+
+
+def raise_fd_limit():
+    """Lifts the soft open-file limit to the hard limit so thousands of sockets fit."""
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        LOG.warning(f"[!] Could not raise open-file limit: {e}")
@@ -0,0 +1,200 @@
+"""
+========================================
+ IPK25 session capture
+========================================
+
+With --capture FILE, both mock servers append every message of every
+session to FILE, for ipk25_replay.py and for reading back what a client
+really sent when a bug only shows under load. The format is binary and
+append-only:
+
+  file header   "IPK25CAP" | version (u16)
+  record        time_ns (i64) | session (u64) | transport (u8) | event (u8) | length (u32) | data
+                little endian, 22 bytes before the data
+
+  time_ns    wall clock (time.time_ns), so records of worker processes interleave correctly
+  session    pid << 32 | per-process counter; unique across --workers
+  transport  TCP or UDP
+  event      OPEN (data: client "host:port"), IN, OUT, CLOSE (no data)
+
+UDP records hold one datagram each. TCP records hold what one read returned
+or one write sent, so they may carry several lines or part of one;
+lines() splits them again. Records show the server's view: inbound after
+the impairment stage, outbound before it. The listener's CONFIRM of an AUTH
+and REPLY NOK to refused AUTHs are not part of any session and are not
+recorded.
+
+Recording packs a header and appends it to a buffer. The buffer is written
+with one os.write when it reaches FLUSH_BYTES, every FLUSH_INTERVAL seconds
+on the server's timer heap, and at exit. O_APPEND keeps the writes of
+--workers processes sharing the file whole.
+"""
+
+import atexit
+import os
+import struct
+import threading
+import time
+from typing import NamedTuple
+
+from server_log import LOG
+
+MAGIC = b'IPK25CAP'
+VERSION = 1
+FILE_HEADER = struct.Struct('<8sH')
+RECORD = struct.Struct('<qQBBI')
+
+TCP, UDP = 0, 1
+TRANSPORTS = ('tcp', 'udp')
+OPEN, IN, OUT, CLOSE = 0, 1, 2, 3
+EVENTS = ('open', 'in', 'out', 'close')
+
+FLUSH_BYTES = 1 << 16
+FLUSH_INTERVAL = 0.5 # Seconds
+
+
+class Record(NamedTuple):
+    time_ns: int
+    session: int
+    transport: int
+    event: int
+    data: bytes
+
+
+class SessionCapture:
+    """Process-wide capture file; one instance (CAPTURE) per server process, off until open()."""
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self._fd = None
+        self._buffer = []
+        self._buffered = 0
+        self._lock = threading.Lock() # Threaded TCP handlers and the timer thread record concurrently
+        self._sessions = 0
+        self._timers = None
+        self._atexit = False # close() registered to run at exit
+
+    def open(self, path):
+        """
+        Starts appending to path; writes the file header if it creates the file. Raises OSError.
+        A file that is already open is flushed and closed first.
+        """
+        self.close()
+        try: # O_EXCL: of two servers started on one file, only the creator writes the header
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+            os.write(fd, FILE_HEADER.pack(MAGIC, VERSION))
+        except FileExistsError:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        with self._lock:
+            self._fd = fd
+            self.path = path
+            self.enabled = True
+        if not self._atexit:
+            atexit.register(self.close)
+            self._atexit = True
+
+    def attach(self, timers):
+        """Flushes every FLUSH_INTERVAL seconds from a server's timer heap; once per process."""
+        if not self.enabled or self._timers is not None:
+            return
+        self._timers = timers
+        timers.call_later(FLUSH_INTERVAL, self._tick)
+
+    def _tick(self):
+        self.flush()
+        if self._fd is not None:
+            self._timers.call_later(FLUSH_INTERVAL, self._tick)
+
+    # --- Hot path (callers check enabled first) ---
+    def open_session(self, transport, addr):
+        """Session id for a new client connection; records its OPEN."""
+        with self._lock:
+            self._sessions += 1
+            session = (os.getpid() << 32) | (self._sessions & 0xFFFFFFFF)
+        self.record(session, transport, OPEN, f"{addr[0]}:{addr[1]}".encode())
+        return session
+
+    def record(self, session, transport, event, data=b''):
+        data = bytes(data) # UDP hands in views of reused receive buffers
+        header = RECORD.pack(time.time_ns(), session, transport, event, len(data))
+        with self._lock:
+            self._buffer.append(header)
+            self._buffer.append(data)
+            self._buffered += RECORD.size + len(data)
+            if self._buffered >= FLUSH_BYTES:
+                self._flush_locked()
+
+    # --- Writing ---
+    def _flush_locked(self):
+        if not self._buffer or self._fd is None:
+            return
+        data = b''.join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+        try:
+            os.write(self._fd, data)
+        except OSError as e:
+            LOG.error(f"[!] Capture write to {self.path} failed, {len(data)} bytes lost: {e}")
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        with self._lock:
+            self._flush_locked()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+            self.enabled = False
+
+
+CAPTURE = SessionCapture()
+
+
+# --- Reading ---
+def read_capture(path):
+    """Yields the Records of a capture file in file order. Raises ValueError on a foreign file."""
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[0] != MAGIC:
+            raise ValueError(f"{path} is not an IPK25 capture file")
+        version = FILE_HEADER.unpack(header)[1]
+        if version != VERSION:
+            raise ValueError(f"{path}: capture version {version}, expected {VERSION}")
+        size = RECORD.size
+        while True:
+            head = f.read(size)
+            if len(head) < size:
+                return # A truncated tail is what a killed server leaves behind
+            time_ns, session, transport, event, length = RECORD.unpack(head)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield Record(time_ns, session, transport, event, data)
+
+def lines(data):
+    """Splits TCP record data at CRLF; a trailing partial line is kept as is."""
+    parts = data.split(b'\r\n')
+    result = [part + b'\r\n' for part in parts[:-1]]
+    if parts[-1]:
+        result.append(parts[-1])
+    return result
+
+
+# --- Command line ---
+def add_capture_arguments(parser):
+    parser.add_argument('--capture', metavar='FILE',
+                        help="append every message of every session to FILE (binary, see session_capture.py; "
+                             "ipk25_replay.py reads and replays it)")
+
+def capture_from_args(args):
+    """Opens --capture if given; exits with a message if the file cannot be opened."""
+    if not args.capture:
+        return
+    try:
+        CAPTURE.open(args.capture)
+    except OSError as e:
+        raise SystemExit(f"Cannot open capture file {args.capture}: {e}")
+    LOG.info("[~] Capturing sessions to %s", args.capture)
@@ -0,0 +1,137 @@
+"""
+========================================
+ IPK25 TCP grammar
+========================================
+
+Parses one TCP protocol line (without its CRLF) into a typed message.
+GRAMMAR holds one precompiled regex per keyword, fields separated by any run
+of whitespace. Keywords are case insensitive, as the IPK25-CHAT specification
+requires, and message content must not be empty:
+
+  AUTH {Username} AS {DisplayName} USING {Secret}
+  JOIN {ChannelID} AS {DisplayName}
+  MSG FROM {DisplayName} IS {MessageContent}
+  ERR FROM {DisplayName} IS {MessageContent}
+  BYE FROM {DisplayName}
+  REPLY {OK|NOK} IS {MessageContent}
+
+A line with a known keyword but bad syntax becomes a Malformed message.
+A line with an unknown keyword becomes an Unknown message.
+
+parse_line first tries the common shape (upper-case keywords, single split
+on whitespace) and hands everything else to the regexes, so both paths
+accept exactly the same lines.
+"""
+
+import re
+from typing import NamedTuple
+
+
+class Auth(NamedTuple):
+    username: str
+    display_name: str
+    secret: str
+
+class Join(NamedTuple):
+    channel_id: str
+    display_name: str
+
+class Msg(NamedTuple):
+    display_name: str
+    content: str
+
+class Err(NamedTuple):
+    display_name: str
+    content: str
+
+class Bye(NamedTuple):
+    display_name: str
+
+class Reply(NamedTuple):
+    success: bool
+    content: str
+
+class Malformed(NamedTuple):
+    keyword: str # Upper-cased keyword of the line that failed to parse
+    line: str
+
+class Unknown(NamedTuple):
+    line: str
+
+
+_new = tuple.__new__ # Builds the typed tuples without a Python-level __new__ call
+
+def _compile(pattern):
+    return re.compile(pattern, re.DOTALL).fullmatch
+
+# --- One regex per keyword; \s+ between fields, content must not be empty ---
+_AUTH = _compile(r'(?i:AUTH)\s+(\S+)\s+(?i:AS)\s+(\S+)\s+(?i:USING)\s+(\S+)\s*')
+_JOIN = _compile(r'(?i:JOIN)\s+(\S+)\s+(?i:AS)\s+(\S+)\s*')
+_MSG = _compile(r'(?i:MSG)\s+(?i:FROM)\s+(\S+)\s+(?i:IS)\s+(\S.*)')
+_ERR = _compile(r'(?i:ERR)\s+(?i:FROM)\s+(\S+)\s+(?i:IS)\s+(\S.*)')
+_BYE = _compile(r'(?i:BYE)\s+(?i:FROM)\s+(\S+)\s*')
+_REPLY = _compile(r'(?i:REPLY)\s+(?i:(OK)|NOK)\s+(?i:IS)\s+(\S.*)')
+_KEYWORD = re.compile(r'\S*').match
+
+def _fields(cls, match):
+    def parse(line):
+        m = match(line)
+        if m is not None:
+            return _new(cls, m.groups())
+    return parse
+
+def _reply(line):
+    m = _REPLY(line)
+    if m is not None:
+        ok, content = m.groups()
+        return _new(Reply, (ok is not None, content))
+
+# Keyword -> parser for the whole line (None when the syntax does not match)
+GRAMMAR = {
+    'AUTH': _fields(Auth, _AUTH),
+    'JOIN': _fields(Join, _JOIN),
+    'MSG': _fields(Msg, _MSG),
+    'ERR': _fields(Err, _ERR),
+    'BYE': _fields(Bye, _BYE),
+    'REPLY': _reply,
+}
+
+
+def parse_grammar(line):
+    """Parses one line with the GRAMMAR regexes alone; parse_line falls back to it."""
+    keyword = _KEYWORD(line).group().upper()
+    parser = GRAMMAR.get(keyword)
+    if parser is None:
+        return Unknown(line)
+    message = parser(line)
+    if message is None:
+        return Malformed(keyword, line)
+    return message
+
+
+def parse_line(line):
+    """Parses one line into Auth/Join/Msg/Err/Bye/Reply, Malformed or Unknown."""
+    # Fast path: upper-case keywords with the right field count, checked with one
+    # whitespace split. str.split() and the regex \s agree on what whitespace is,
+    # and split(None, 4) strips the content's leading whitespace just like \s+(\S.*).
+    key = line[:1]
+    try:
+        if key == 'M':
+            keyword, from_, name, is_, content = line.split(None, 4)
+            if keyword == 'MSG' and from_ == 'FROM' and is_ == 'IS':
+                return _new(Msg, (name, content))
+        elif key == 'A':
+            keyword, username, as_, name, using, secret = line.split()
+            if keyword == 'AUTH' and as_ == 'AS' and using == 'USING':
+                return _new(Auth, (username, name, secret))
+        elif key == 'J':
+            keyword, channel, as_, name = line.split()
+            if keyword == 'JOIN' and as_ == 'AS':
+                return _new(Join, (channel, name))
+        elif key == 'B':
+            keyword, from_, name = line.split()
+            if keyword == 'BYE' and from_ == 'FROM':
+                return _new(Bye, (name,))
+    except ValueError: # Wrong field count: the grammar decides
+        pass
+    return parse_grammar(line)
@@ -1,10 +1,25 @@
+import argparse
+import asyncio
+import collections
+import functools
+import os
 import socket
 import time
-import random
 import threading
 import signal
 import sys
 
+from channel_registry import ChannelRegistry, WorkerRelay, DEFAULT_CHANNEL
+from line_framer import LineFramer
+from protocol_core import END, ProtocolState, compile_table
+from scenarios import STANDARD, add_scenario_arguments, default_scenarios, scenarios_from_args
+from scheduler import IdleReaper, LoopTimerHeap, ThreadTimerHeap
+from server_log import LOG, add_log_arguments, configure_from_args
+from server_metrics import METRICS, add_metrics_arguments, start_http_server
+from server_util import raise_fd_limit
+from session_capture import CAPTURE, CLOSE, IN, OUT, TCP, add_capture_arguments, capture_from_args
+from tcp_grammar import Auth, Bye, Err, Join, Malformed, Msg, Reply, Unknown, parse_line
+
 """
 ========================================
  IPK25 Mock TCP Server (Python) - FSM Test Enhanced
@@ -17,9 +32,18 @@ Finite State Machine (FSM) defined in the project specification.
 ----------------------------------------
 How to use:
 1. Start the server: `python3 ipk25_tcp_server_fsm.py` (or your filename)
+   By default all clients are served from one asyncio event loop. Pass
+   `--mode threaded` to get the legacy thread-per-connection server, or
+   `--workers N` to fork N event-loop processes sharing the port
+   (SO_REUSEPORT); channel broadcasts are relayed between the workers.
+   A client that sends nothing for `--idle-timeout` seconds (default 60,
+   0 = never) gets BYE (ERR before it authenticated) and is disconnected.
+   `--capture FILE` records every session for ipk25_replay.py.
 2. Start your C# client with the strict FSM logic enabled:
    `dotnet run -- -t tcp -s 127.0.0.1`
 3. Use the specific commands/messages below to trigger test scenarios.
+   They are declared in scenarios.json, which the UDP server shares;
+   `--scenarios FILE` loads a different JSON or TOML file (scenarios.py).
 
 ----------------------------------------
 Standard Test Effects (from original description):
@@ -48,7 +72,10 @@ Messages:
 → contains `hello` or `hi`
    Replies "Hi!", "Hello {sender_name}!", "Hey there!"
 → anything else
-   Replies "MSG FROM python_server IS Received: '{content}'"
+   Broadcast as "MSG FROM <display_name> IS <content>" to every other
+   member of the sender's channel (clients start in 'default').
+   JOIN and disconnect/BYE announce "<display_name> joined/left <channel>."
+   to the channel.
 ----------------------------------------
 **NEW** FSM Strictness Test Scenarios:
 
@@ -74,39 +101,481 @@ Messages:
 
 HOST = '127.0.0.1'
 PORT = 4567
-
-def send_message_async(conn, addr, message, log_prefix="Sent Async"):
-    """Helper to send a message without blocking the main handler logic."""
+LISTEN_BACKLOG = 4096
+IDLE_TIMEOUT = 60 # Seconds without a line from the client before the server disconnects it
+SLOW_CLIENT_LIMIT = 1 << 20 # Unsent bytes above which a broadcast disconnects its recipient
+CLOSE_LINGER = 2.0 # Seconds a closing threaded connection gets to send what is still queued
+
+# Channel membership shared by every connection of this process
+CHANNELS = ChannelRegistry()
+
+# --- Per-connection outbound queue ---
+class OutboundQueue:
+    """
+    Ordered send queue for one connection. Messages pushed while a batch of
+    lines is processed are written together with a single write call.
+    It is also the connection's channel member: broadcasts arrive via deliver().
+
+    A delayed push parks the message on the shared timer heap. Everything
+    pushed after it waits behind it, so test pauses never reorder or split
+    the stream, and the handler itself never sleeps.
+
+    write never blocks: it is a SocketWriter's (threaded) or the transport's
+    (event loop). backlog() tells how much of it is still unsent; a client
+    that lets more than SLOW_CLIENT_LIMIT pile up is disconnected by the
+    next broadcast with abort(), so one stalled reader cannot grow the
+    server's memory or hold up the members that do read.
+    """
+
+    def __init__(self, addr, write, timers, backlog, abort):
+        self.addr = addr
+        self._write = write # SocketWriter.write (threaded) or transport write (event loop)
+        self._backlog = backlog
+        self._abort = abort # Drops the connection and whatever it has not sent yet
+        self.slow = False
+        self._timers = timers
+        self.capture_id = CAPTURE.open_session(TCP, addr) if CAPTURE.enabled else None
+        self._pending = []
+        self._delayed = collections.deque() # (release_time, data, log_prefix), release_time ascending
+        self._timer = None # Heap entry releasing the head of _delayed
+        self._lock = threading.RLock() # Keeps ordering when several threads flush
+
+    def push(self, data, log_prefix="Sent", delay=0):
+        """
+        Queues encoded bytes; a log_prefix of None sends them without a log line.
+        delay counts from the previously queued message, as the FSM describes its pauses.
+        """
+        with self._lock:
+            if not delay and not self._delayed:
+                self._pending.append((data, log_prefix))
+                return
+            base = self._delayed[-1][0] if self._delayed else self._timers.clock()
+            self._delayed.append((base + delay, data, log_prefix))
+            if self._timer is None:
+                self._timer = self._timers.call_at(base + delay, self._release)
+
+    def _release(self):
+        """Timer callback: moves due delayed messages to the pending batch and writes them."""
+        with self._lock:
+            self._timer = None
+            now = self._timers.clock()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, data, log_prefix = self._delayed.popleft()
+                self._pending.append((data, log_prefix))
+            if self._delayed:
+                self._timer = self._timers.call_at(self._delayed[0][0], self._release)
+        self.flush()
+
+    def flush(self):
+        """Writes every pending message in order. Returns False if the write failed."""
+        with self._lock:
+            if not self._pending:
+                return True
+            batch, self._pending = self._pending, []
+            payload = b''.join(data for data, _ in batch)
+            try:
+                self._write(payload)
+            except Exception as e:
+                LOG.error(f"[!] Error sending to {self.addr}: {e}")
+                return False
+            if self.capture_id is not None:
+                CAPTURE.record(self.capture_id, TCP, OUT, payload)
+        METRICS.add_bytes('tcp', 'out', len(payload))
+        for data, log_prefix in batch:
+            if log_prefix is not None:
+                LOG.debug("[<] %s to %s: %r", log_prefix, self.addr, data)
+        return True
+
+    def deliver(self, data, log_prefix="Sent Broadcast"):
+        """Channel fan-out entry point: queue and write immediately, or disconnect a client that fell behind."""
+        if self.slow:
+            return
+        if self._backlog() > SLOW_CLIENT_LIMIT:
+            self.slow = True
+            LOG.warning(f"[!] {self.addr} has over {SLOW_CLIENT_LIMIT} bytes unsent, disconnecting slow client")
+            METRICS.event('tcp', 'slow_client_disconnect')
+            self._abort()
+            return
+        METRICS.message('tcp', 'out', 'MSG') # Broadcasts are always MSG lines
+        self.push(data, log_prefix)
+        self.flush()
+
+    def close(self):
+        """Drops messages still waiting on a timer."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._delayed.clear()
+            self._pending.clear()
+        if self.capture_id is not None:
+            CAPTURE.record(self.capture_id, TCP, CLOSE)
+
+# --- Threaded mode: per-connection sending thread ---
+class SocketWriter:
+    """
+    Sends one connection's output from a thread of its own. write() only
+    queues, so a thread broadcasting to a slow client, or the timer thread
+    releasing a delayed line, never waits for that client's socket.
+    """
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self._chunks = []
+        self._queued = 0 # Bytes written but not yet sent, including the batch being sent
+        self._closing = False
+        self._aborted = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        with self._cond:
+            if self._closing:
+                raise BrokenPipeError("connection is closing")
+            self._chunks.append(data)
+            self._queued += len(data)
+            self._cond.notify()
+
+    def backlog(self):
+        return self._queued
+
+    def close(self, abort=False):
+        """Stops the thread once it has sent what is queued (abort: at once), then shuts the socket down."""
+        with self._cond:
+            self._closing = True
+            if abort:
+                self._aborted = True
+                self._chunks.clear()
+            self._cond.notify()
+
+    def abort(self):
+        self.close(abort=True)
+
+    def join(self, timeout=CLOSE_LINGER):
+        self._thread.join(timeout)
+
+    def _run(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._chunks and not self._closing:
+                        self._cond.wait()
+                    if not self._chunks:
+                        return
+                    payload = b''.join(self._chunks)
+                    self._chunks.clear()
+                if not self._send(payload):
+                    return
+                with self._cond:
+                    self._queued -= len(payload)
+        finally:
+            with self._cond:
+                self._closing = True
+                self._chunks.clear()
+                self._queued = 0
+            _shutdown(self.conn) # The handler's recv returns EOF if it is still reading
+
+    def _send(self, payload):
+        view = memoryview(payload)
+        while view:
+            if self._aborted:
+                return False
+            try:
+                view = view[self.conn.send(view):]
+            except socket.timeout:
+                continue # The handler's 0.2 s recv timeout also applies here; nothing was sent
+            except OSError as e:
+                LOG.info(f"[-] Error sending to {self.addr}: {e}")
+                return False
+        return True
+
+# --- Server-side FSM (shared by the threaded and event-loop servers) ---
+class ClientSession:
+    """Server-side protocol state for one TCP client, independent of the I/O model."""
+
+    def __init__(self, addr, member, channels=CHANNELS, scenarios=None):
+        self.addr = addr
+        self.fsm = ProtocolState(self._TABLE) # protocol_core state machine; handlers below are its actions
+        self.display_name = None
+        self.member = member # This client's entry in the channel registry
+        self.channels = channels
+        self.scenarios = scenarios if scenarios is not None else default_scenarios().matcher('tcp')
+        self.replied = [] # Kinds of lines answered immediately, for the latency histogram
+
+    def _announce(self, channel, text):
+        """Sends a Server notice to everyone in channel except this client."""
+        data = f"MSG FROM Server IS {text}\r\n".encode()
+        count = self.channels.broadcast(channel, data, exclude=self.member)
+        if count:
+            LOG.debug("[<] Broadcast to %d member(s) of '%s': %r", count, channel, text)
+
+    def _enter_channel(self, channel):
+        previous = self.channels.join(self.member, channel)
+        if previous is not None and previous != channel:
+            self._announce(previous, f"{self.display_name} left {previous}.")
+        self._announce(channel, f"{self.display_name} joined {channel}.")
+
+    def idle_goodbye(self):
+        """Line ending an idle session: BYE once authenticated, ERR before."""
+        authenticated = self.fsm.authenticated
+        self.fsm.enter(END)
+        METRICS.message('tcp', 'out', 'BYE' if authenticated else 'ERR')
+        return "BYE FROM Server\r\n" if authenticated else "ERR FROM Server IS Session idle for too long.\r\n"
+
+    def close(self):
+        """Drops this client from its channel and tells the remaining members."""
+        channel = self.channels.leave(self.member)
+        if channel is not None:
+            self._announce(channel, f"{self.display_name} left {channel}.")
+
+    def handle_line(self, current_command):
+        """
+        Runs one received line through the state machine.
+        Returns (outgoing, close): outgoing is a list of
+        (delay_before_send, message, log_prefix) tuples in send order,
+        close tells the caller to drop the connection once they are sent.
+        """
+        message = parse_line(current_command) # Parsed once, handlers only read fields
+        kind = self._KIND[type(message)]
+        fsm = self.fsm
+        METRICS.message('tcp', 'in', kind, fsm.state)
+        out = LineOutcome()
+        fsm.dispatch(self, kind, message, out)
+
+        # --- Queue Reply / Following Messages ---
+        reply = out.reply
+        if reply:
+            out.outgoing.append((out.reply_delay, reply, "Sent Reply"))
+            # State transition happens *after* sending the reply. A delayed reply
+            # (test_msg_during_auth/join) still moves the state now, on purpose:
+            # the old handler slept through the pause and handled the lines that
+            # came meanwhile after it, and an ERR for them would queue behind the
+            # delayed reply and be dropped with it when the connection closes.
+            if reply.startswith("REPLY OK"):
+                 fsm.replied(True)
+                 if out.join_channel is not None:
+                     self._enter_channel(out.join_channel)
+            elif reply.startswith("REPLY NOK"):
+                 fsm.replied(False)
+            elif reply.startswith("ERR"):
+                 fsm.enter(END)
+
+            # Messages scheduled after the reply; the queue keeps them behind it
+            out.outgoing.extend(out.after)
+
+        outgoing = out.outgoing
+        for _, text, _ in outgoing:
+            head = text.partition(' ')[0]
+            if head in self._OUT_KINDS: # The second half of the split test has no keyword
+                METRICS.message('tcp', 'out', head)
+        if outgoing and not outgoing[0][0]:
+            self.replied.append(kind)
+        return outgoing, out.terminate or fsm.state == END
+
+    def observe_replies(self, received_ns):
+        """Records receive-to-write latency for the lines answered since the last call."""
+        for kind in self.replied:
+            METRICS.observe('tcp', kind, received_ns)
+        self.replied.clear()
+
+    # --- State Machine Actions (protocol_core.TABLE picks one per state and message kind) ---
+    def _on_auth(self, msg, out):
+        # In AUTH_WAIT already, until the reply is queued; then OPEN (OK) or START (NOK)
+        self.display_name = msg.display_name
+        scenario = self.scenarios.match('AUTH', msg)
+        if scenario is not None:
+            self._run_scenario(scenario, msg, out, DEFAULT_CHANNEL)
+        else:
+            self._auth_standard(msg, out)
+
+    def _auth_standard(self, msg, out, step=STANDARD):
+        out.reply = "REPLY OK IS Welcome\r\n"
+        out.reply_delay = step.delay
+        if step.duplicate is not None:
+            out.after.append((step.duplicate, out.reply, "Sent Duplicate"))
+        out.after.append((0, f"MSG FROM Server IS {msg.display_name} joined {DEFAULT_CHANNEL}.\r\n", "Sent Extra"))
+        out.join_channel = DEFAULT_CHANNEL
+
+    def _on_join(self, msg, out):
+        # In JOIN_WAIT already, until the reply is queued; then OPEN
+        self.display_name = msg.display_name
+        scenario = self.scenarios.match('JOIN', msg)
+        if scenario is not None:
+            self._run_scenario(scenario, msg, out, msg.channel_id.lower())
+        else:
+            self._join_standard(msg, out)
+
+    def _join_standard(self, msg, out, step=STANDARD):
+        channel = msg.channel_id.lower()
+        out.reply = "REPLY OK IS Join success.\r\n"
+        out.reply_delay = step.delay
+        if step.duplicate is not None:
+            out.after.append((step.duplicate, out.reply, "Sent Duplicate"))
+        out.after.append((0, f"MSG FROM Server IS {msg.display_name} joined {channel}.\r\n", "Sent Extra"))
+        out.join_channel = channel
+
+    def _on_msg(self, msg, out):
+        self.display_name = msg.display_name # Follows /rename on the client
+        LOG.debug("[i] MSG content from %s: '%s'", self.display_name, msg.content)
+        scenario = self.scenarios.match('MSG', msg)
+        if scenario is not None:
+            self._run_scenario(scenario, msg, out)
+        else:
+            self._msg_standard(msg, out)
+
+    def _msg_standard(self, msg, out, step=STANDARD):
+        # Fan out to the channel, encoded once for all recipients
+        channel = self.channels.channel_of(self.member)
+        data = f"MSG FROM {self.display_name} IS {msg.content.strip()}\r\n".encode()
+        count = self.channels.broadcast(channel, data, exclude=self.member)
+        LOG.debug("[<] Broadcast MSG from %s to %d member(s) of '%s'", self.display_name, count, channel)
+
+    # --- Test scenarios (scenarios.py) ---
+    def _run_scenario(self, scenario, msg, out, channel=None):
+        """Turns a scenario's actions into the outcome; a REPLY OK enters channel."""
+        LOG.info("[*] TEST: scenario '%s' (%s %s)", scenario.name, scenario.kind, scenario.field)
+        for step in scenario.steps:
+            if step.action == 'standard':
+                self._STANDARD[scenario.kind](self, msg, out, step)
+            elif step.action == 'reply':
+                line = f"REPLY {step.kind} IS {step.render(msg)}\r\n"
+                if out.reply is None:
+                    out.reply = line
+                    out.reply_delay = step.delay
+                    if step.kind == 'OK':
+                        out.join_channel = channel
+                else:
+                    out.after.append((step.delay, line, "Sent Reply"))
+            else:
+                self._send_step(step, msg, out)
+
+    def _send_step(self, step, msg, out):
+        kind = step.kind
+        if kind == 'BYE':
+            line = f"BYE FROM {step.sender}\r\n"
+        elif kind == 'ERR':
+            line = f"ERR FROM {step.sender} IS {step.render(msg)}\r\n"
+        elif kind == 'RAW':
+            line = step.render(msg)
+        else:
+            line = f"MSG FROM {step.sender} IS {step.render(msg)}" + ("\r\n" if kind == 'MSG' else "")
+        if kind in ('BYE', 'ERR'):
+            self.fsm.enter(END)
+            out.terminate = True
+        # Before the reply while there is none, so a later reply action still comes after it
+        (out.outgoing if out.reply is None else out.after).append((step.delay, line, f"Sent {kind}"))
+
+    def _on_bye(self, msg, out):
+        LOG.info("[*] Received BYE from client. Closing connection.") # END_REQUESTED ends the loop; no reply to BYE
+
+    def _on_err(self, msg, out):
+        LOG.info(f"[*] Received ERR from client: '{msg.content}'. Closing connection.")
+
+    # Malformed AUTH/JOIN in the state that expects them gets REPLY NOK, as before
+    _MALFORMED_NOK = {
+        'AUTH': ('START', 'AUTH_WAIT', "REPLY NOK IS Invalid AUTH syntax\r\n"),
+        'JOIN': ('OPEN', 'JOIN_WAIT', "REPLY NOK IS Invalid JOIN syntax\r\n"),
+    }
+
+    def _on_malformed(self, msg, out):
+        if msg.keyword == 'BYE':
+            self.fsm.enter(END)
+            self._on_bye(msg, out)
+            return
+        expected = self._MALFORMED_NOK.get(msg.keyword)
+        if expected is not None and self.fsm.state == expected[0]:
+            self.fsm.enter(expected[1]) # Tentative state; the NOK moves it back
+            out.reply = expected[2]
+        else:
+            out.error(f"Malformed {msg.keyword} message.")
+
+    def _on_unknown(self, msg, out):
+        out.error(f"Unknown command: {repr(msg.line)}")
+
+    def _on_violation(self, msg, out, text):
+        out.error(text)
+
+    def _on_ignore(self, msg, out):
+        pass
+
+    _KIND = {
+        Auth: 'AUTH', Join: 'JOIN', Msg: 'MSG', Bye: 'BYE', Err: 'ERR', Reply: 'REPLY',
+        Malformed: 'MALFORMED', Unknown: 'UNKNOWN',
+    }
+    _OUT_KINDS = frozenset(('MSG', 'REPLY', 'ERR', 'BYE'))
+
+    _TABLE = compile_table({
+        'auth': _on_auth,
+        'join': _on_join,
+        'msg': _on_msg,
+        'err': _on_err,
+        'bye': _on_bye,
+        'ping': _on_ignore, # No PING in the text protocol
+        'malformed': _on_malformed,
+        'unknown': _on_unknown,
+        'violation': _on_violation,
+        'ignore': _on_ignore,
+    })
+    _STANDARD = {'AUTH': _auth_standard, 'JOIN': _join_standard, 'MSG': _msg_standard}
+
+
+class LineOutcome:
+    """What the FSM decided for one line; handle_line turns it into sends and state changes."""
+    __slots__ = ('outgoing', 'reply', 'reply_delay', 'after', 'join_channel', 'terminate')
+
+    def __init__(self):
+        self.outgoing = [] # Messages sent before the reply
+        self.reply = None
+        self.reply_delay = 0
+        self.after = [] # Messages sent after the reply
+        self.join_channel = None # Channel entered once the REPLY OK is queued
+        self.terminate = False # Close the connection after sending
+
+    def error(self, text):
+        self.reply = f"ERR FROM Server IS {text}\r\n"
+        self.terminate = True
+
+def expire_idle(session, queue, disconnect):
+    """Idle-reaper callback (both I/O models): sends the goodbye line, then drops the connection."""
+    LOG.info(f"[-] Client {session.addr} idle, disconnecting")
+    METRICS.event('tcp', 'idle_expired')
+    queue.push(session.idle_goodbye().encode(), "Sent Idle")
+    queue.flush()
+    disconnect() # The handler sees EOF and cleans up as for any disconnect
+
+def _shutdown(conn):
     try:
-        conn.sendall(message.encode())
-        print(f"[<] {log_prefix} to {addr}: {repr(message)}")
-    except Exception as e:
-        print(f"[!] Error in send_message_async to {addr}: {e}")
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass # Already closed by the handler
 
-def handle_client(conn, addr):
+# --- Legacy thread-per-connection handler ---
+def handle_client(conn, addr, timers, reaper, scenarios=None):
     """Handles communication with a single connected client."""
-    print(f"[+] Client connected from {addr}")
-    client_state = 'START' # Simulate server-side state tracking
-    display_name = None
+    LOG.info(f"[+] Client connected from {addr}")
+    METRICS.session_opened('tcp')
+    writer = SocketWriter(conn, addr)
+    queue = OutboundQueue(addr, writer.write, timers, writer.backlog, writer.abort)
+    session = ClientSession(addr, queue, scenarios=scenarios)
+    idle = reaper.add(expire_idle, session, queue, writer.close)
 
     # --- FSM Test: Send unexpected REPLY in START state ---
     # This is hard to test reliably as client sends AUTH quickly.
     # A better test is sending unexpected REPLY in OPEN state later.
     # Uncomment the following lines ONLY for specific START state testing:
-    # if client_state == 'START':
+    # if session.fsm.state == 'START':
     #    time.sleep(0.5) # Give client tiny moment to connect fully
-    #    print("[*] TEST: Sending unexpected REPLY in START state")
+    #    LOG.info("[*] TEST: Sending unexpected REPLY in START state")
     #    reply_in_start = "REPLY OK IS Unexpected REPLY in START!\r\n"
-    #    threading.Thread(target=send_message_async, args=(conn, addr, reply_in_start, "Sent Test"), daemon=True).start()
+    #    queue.push(reply_in_start.encode(), "Sent Test"); queue.flush()
     #    # We might continue processing AUTH after this, or client might disconnect
 
     try:
-        buffer = ""
-        while True:
-            reply = None
-            extra_msg_after_reply = None
-            send_reply_normally = True # Flag to control normal reply sending
-
+        framer = LineFramer()
+        close = False
+        while not close:
             try:
                 # Increased buffer size slightly, use non-blocking recv with timeout
                 conn.settimeout(0.2) # Short non-blocking timeout
@@ -114,242 +583,170 @@ def handle_client(conn, addr):
                      data_bytes = conn.recv(8192)
                 except socket.timeout:
                     # No data received in this short interval, loop again
-                    # This allows checking connection state more frequently
-                    if client_state == 'END_REQUESTED': # Check if we decided to end
-                         break
                     continue
                 except (ConnectionResetError, ConnectionAbortedError):
-                    print(f"[-] Connection reset or aborted by {addr}")
+                    LOG.info(f"[-] Connection reset or aborted by {addr}")
                     break
                 except OSError as e:
-                    print(f"[!] Socket error receiving from {addr}: {e}")
+                    LOG.error(f"[!] Socket error receiving from {addr}: {e}")
                     break
 
                 if not data_bytes:
-                    print(f"[-] Client {addr} disconnected (recv returned 0 bytes).")
+                    LOG.info(f"[-] Client {addr} disconnected (recv returned 0 bytes).")
                     break
 
-                buffer += data_bytes.decode('utf-8', errors='ignore') # Ignore decode errors for simplicity
+                received_ns = time.perf_counter_ns()
+                idle.touch()
+                METRICS.add_bytes('tcp', 'in', len(data_bytes))
+                if queue.capture_id is not None:
+                    CAPTURE.record(queue.capture_id, TCP, IN, data_bytes)
+                lines = framer.feed(data_bytes)
 
-            except UnicodeDecodeError:
-                 print(f"[!] Received non-UTF8 data from {addr}. Closing.")
-                 err_msg = "ERR FROM Server IS Malformed non-UTF8 message received.\r\n"
-                 threading.Thread(target=send_message_async, args=(conn, addr, err_msg, "Sent Error"), daemon=True).start()
-                 client_state = 'END_REQUESTED' # Signal to exit loop
-                 continue # Go back to loop check
             except Exception as e:
-                 print(f"[!] Error during recv/decode: {e}")
+                 LOG.error(f"[!] Error during recv/decode: {e}")
                  break # Exit on other recv errors
 
-
             # Process complete lines from the buffer
-            while '\r\n' in buffer:
-                line, buffer = buffer.split('\r\n', 1)
-                print(f"[>] Received Line: {repr(line)}")
-                current_command = line # Process one command/line at a time
-
-                # Reset flags/messages for each command
-                reply = None
-                extra_msg_after_reply = None
-                send_reply_normally = True
-                terminate_after_send = False # Flag to break after sending ERR/BYE
-
-                # --- State Machine Logic ---
-                if current_command.startswith("AUTH"):
-                    if client_state != 'START':
-                        reply = "ERR FROM Server IS Already authenticated or invalid state for AUTH.\r\n"
-                        terminate_after_send = True
-                    else:
-                        client_state = 'AUTH_WAIT' # Tentative state while processing
-                        try:
-                            parts = current_command.strip().split()
-                            if len(parts) >= 6 and parts[2] == "AS" and parts[4] == "USING":
-                                secret = parts[5]
-                                display_name = parts[3]
-
-                                if "test_msg_during_auth" in display_name.lower():
-                                    print("[*] TEST: Sending MSG during AUTH wait")
-                                    client_state = 'AUTH_WAIT' # Remain waiting
-                                    # Send MSG *before* the reply
-                                    unexpected_msg = f"MSG FROM Server IS Unexpected MSG during AUTH!\r\n"
-                                    threading.Thread(target=send_message_async, args=(conn, addr, unexpected_msg, "Sent Test (Before AUTH Reply)"), daemon=True).start()
-                                    time.sleep(0.2) # Small delay
-                                    # Now prepare the normal reply
-                                    reply = "REPLY OK IS Welcome (test_msg_during_auth)\r\n"
-                                    # State will transition properly after sending reply
-
-                                elif display_name.lower() == "nerd":
-                                    reply = "REPLY NOK IS Nerds must pay the Nerd Tax first.\r\n"
-                                    # State remains AUTH_WAIT until reply sent, then START
-                                elif secret.lower() == "invalid":
-                                    reply = "REPLY NOK IS Invalid credentials\r\n"
-                                    # State remains AUTH_WAIT until reply sent, then START
-                                else:
-                                    reply = "REPLY OK IS Welcome\r\n"
-                                    extra_msg_after_reply = f"MSG FROM Server IS {display_name} joined default.\r\n"
-                                    # State remains AUTH_WAIT until reply sent, then OPEN
-                            else:
-                                reply = "REPLY NOK IS Invalid AUTH syntax\r\n"
-                                # State remains AUTH_WAIT until reply sent, then START
-                        except Exception as e:
-                            print(f"[!] Exception during AUTH parsing: {e}")
-                            reply = "REPLY NOK IS Malformed AUTH\r\n"
-                            # State remains AUTH_WAIT until reply sent, then START
-
-                elif current_command.startswith("JOIN"):
-                    if client_state != 'OPEN':
-                        reply = "ERR FROM Server IS Must be in OPEN state to JOIN.\r\n"
-                        terminate_after_send = True
-                    else:
-                        client_state = 'JOIN_WAIT' # Tentative state
-                        try:
-                            parts = current_command.strip().split()
-                            if len(parts) >= 4 and parts[2] == "AS":
-                                channel = parts[1].lower()
-                                join_display_name = parts[3]
-
-                                if channel == "secret":
-                                    reply = "REPLY NOK IS You are not allowed to join this channel\r\n"
-                                    # State remains JOIN_WAIT until reply sent, then OPEN
-                                elif channel == "nothing":
-                                    print("[*] TEST: Simulating no response for JOIN nothing")
-                                    # Stay in JOIN_WAIT, send nothing
-                                    send_reply_normally = False
-                                elif "test_msg_during_join" in channel:
-                                    print("[*] TEST: Sending MSG during JOIN wait")
-                                    # Send MSG *before* the reply
-                                    unexpected_msg = f"MSG FROM Server IS Unexpected MSG during JOIN!\r\n"
-                                    threading.Thread(target=send_message_async, args=(conn, addr, unexpected_msg,"Sent Test (Before JOIN Reply)"), daemon=True).start()
-                                    time.sleep(0.2)
-                                    # Prepare normal reply
-                                    reply = "REPLY OK IS Join success (test_msg_during_join)\r\n"
-                                     # State remains JOIN_WAIT until reply sent, then OPEN
-                                else:
-                                    reply = f"REPLY OK IS Join success.\r\n"
-                                    extra_msg_after_reply = f"MSG FROM Server IS {join_display_name} joined {channel}.\r\n"
-                                    # State remains JOIN_WAIT until reply sent, then OPEN
-                            else:
-                                reply = "REPLY NOK IS Invalid JOIN syntax\r\n"
-                                # State remains JOIN_WAIT until reply sent, then OPEN
-                        except Exception as e:
-                             print(f"[!] Exception during JOIN parsing: {e}")
-                             reply = "REPLY NOK IS Malformed JOIN\r\n"
-                             # State remains JOIN_WAIT until reply sent, then OPEN
-
-                elif current_command.startswith("MSG"):
-                    if client_state != 'OPEN':
-                        reply = "ERR FROM Server IS Not authorized or wrong state for MSG.\r\n"
-                        terminate_after_send = True
-                    else:
-                        try:
-                            # Basic parsing
-                            is_index = current_command.find(" IS ")
-                            content = current_command[is_index + 4:].strip() if is_index != -1 else ""
-                            content_lower = content.lower()
-                            sender_name = display_name
-
-                            print(f"[i] MSG content from {sender_name}: '{content}'")
-
-                            # Test Triggers
-                            if "err" == content_lower:
-                                reply = "ERR FROM Server IS Simulated error requested\r\n"
-                                terminate_after_send = True
-                            elif "split" == content_lower:
-                                print("[*] TEST: Simulating split message send")
-                                part1 = "MSG FROM python_server "
-                                part2 = f"IS you sent '{content}' (split test)\r\nMSG FROM python_server IS another one \r\n"
-                                # Use threads to avoid blocking loop
-                                threading.Thread(target=send_message_async, args=(conn, addr, part1, "Sent PART 1"), daemon=True).start()
-                                time.sleep(2)
-                                threading.Thread(target=send_message_async, args=(conn, addr, part2, "Sent PART 2"), daemon=True).start()
-                                send_reply_normally = False
-                            elif "test_reply_in_open" == content_lower:
-                                 print("[*] TEST: Sending unexpected REPLY in OPEN state")
-                                 reply = f"REPLY OK IS This reply is unexpected!\r\n"
-                                 # Client should terminate based on this reply
-                            # Conversational Logic (Optional)
-                            elif "hello" in content_lower or "hi" in content_lower:
-                                possible_replies = ["Hi!", f"Hello {sender_name}!", "Hey there!"]
-                                reply = f"MSG FROM python_server IS {random.choice(possible_replies)}\r\n"
-                            # Default reply
-                            else:
-                                reply = f"MSG FROM python_server IS Received: '{content}'\r\n"
-                        except Exception as e:
-                             print(f"[!] Exception during MSG processing: {e}")
-                             reply = "ERR FROM Server IS Error processing message\r\n"
-                             terminate_after_send = True
-
-                elif current_command.startswith("BYE"):
-                    print("[*] Received BYE from client. Closing connection.")
-                    reply = None # No reply to BYE
-                    send_reply_normally = False
-                    client_state = 'END_REQUESTED' # Signal loop to exit
-
-                else: # Unknown command
-                    reply = f"ERR FROM Server IS Unknown command: {repr(current_command)}\r\n"
-                    terminate_after_send = True
-
-                # --- Send Reply / Extra Message ---
-                if reply and send_reply_normally:
-                    # Use thread to avoid blocking
-                    threading.Thread(target=send_message_async, args=(conn, addr, reply, "Sent Reply"), daemon=True).start()
-                    # State transition happens *after* sending the reply
-                    if reply.startswith("REPLY OK"):
-                         if client_state == 'AUTH_WAIT': client_state = 'OPEN'
-                         elif client_state == 'JOIN_WAIT': client_state = 'OPEN'
-                    elif reply.startswith("REPLY NOK"):
-                         if client_state == 'AUTH_WAIT': client_state = 'START'
-                         elif client_state == 'JOIN_WAIT': client_state = 'OPEN'
-                    elif reply.startswith("ERR"):
-                         client_state = 'END_REQUESTED'
-
-
-                    # Send extra message if scheduled (also in thread)
-                    if extra_msg_after_reply:
-                         # Short delay before sending extra message
-                         time.sleep(0.05)
-                         threading.Thread(target=send_message_async, args=(conn, addr, extra_msg_after_reply, "Sent Extra"), daemon=True).start()
-
-                if terminate_after_send or client_state == 'END_REQUESTED':
+            for line in lines:
+                LOG.debug("[>] Received Line: %r", line)
+                outgoing, close = session.handle_line(line) # Process one command/line at a time
+
+                # --- Queue Reply / Extra Message ---
+                for delay, message, log_prefix in outgoing:
+                    queue.push(message.encode(), log_prefix, delay)
+
+                if close:
                     break # Exit inner command processing loop
 
-            # Check if we should exit outer loop
-            if client_state == 'END_REQUESTED':
-                 break
+            # One write for everything the lines of this read produced
+            if not queue.flush():
+                break
+            if session.replied:
+                session.observe_replies(received_ns)
+
+    except Exception as e:
+        LOG.error(f"[!] Unhandled exception in client handler for {addr}: {e}")
+
+    finally:
+        LOG.info(f"[-] Client from {addr} disconnected")
+        idle.cancel()
+        session.close()
+        queue.close()
+        METRICS.session_closed('tcp')
+        writer.close() # Sends what is queued (ERR, BYE) and shuts the socket down
+        writer.join()
+        _shutdown(conn) # In case the writer is still stuck after CLOSE_LINGER
+        conn.close()
 
+# --- Event-loop handler (one coroutine per connection, all in one thread) ---
+async def handle_client_async(reader, writer, timers, reaper, scenarios=None, connections=None):
+    """Handles communication with a single connected client on the event loop."""
+    addr = writer.get_extra_info('peername')
+    if connections is not None:
+        connections[asyncio.current_task()] = writer
+    LOG.info(f"[+] Client connected from {addr}")
+    METRICS.session_opened('tcp')
+    queue = OutboundQueue(addr, writer.write, timers, writer.transport.get_write_buffer_size, writer.transport.abort)
+    session = ClientSession(addr, queue, scenarios=scenarios)
+    idle = reaper.add(expire_idle, session, queue, writer.close)
+
+    try:
+        framer = LineFramer()
+        close = False
+        while not close:
+            try:
+                data_bytes = await reader.read(8192)
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                LOG.info(f"[-] Connection reset or aborted by {addr}")
+                break
+            except OSError as e:
+                LOG.error(f"[!] Socket error receiving from {addr}: {e}")
+                break
+
+            if not data_bytes:
+                LOG.info(f"[-] Client {addr} disconnected (recv returned 0 bytes).")
+                break
+            received_ns = time.perf_counter_ns()
+            idle.touch()
+            METRICS.add_bytes('tcp', 'in', len(data_bytes))
+            if queue.capture_id is not None:
+                CAPTURE.record(queue.capture_id, TCP, IN, data_bytes)
+
+            # Process complete lines from the buffer
+            for line in framer.feed(data_bytes):
+                LOG.debug("[>] Received Line: %r", line)
+                outgoing, close = session.handle_line(line)
+
+                for delay, message, log_prefix in outgoing:
+                    queue.push(message.encode(), log_prefix, delay)
+
+                if close:
+                    break
+
+            # One write for everything the lines of this read produced
+            queue.flush()
+            if session.replied:
+                session.observe_replies(received_ns)
+            try:
+                await writer.drain()
+            except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+                LOG.info(f"[-] Connection to {addr} lost while sending")
+                break
 
     except Exception as e:
-        print(f"[!] Unhandled exception in client handler for {addr}: {e}")
+        LOG.error(f"[!] Unhandled exception in client handler for {addr}: {e}")
 
     finally:
-        print(f"[-] Client from {addr} disconnected")
+        LOG.info(f"[-] Client from {addr} disconnected")
+        idle.cancel()
+        session.close()
+        queue.close()
+        METRICS.session_closed('tcp')
+        writer.close()
         try:
-            conn.shutdown(socket.SHUT_RDWR) # Signal close intent
+            await writer.wait_closed()
         except OSError:
-            pass # Ignore if already closed
-        conn.close()
-
-# --- run_server function ---
-def run_server():
+            pass # Ignore if the peer already reset the connection
+        if connections is not None:
+            connections.pop(asyncio.current_task(), None)
+
+async def close_connections(connections):
+    """Closes every open client connection and waits for its handler to finish.
+
+    Without this, asyncio.run cancels the handlers still blocked in read() at
+    shutdown and logs a CancelledError traceback for each of them.
+    """
+    for writer in list(connections.values()):
+        writer.close() # The handler's read() returns EOF and it closes the session normally
+    if connections:
+        await asyncio.gather(*connections, return_exceptions=True)
+
+# --- run_server function (legacy threaded mode) ---
+def run_server(host=HOST, port=PORT, metrics_port=0, idle_timeout=IDLE_TIMEOUT, scenarios=None):
     """Sets up the server socket and listens for incoming connections."""
-    print(f"[~] IPK25 Mock TCP Server (FSM Test Enhanced) running on {HOST}:{PORT}")
+    LOG.info(f"[~] IPK25 Mock TCP Server (FSM Test Enhanced, threaded) running on {host}:{port}")
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
         # Allow reusing address quickly after server restart
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            server.bind((HOST, PORT))
+            server.bind((host, port))
             server.listen()
-            print("[~] Waiting for connections...")
+            LOG.info("[~] Waiting for connections...")
         except Exception as e:
-             print(f"[!] Failed to start server: {e}")
+             LOG.error(f"[!] Failed to start server: {e}")
              return
 
         active_threads = []
         running = True
+        timers = ThreadTimerHeap().start() # One thread serves every delayed send and idle expiry
+        reaper = IdleReaper(timers, idle_timeout)
+        CAPTURE.attach(timers)
+        if metrics_port:
+            start_http_server(metrics_port)
 
         def signal_handler(sig, frame):
             nonlocal running
-            print("\n[~] Server shutdown requested (Ctrl+C).")
+            LOG.info("\n[~] Server shutdown requested (Ctrl+C).")
             running = False
             # Optionally try to close the listening socket to break the accept loop
             # This might raise an exception in the main loop, which is caught
@@ -367,7 +764,7 @@ def run_server():
             try:
                 conn, addr = server.accept()
                 # Create and start a new thread for each client
-                thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
+                thread = threading.Thread(target=handle_client, args=(conn, addr, timers, reaper, scenarios), daemon=True)
                 active_threads.append(thread)
                 thread.start()
                 # Clean up finished threads
@@ -383,15 +780,135 @@ def run_server():
             except Exception as e:
                  # Log other errors during accept, but keep server running if possible
                  if running: # Only log if we weren't intentionally shutting down
-                     print(f"[!] Error accepting connection: {e}")
+                     LOG.error(f"[!] Error accepting connection: {e}")
                  else:
-                      print("[~] Server socket closed during shutdown.")
+                      LOG.info("[~] Server socket closed during shutdown.")
 
 
-        print("[~] Server main loop finished. Shutting down...")
+        LOG.info("[~] Server main loop finished. Shutting down...")
+        timers.stop()
         # No need to explicitly join daemon threads, they will exit with main thread
-        print("[~] Server shut down.")
+        LOG.info("[~] Server shut down.")
+
+# --- run_server_async function (default event-loop mode) ---
+async def serve_async(host=HOST, port=PORT, relay=None, metrics_port=0, idle_timeout=IDLE_TIMEOUT, scenarios=None):
+    """Serves every client from one event loop until SIGINT/SIGTERM."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    timers = LoopTimerHeap(loop)
+    reaper = IdleReaper(timers, idle_timeout)
+    connections = {} # Handler task -> its writer
+    CAPTURE.attach(timers)
+    if relay is not None:
+        relay.attach(loop, CHANNELS)
+    if metrics_port:
+        start_http_server(metrics_port + (relay.index if relay is not None else 0)) # One port per worker
+    try:
+        server = await asyncio.start_server(functools.partial(handle_client_async, timers=timers, reaper=reaper,
+                                                              scenarios=scenarios, connections=connections),
+                                            host, port,
+                                            reuse_address=True, reuse_port=relay is not None,
+                                            backlog=LISTEN_BACKLOG)
+    except OSError as e:
+        LOG.error(f"[!] Failed to start server: {e}")
+        return
+
+    worker = f", worker {relay.index} pid {os.getpid()}" if relay is not None else ""
+    LOG.info(f"[~] IPK25 Mock TCP Server (FSM Test Enhanced, event loop{worker}) running on {host}:{port}")
+    LOG.info("[~] Waiting for connections...")
+    async with server:
+        await stop.wait()
+        LOG.info("\n[~] Server shutdown requested (Ctrl+C).")
+        await close_connections(connections)
+    timers.close()
+    LOG.info("[~] Server shut down.")
+
+def run_server_async(host=HOST, port=PORT, metrics_port=0, idle_timeout=IDLE_TIMEOUT, scenarios=None):
+    """Runs the single-threaded event-loop server."""
+    raise_fd_limit()
+    asyncio.run(serve_async(host, port, metrics_port=metrics_port, idle_timeout=idle_timeout, scenarios=scenarios))
+
+# --- run_workers function (multi-process event-loop mode) ---
+def run_workers(host=HOST, port=PORT, workers=None, metrics_port=0, idle_timeout=IDLE_TIMEOUT,
+                scenarios=None):
+    """
+    Forks one event-loop server per worker, all bound to the same port with SO_REUSEPORT.
+    workers defaults to the number of CPUs.
+    """
+    workers = workers or os.cpu_count() or 1
+    raise_fd_limit()
+    pairs = WorkerRelay.create_pairs(workers)
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                asyncio.run(serve_async(host, port, WorkerRelay(index, pairs), metrics_port, idle_timeout, scenarios))
+            except Exception as e:
+                LOG.error(f"[!] Worker {index} failed: {e}")
+                code = 1
+            finally:
+                CAPTURE.close()
+                LOG.close() # os._exit skips interpreter cleanup
+                sys.stdout.flush()
+                os._exit(code)
+        children.append(pid)
+    LOG.info(f"[~] Started {workers} worker processes: {children}")
+
+    def signal_handler(sig, frame):
+        LOG.info(f"\n[~] Server shutdown requested, stopping {len(children)} workers.")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    LOG.info("[~] All workers stopped.")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IPK25 Mock TCP Server")
+    parser.add_argument('--host', default=HOST, help=f"address to bind (default {HOST})")
+    parser.add_argument('--port', type=int, default=PORT, help=f"port to bind (default {PORT})")
+    parser.add_argument('--mode', choices=('async', 'threaded'), default='async',
+                        help="'async' serves all clients from one event loop (default), "
+                             "'threaded' is the legacy thread-per-connection server")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="fork N event-loop worker processes sharing the port via SO_REUSEPORT "
+                             "(async mode only, default 1)")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, metavar='S',
+                        help=f"disconnect clients silent for S seconds, with BYE (ERR before AUTH succeeded); "
+                             f"0 = never (default {IDLE_TIMEOUT})")
+    add_scenario_arguments(parser)
+    add_capture_arguments(parser) # Workers append to the same file
+    add_log_arguments(parser)
+    add_metrics_arguments(parser) # With --workers, worker i serves on PORT + i
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and args.mode != 'async':
+        parser.error("--workers requires --mode async")
+    return args
 
 
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    args = parse_args()
+    configure_from_args(args)
+    scenarios = scenarios_from_args(args).matcher('tcp')
+    capture_from_args(args)
+    if args.mode == 'threaded':
+        run_server(args.host, args.port, args.metrics_port, args.idle_timeout, scenarios)
+    elif args.workers > 1:
+        run_workers(args.host, args.port, args.workers, args.metrics_port, args.idle_timeout, scenarios)
+    else:
+        run_server_async(args.host, args.port, args.metrics_port, args.idle_timeout, scenarios)
@@ -0,0 +1,62 @@
+from line_framer import LineFramer
+
+
+def test_single_line():
+    framer = LineFramer()
+    assert framer.feed(b"AUTH a AS b USING c\r\n") == ["AUTH a AS b USING c"]
+    assert framer.pending == 0
+
+
+def test_many_lines_in_one_read():
+    framer = LineFramer()
+    data = b"".join(b"MSG FROM a IS %d\r\n" % i for i in range(500))
+    lines = framer.feed(data)
+    assert lines == [f"MSG FROM a IS {i}" for i in range(500)]
+    assert framer.pending == 0
+
+
+def test_line_split_across_reads():
+    # Same shape as the server's `split` scenario
+    framer = LineFramer()
+    assert framer.feed(b"MSG FROM python_server ") == []
+    assert framer.pending == len(b"MSG FROM python_server ")
+    assert framer.feed(b"IS you sent 'split' (split test)\r\nMSG FROM python_server IS another one \r\n") == [
+        "MSG FROM python_server IS you sent 'split' (split test)",
+        "MSG FROM python_server IS another one ",
+    ]
+    assert framer.pending == 0
+
+
+def test_delimiter_split_across_reads():
+    framer = LineFramer()
+    assert framer.feed(b"BYE FROM a\r") == []
+    assert framer.feed(b"\nJOIN c AS a") == ["BYE FROM a"]
+    assert framer.feed(b"\r\n") == ["JOIN c AS a"]
+
+
+def test_byte_by_byte():
+    framer = LineFramer()
+    data = b"MSG FROM a IS x\r\nMSG FROM a IS y\r\n"
+    lines = []
+    for i in range(len(data)):
+        lines += framer.feed(data[i:i + 1])
+    assert lines == ["MSG FROM a IS x", "MSG FROM a IS y"]
+
+
+def test_empty_line_and_partial_tail():
+    framer = LineFramer()
+    assert framer.feed(b"\r\nMSG FROM a IS") == [""]
+    assert framer.pending == len(b"MSG FROM a IS")
+
+
+def test_invalid_utf8_is_ignored():
+    framer = LineFramer()
+    assert framer.feed(b"MSG FROM a IS \xff\xfeok\r\n") == ["MSG FROM a IS ok"]
+
+
+def test_clear():
+    framer = LineFramer()
+    framer.feed(b"partial")
+    framer.clear()
+    assert framer.pending == 0
+    assert framer.feed(b"x\r\n") == ["x"]
@@ -0,0 +1,67 @@
+from udp_ipk25_server import MessageIdWindow
+
+
+def test_first_and_repeated_id():
+    window = MessageIdWindow()
+    assert window.check_and_add(7) is False
+    assert window.check_and_add(7) is True
+
+
+def test_in_order_ids_are_new_once():
+    window = MessageIdWindow()
+    assert [window.check_and_add(i) for i in range(200)] == [False] * 200
+    assert [window.check_and_add(i) for i in range(200 - MessageIdWindow.WINDOW, 200)] == [True] * MessageIdWindow.WINDOW
+
+
+def test_duplicates_across_wrap():
+    window = MessageIdWindow()
+    ids = [0xFFFD, 0xFFFE, 0xFFFF, 0, 1, 2]
+    assert [window.check_and_add(i) for i in ids] == [False] * len(ids)
+    assert window.highest == 2 # 0 is newer than 0xFFFF
+    assert [window.check_and_add(i) for i in ids] == [True] * len(ids)
+
+
+def test_reordered_across_wrap():
+    window = MessageIdWindow()
+    assert window.check_and_add(1) is False
+    assert window.check_and_add(0xFFFF) is False # Late, but inside the window
+    assert window.check_and_add(0) is False
+    assert window.highest == 1
+    assert window.check_and_add(0xFFFF) is True
+    assert window.check_and_add(0) is True
+
+
+def test_reordering_inside_window():
+    window = MessageIdWindow()
+    order = [10, 14, 11, 13, 12, 20, 15, 19, 16, 18, 17]
+    assert [window.check_and_add(i) for i in order] == [False] * len(order)
+    assert window.highest == 20
+    assert [window.check_and_add(i) for i in range(10, 21)] == [True] * 11
+
+
+def test_too_old_for_window():
+    window = MessageIdWindow()
+    window.check_and_add(100)
+    window.check_and_add(100 + MessageIdWindow.WINDOW)
+    # Never seen, but older than the window can tell apart: treated as a late retransmission
+    assert window.check_and_add(99) is True
+    assert window.check_and_add(100) is True
+    assert window.check_and_add(101) is False # Just inside
+    assert window.check_and_add(101) is True
+
+
+def test_too_old_across_wrap():
+    window = MessageIdWindow()
+    window.check_and_add(0xFFF0)
+    window.check_and_add((0xFFF0 + MessageIdWindow.WINDOW) & 0xFFFF)
+    assert window.check_and_add(0xFFEF) is True
+    assert window.check_and_add(0xFFF0) is True
+    assert window.check_and_add(0xFFF1) is False # Just inside
+
+
+def test_big_jump_resets_window():
+    window = MessageIdWindow()
+    window.check_and_add(5)
+    window.check_and_add(5 + 1000)
+    assert window.mask == 1
+    assert window.check_and_add(5 + 1000 - 1) is False
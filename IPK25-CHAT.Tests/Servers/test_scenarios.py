@@ -0,0 +1,96 @@
+import random
+import timeit
+from types import SimpleNamespace
+
+import scenarios
+from scenarios import Matcher, ScenarioBook, _Automaton, _Substrings, _parse_scenario
+
+
+def scenario(index, mode, pattern, kind='MSG', field='content', transport=None):
+    raw = {'name': f"s{index}", 'on': kind, 'field': field, mode: pattern, 'actions': []}
+    if transport is not None:
+        raw['transport'] = transport
+    return _parse_scenario(index, raw)
+
+def msg(content):
+    return SimpleNamespace(display_name='Dn', content=content)
+
+def linear_scan(book, kind, message):
+    """Reference: the first scenario in file order that message triggers."""
+    for s in book.scenarios:
+        if s.kind != kind:
+            continue
+        value = getattr(message, s.field).lower()
+        if (value.strip() == s.pattern) if s.mode == 'equals' else (s.pattern in value):
+            return s
+    return None
+
+
+def test_exact_lookup_folds_case_and_strips():
+    matcher = Matcher([scenario(0, 'equals', 'Split'), scenario(1, 'equals', 'err')])
+    assert matcher.match('MSG', msg("split")).name == 's0'
+    assert matcher.match('MSG', msg("SPLIT ")).name == 's0'
+    assert matcher.match('MSG', msg("ERR")).name == 's1'
+    assert matcher.match('MSG', msg("split it")) is None
+    assert matcher.match('JOIN', msg("split")) is None
+
+
+def test_contains_folds_case():
+    matcher = Matcher([scenario(0, 'contains', 'NoConfirm')])
+    assert matcher.match('MSG', msg("please NOCONFIRM this")).name == 's0'
+    assert matcher.match('MSG', msg("no confirm")) is None
+
+
+def test_earlier_scenario_wins_across_modes():
+    matcher = Matcher([scenario(0, 'contains', 'hello'), scenario(1, 'equals', 'hello there'),
+                       scenario(2, 'contains', 'hi')])
+    assert matcher.match('MSG', msg("hello there")).name == 's0'
+    assert matcher.match('MSG', msg("hi hello")).name == 's0'
+    assert matcher.match('MSG', msg("this")).name == 's2'
+
+
+def test_matcher_keeps_one_transport():
+    book = ScenarioBook([scenario(0, 'equals', 'x', transport='tcp'), scenario(1, 'equals', 'x', transport='udp')])
+    assert book.matcher('tcp').match('MSG', msg("x")).name == 's0'
+    assert book.matcher('udp').match('MSG', msg("x")).name == 's1'
+
+
+def test_shipped_scenarios_load():
+    book = scenarios.default_scenarios()
+    assert book.matcher('udp').match('MSG', msg("a malformed one")).name == 'malformed'
+    assert book.matcher('tcp').match('MSG', msg("Hi")).name == 'hi'
+
+
+def test_automaton_agrees_with_linear_scan():
+    rng = random.Random(25)
+    alphabet = 'abc'
+    patterns = set()
+    while len(patterns) < scenarios.SCAN_THRESHOLD + 36: # Short patterns over 3 letters: many overlap
+        patterns.add(''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 6))))
+    patterns = sorted(patterns, key=lambda p: (rng.random(), p))
+    book = ScenarioBook([scenario(i, 'contains', p) for i, p in enumerate(patterns)])
+    matcher = Matcher(book.scenarios)
+    assert isinstance(matcher._rules['MSG'][0][4], _Automaton)
+    for _ in range(2000):
+        text = ''.join(rng.choice(alphabet + 'xyz') for _ in range(rng.randint(0, 20)))
+        assert matcher.match('MSG', msg(text)) == linear_scan(book, 'MSG', msg(text)), text
+
+
+def test_matcher_switches_at_scan_threshold():
+    below = Matcher([scenario(i, 'contains', f"p{i}") for i in range(scenarios.SCAN_THRESHOLD - 1)])
+    at = Matcher([scenario(i, 'contains', f"p{i}") for i in range(scenarios.SCAN_THRESHOLD)])
+    assert below._rules['MSG'][0][4] is None
+    assert isinstance(at._rules['MSG'][0][4], _Automaton)
+
+
+def test_scan_threshold_sits_between_the_crossover():
+    """Substring checks win at half SCAN_THRESHOLD, the automaton at twice it (no match, 72 characters)."""
+    text = "hello everyone, this is a fairly ordinary chat message without triggers."
+    def timings(count):
+        pairs = [(f"trigger{i:04d}x", scenario(i, 'contains', f"trigger{i:04d}x")) for i in range(count)]
+        return [min(timeit.repeat(lambda: index.search(text), number=200, repeat=5))
+                for index in (_Substrings(pairs), _Automaton(pairs))]
+    substrings, automaton = timings(scenarios.SCAN_THRESHOLD // 2)
+    assert substrings < automaton
+    substrings, automaton = timings(scenarios.SCAN_THRESHOLD * 2)
+    assert automaton < substrings
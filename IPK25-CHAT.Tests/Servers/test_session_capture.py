@@ -0,0 +1,83 @@
+import pytest
+
+from session_capture import (CLOSE, FILE_HEADER, IN, MAGIC, OPEN, OUT, RECORD, TCP, UDP, VERSION, Record,
+                             SessionCapture, lines, read_capture)
+
+
+def encode(records):
+    return FILE_HEADER.pack(MAGIC, VERSION) + b''.join(
+        RECORD.pack(r.time_ns, r.session, r.transport, r.event, len(r.data)) + r.data for r in records)
+
+RECORDS = [
+    Record(1_000, (1234 << 32) | 1, TCP, OPEN, b"127.0.0.1:40000"),
+    Record(2_000, (1234 << 32) | 1, TCP, IN, b"AUTH u AS a USING p\r\n"),
+    Record(3_000, (1234 << 32) | 2, UDP, OUT, b"\x01\x00\x01\x01\x00\x00ok\x00"),
+    Record(4_000, (1234 << 32) | 1, TCP, CLOSE, b""),
+]
+
+
+def test_record_header_is_22_bytes():
+    assert RECORD.size == 22
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "run.cap"
+    path.write_bytes(encode(RECORDS))
+    assert list(read_capture(path)) == RECORDS
+
+
+def test_truncated_tail_is_dropped(tmp_path):
+    data = encode(RECORDS)
+    path = tmp_path / "run.cap"
+    path.write_bytes(data[:-1]) # CLOSE header cut short
+    assert list(read_capture(path)) == RECORDS[:3]
+    path.write_bytes(data[:-(RECORD.size + 3)]) # UDP record's data cut short
+    assert list(read_capture(path)) == RECORDS[:2]
+
+
+def test_foreign_file_is_rejected(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"not a capture at all")
+    with pytest.raises(ValueError):
+        list(read_capture(path))
+    path.write_bytes(FILE_HEADER.pack(MAGIC, VERSION + 1))
+    with pytest.raises(ValueError):
+        list(read_capture(path))
+
+
+def test_capture_writes_readable_file(tmp_path):
+    path = tmp_path / "run.cap"
+    capture = SessionCapture()
+    capture.open(str(path))
+    session = capture.open_session(TCP, ('127.0.0.1', 40000))
+    capture.record(session, TCP, IN, memoryview(b"MSG FROM a IS x\r\n"))
+    capture.record(session, TCP, CLOSE)
+    capture.close()
+    capture.open(str(path)) # Appends; no second file header
+    capture.record(session, TCP, OUT, b"BYE FROM Server\r\n")
+    capture.close()
+    records = list(read_capture(path))
+    assert [(r.session, r.event, r.data) for r in records] == [
+        (session, OPEN, b"127.0.0.1:40000"),
+        (session, IN, b"MSG FROM a IS x\r\n"),
+        (session, CLOSE, b""),
+        (session, OUT, b"BYE FROM Server\r\n"),
+    ]
+    assert records == sorted(records, key=lambda r: r.time_ns)
+
+
+def test_reopen_closes_previous_file(tmp_path):
+    first, second = tmp_path / "a.cap", tmp_path / "b.cap"
+    capture = SessionCapture()
+    capture.open(str(first))
+    session = capture.open_session(TCP, ('127.0.0.1', 40000))
+    capture.open(str(second)) # Flushes and closes a.cap
+    capture.record(session, TCP, CLOSE)
+    capture.close()
+    assert [r.event for r in read_capture(first)] == [OPEN]
+    assert [r.event for r in read_capture(second)] == [CLOSE]
+
+
+def test_lines_splits_tcp_data():
+    assert lines(b"A\r\nB\r\nC") == [b"A\r\n", b"B\r\n", b"C"]
+    assert lines(b"A\r\n") == [b"A\r\n"]
@@ -0,0 +1,74 @@
+import random
+
+from tcp_grammar import Auth, Bye, Err, Join, Malformed, Msg, Reply, Unknown, parse_grammar, parse_line
+
+
+def test_canonical_lines():
+    assert parse_line("AUTH user AS Dn USING s3cr3t") == Auth('user', 'Dn', 's3cr3t')
+    assert parse_line("JOIN discord.general AS Dn") == Join('discord.general', 'Dn')
+    assert parse_line("MSG FROM Dn IS hello") == Msg('Dn', 'hello')
+    assert parse_line("ERR FROM Dn IS oops") == Err('Dn', 'oops')
+    assert parse_line("BYE FROM Dn") == Bye('Dn')
+    assert parse_line("REPLY OK IS Welcome") == Reply(True, 'Welcome')
+    assert parse_line("REPLY NOK IS Denied") == Reply(False, 'Denied')
+
+
+def test_keywords_are_case_insensitive():
+    assert parse_line("auth user as Dn using s") == Auth('user', 'Dn', 's')
+    assert parse_line("Join ch As Dn") == Join('ch', 'Dn')
+    assert parse_line("msg from Dn is Hi") == Msg('Dn', 'Hi')
+    assert parse_line("bye From Dn") == Bye('Dn')
+    assert parse_line("reply ok is fine") == Reply(True, 'fine')
+    assert parse_line("Reply Nok Is no") == Reply(False, 'no')
+
+
+def test_any_whitespace_separates_fields():
+    assert parse_line("MSG  FROM\tDn   IS  hello") == Msg('Dn', 'hello')
+    assert parse_line("AUTH  user\tAS Dn  USING s") == Auth('user', 'Dn', 's')
+    assert parse_line("JOIN ch AS Dn ") == Join('ch', 'Dn')
+
+
+def test_content_keeps_inner_spaces():
+    assert parse_line("MSG FROM Dn IS a  b IS c ") == Msg('Dn', 'a  b IS c ')
+    assert parse_line("REPLY OK IS  spaced  out") == Reply(True, 'spaced  out')
+
+
+def test_malformed_known_keywords():
+    assert parse_line("MSG FROM Dn IS") == Malformed('MSG', "MSG FROM Dn IS")
+    assert parse_line("MSG FROM Dn IS   ") == Malformed('MSG', "MSG FROM Dn IS   ")
+    assert parse_line("err from Dn") == Malformed('ERR', "err from Dn")
+    assert parse_line("AUTH user AS Dn") == Malformed('AUTH', "AUTH user AS Dn")
+    assert parse_line("JOIN ch AS Dn extra") == Malformed('JOIN', "JOIN ch AS Dn extra")
+    assert parse_line("BYE Dn") == Malformed('BYE', "BYE Dn")
+    assert parse_line("REPLY MAYBE IS x") == Malformed('REPLY', "REPLY MAYBE IS x")
+
+
+def test_unknown_keywords():
+    assert parse_line("HELLO there") == Unknown("HELLO there")
+    assert parse_line("MSGFROM Dn IS x") == Unknown("MSGFROM Dn IS x")
+    assert parse_line(" MSG FROM Dn IS x") == Unknown(" MSG FROM Dn IS x")
+    assert parse_line("") == Unknown("")
+
+
+def test_fast_path_agrees_with_grammar():
+    rng = random.Random(7)
+    shapes = [
+        ["AUTH", "u", "AS", "Dn", "USING", "s"],
+        ["JOIN", "ch", "AS", "Dn"],
+        ["MSG", "FROM", "Dn", "IS", "hi", "there"],
+        ["ERR", "FROM", "Dn", "IS", "x"],
+        ["BYE", "FROM", "Dn"],
+        ["REPLY", "OK", "IS", "y"],
+    ]
+    for _ in range(3000):
+        words = list(rng.choice(shapes))
+        if rng.random() < 0.3:
+            del words[rng.randrange(len(words))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words) + 1), "IS")
+        words = [w.lower() if rng.random() < 0.1 else w for w in words]
+        line = ''.join(w + rng.choice([' ', ' ', ' ', '  ', '\t']) for w in words)
+        if rng.random() < 0.7:
+            line = line.rstrip()
+        fast, slow = parse_line(line), parse_grammar(line)
+        assert (type(fast), fast) == (type(slow), slow), repr(line)
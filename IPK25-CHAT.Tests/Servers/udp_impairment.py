@@ -0,0 +1,138 @@
+"""
+========================================
+ IPK25 UDP network impairment
+========================================
+
+A seeded, reproducible lossy network between the UDP server's sockets and
+its protocol logic, for testing client retransmission (UdpFsm) without
+netem or root rights.
+
+Each datagram, in either direction, can be dropped, duplicated, held back
+so that later datagrams overtake it (reorder), and delayed by a latency
+drawn from a distribution:
+
+  constant     every datagram waits --delay
+  uniform      --delay +/- --jitter
+  normal       Gaussian around --delay with standard deviation --jitter
+  exponential  --delay plus an exponential tail with mean --jitter
+
+Decisions come from one random.Random per direction, seeded from --impair-seed
+(a random seed is picked and logged if none is given). Replaying the same
+client traffic therefore makes the same decisions. The two directions use
+separate streams, so the number of datagrams in one direction does not
+change what happens to the other.
+
+The server pays nothing when every option is 0. Otherwise a datagram costs
+a few random() calls, plus one timer-heap push for each delayed copy.
+Drops, duplicates and reorders are counted as impair_* events
+(ipk25_events_total).
+"""
+
+import random
+
+from server_log import LOG
+from server_metrics import METRICS
+
+DISTRIBUTIONS = ('constant', 'uniform', 'normal', 'exponential')
+REORDER_GAP = 0.02 # Seconds a reordered datagram is held back beyond its latency
+DUPLICATE_GAP = 0.001 # Seconds between a datagram and its duplicate
+
+_PASS = (0.0,)
+_DROP = ()
+
+
+class Impairment:
+    """
+    Decides the fate of each datagram. inbound()/outbound() return the delays
+    in seconds after which copies of it are delivered: () drops it, (0.0,)
+    lets it through untouched and two entries duplicate it.
+    """
+
+    def __init__(self, loss=0.0, duplicate=0.0, reorder=0.0, delay=0.0, jitter=0.0,
+                 distribution='uniform', seed=None, direction='both'):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"unknown delay distribution {distribution!r}")
+        self.loss = loss # Probabilities, 0..1
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.delay = delay # Seconds
+        self.jitter = jitter
+        self.distribution = distribution if jitter else 'constant'
+        self.seed = random.randrange(1 << 32) if seed is None else seed
+        self.rng_in = random.Random(f"{self.seed}/in")
+        self.rng_out = random.Random(f"{self.seed}/out")
+        self.impair_in = direction in ('in', 'both')
+        self.impair_out = direction in ('out', 'both')
+
+    def reseed(self, stream):
+        """Switches to separate, still reproducible streams, e.g. one per worker process."""
+        self.rng_in = random.Random(f"{self.seed}/{stream}/in")
+        self.rng_out = random.Random(f"{self.seed}/{stream}/out")
+
+    def inbound(self):
+        return self._plan(self.rng_in) if self.impair_in else _PASS
+
+    def outbound(self):
+        return self._plan(self.rng_out) if self.impair_out else _PASS
+
+    def _plan(self, rng):
+        r = rng.random
+        if self.loss and r() < self.loss:
+            METRICS.event('udp', 'impair_drop')
+            return _DROP
+        delay = self._latency(rng) if self.delay or self.jitter else 0.0
+        if self.reorder and r() < self.reorder:
+            METRICS.event('udp', 'impair_reorder')
+            delay += REORDER_GAP
+        if self.duplicate and r() < self.duplicate:
+            METRICS.event('udp', 'impair_duplicate')
+            return (delay, delay + DUPLICATE_GAP)
+        return (delay,) if delay else _PASS
+
+    def _latency(self, rng):
+        dist = self.distribution
+        if dist == 'constant':
+            return self.delay
+        if dist == 'uniform':
+            value = rng.uniform(self.delay - self.jitter, self.delay + self.jitter)
+        elif dist == 'normal':
+            value = rng.gauss(self.delay, self.jitter)
+        else:
+            value = self.delay + rng.expovariate(1 / self.jitter)
+        return value if value > 0.0 else 0.0
+
+    def describe(self):
+        return (f"loss {self.loss:.1%}, duplicate {self.duplicate:.1%}, reorder {self.reorder:.1%}, "
+                f"delay {self.delay * 1000:g} ms {self.distribution} jitter {self.jitter * 1000:g} ms, "
+                f"direction {'both' if self.impair_in and self.impair_out else 'in' if self.impair_in else 'out'}, "
+                f"seed {self.seed}")
+
+
+def add_impairment_arguments(parser):
+    group = parser.add_argument_group("network impairment (all off by default)")
+    group.add_argument('--loss', type=float, default=0.0, metavar='PCT',
+                       help="drop PCT%% of datagrams")
+    group.add_argument('--duplicate', type=float, default=0.0, metavar='PCT',
+                       help="deliver PCT%% of datagrams twice")
+    group.add_argument('--reorder', type=float, default=0.0, metavar='PCT',
+                       help=f"hold PCT%% of datagrams back {REORDER_GAP * 1000:g} ms so later ones overtake them")
+    group.add_argument('--delay', type=float, default=0.0, metavar='MS',
+                       help="base one-way latency in ms")
+    group.add_argument('--jitter', type=float, default=0.0, metavar='MS',
+                       help="latency spread in ms, shaped by --delay-distribution")
+    group.add_argument('--delay-distribution', choices=DISTRIBUTIONS, default='uniform',
+                       help="latency distribution when --jitter is set (default uniform)")
+    group.add_argument('--impair-direction', choices=('in', 'out', 'both'), default='both',
+                       help="impair datagrams from clients, to clients or both (default both)")
+    group.add_argument('--impair-seed', type=int, default=None, metavar='N',
+                       help="seed for reproducible runs (default: random, logged at startup)")
+
+def impairment_from_args(args):
+    """Impairment configured on the command line, or None when everything is off."""
+    if not (args.loss or args.duplicate or args.reorder or args.delay or args.jitter):
+        return None
+    impairment = Impairment(args.loss / 100, args.duplicate / 100, args.reorder / 100,
+                            args.delay / 1000, args.jitter / 1000, args.delay_distribution,
+                            args.impair_seed, args.impair_direction)
+    LOG.info("[~] Network impairment: %s", impairment.describe())
+    return impairment
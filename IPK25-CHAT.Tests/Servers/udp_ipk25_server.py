@@ -1,11 +1,28 @@
+import collections
+import functools
+import os
+import selectors
 import socket
 import struct
-import threading
 import time
 import random
 import signal
+import argparse
 import sys
 
+from channel_registry import DEFAULT_CHANNEL
+from protocol_core import AUTH_WAIT, END, ProtocolState, compile_table
+from scenarios import STANDARD, add_scenario_arguments, default_scenarios, scenarios_from_args
+from scheduler import IdleReaper, TimerHeap
+from server_log import LOG, DEBUG, INFO, WARNING, ERROR, add_log_arguments, configure_from_args
+from server_metrics import METRICS, add_metrics_arguments, start_http_server
+from server_util import raise_fd_limit
+from session_capture import CAPTURE, CLOSE, IN, OUT, UDP, add_capture_arguments, capture_from_args
+from udp_impairment import add_impairment_arguments, impairment_from_args
+from udp_wire import (HEADER, REPLY_HEADER, TYPE_AUTH, TYPE_BYE, TYPE_CONFIRM, TYPE_ERR, TYPE_JOIN, TYPE_MSG,
+                      TYPE_NAMES, TYPE_PING, TYPE_REPLY, Unknown, parse_datagram)
+from wire_bridge import datagram_body, text_line
+
 """
 ========================================
  IPK25 Mock UDP Server (Python) - Command Triggered Tests
@@ -20,17 +37,42 @@ scenarios by sending specially crafted commands/messages from the client.
 How it works:
 1. Server listens on the default port (4567) ONLY for AUTH messages.
 2. Upon receiving AUTH, it sends CONFIRM from the listener port.
-3. It then allocates a new dynamic port for the client.
-4. A new thread is started to handle all further communication with
-   that client exclusively on the new dynamic port.
-5. The handler thread sends the AUTH REPLY from the dynamic port.
+3. It then takes a dynamic-port socket for the client from a pool of
+   pre-bound sockets, unless the session limit or the AUTH rate limit is
+   reached; then the listener answers REPLY NOK. A retransmitted AUTH from
+   a client that already has a session is only CONFIRMed again.
+4. The new socket joins the listener on one selector (epoll) loop, and
+   the client's state lives in a UdpSession in the server's session
+   table; no thread is started per client.
+5. The session sends the AUTH REPLY from the dynamic port.
 6. All subsequent messages (JOIN, MSG, BYE from client; MSG, REPLY,
    ERR, BYE from server) between that client and server use the
    dynamic port.
+7. Optionally (--loss, --duplicate, --reorder, --delay, --jitter) a seeded
+   impairment stage between the sockets and the sessions drops, duplicates,
+   reorders and delays datagrams in both directions; see udp_impairment.
+8. With --workers N, N forked processes each run this loop on their own
+   SO_REUSEPORT listener. The kernel picks the listener by hashing the
+   client address, so a client's AUTH and its retransmissions reach the same
+   worker, and the session and dynamic port it gets live in that worker.
+9. With --ping-interval S, every authenticated session gets a PING each S
+   seconds. One timer walks a wheel of session slots, so the PINGs are
+   spread evenly over the interval instead of sent in bursts.
+10. A client silent for --idle-timeout seconds (default 60) gets a BYE
+    from the server (ERR if it never authenticated), and the session ends
+    once that is confirmed or its retransmissions run out.
+11. ipk25_server.py runs this server and the TCP server on one asyncio
+    loop. There the sessions join the same channels as TCP clients, and a
+    MSG goes to the channel instead of getting the "Got your MSG" echo.
+12. With --capture FILE, every datagram of every session is appended to
+    FILE (session_capture); ipk25_replay.py replays such a file.
 
 ----------------------------------------
 How to Run Tests:
 
+The scenarios below are declared in scenarios.json, which the TCP server
+shares; `--scenarios FILE` loads a different JSON or TOML file (scenarios.py).
+
 AUTH Scenarios (Send via /auth command):
   Use specific keywords in the <username> field:
   → /auth failauth <secret> <DisplayName>
@@ -54,6 +96,7 @@ MSG Scenarios (Send as message content after successful AUTH/JOIN):
   Include specific keywords in the message content:
   → (message containing 'noconfirm')
     Server receives MSG but does *not* send CONFIRM back (client should retransmit).
+    The retransmission is recognised as a duplicate: CONFIRMed, not answered again.
   → (message containing 'duplicatemsg')
     Server sends its standard reply MSG ("Got your MSG...") *twice* (client should ignore second, CONFIRM both).
   → (message containing 'servererr')
@@ -66,6 +109,10 @@ MSG Scenarios (Send as message content after successful AUTH/JOIN):
 Normal Operation:
   Any other valid AUTH, JOIN, MSG, BYE from the client will be handled normally
   according to the basic IPK25 protocol flow.
+  The state machine is the TCP server's (protocol_core): a message the
+  session's state does not allow (a second AUTH, MSG while a JOIN is
+  unanswered, REPLY, an unknown type) is CONFIRMed, answered with ERR, and
+  the session ends. So does an ERR from the client.
 ----------------------------------------
 """
 
@@ -73,29 +120,47 @@ Normal Operation:
 # --- Protocol Constants (same as before) ---
 DEFAULT_PORT = 4567
 BUFFER_SIZE = 8192
-TYPE_CONFIRM = 0x00
-TYPE_REPLY = 0x01
-TYPE_AUTH = 0x02
-TYPE_JOIN = 0x03
-TYPE_MSG = 0x04
-TYPE_PING = 0xFD
-TYPE_ERR = 0xFE
-TYPE_BYE = 0xFF
-TYPE_UNKNOWN = 0x10
 
 # --- Helper Functions (same as before) ---
-def print_log(thread_name, message): print(f"[{thread_name}] {message}")
+def print_log(thread_name, message, level=INFO): LOG.log(level, "[%s] %s", thread_name, message)
 def read_ushort_be(data, offset):
     if offset + 2 > len(data): raise ValueError("Not enough data for ushort")
     return struct.unpack_from('>H', data, offset)[0]
-def read_string(data, offset):
-    end_offset = data.find(b'\x00', offset)
-    if end_offset == -1: raise ValueError("Null terminator not found")
-    value = data[offset:end_offset].decode('ascii')
-    new_offset = end_offset + 1
-    return value, new_offset
 
 
+def send_packet(sock, data, addr):
+    """sendto() that also feeds the outbound counters."""
+    sock.sendto(data, addr)
+    METRICS.message('udp', 'out', TYPE_NAMES.get(data[0], 'UNKNOWN'))
+    METRICS.add_bytes('udp', 'out', len(data))
+
+class DatagramQueue:
+    """
+    Outbound datagrams of one socket. The event loop sends every queued
+    datagram in one pass after it has handled a batch of readiness events.
+    If the socket buffer fills, the rest waits for EVENT_WRITE.
+    """
+    __slots__ = ('sock', 'items', 'key_data')
+
+    def __init__(self, sock, key_data):
+        self.sock = sock
+        self.items = collections.deque() # (data, addr)
+        self.key_data = key_data # Selector data of the socket, kept when toggling EVENT_WRITE
+
+    def flush(self):
+        """Sends queued datagrams in order. Returns False if the socket would block."""
+        items, sock = self.items, self.sock
+        while items:
+            data, addr = items[0]
+            try:
+                send_packet(sock, data, addr)
+            except (BlockingIOError, InterruptedError):
+                return False
+            except OSError as e:
+                LOG.warning("[!] Dropped datagram to %s: %s", addr, e)
+            items.popleft()
+        return True
+
 def build_confirm(ref_msg_id):
     """
     Builds the 3-byte UDP CONFIRM message payload.
@@ -108,7 +173,7 @@ def build_confirm(ref_msg_id):
         # Pack TYPE_CONFIRM and ref_msg_id directly together
         return struct.pack('>BH', TYPE_CONFIRM, ref_msg_id)
     except struct.error as e:
-        print(f"[ERROR] Failed to pack CONFIRM message: {e}")
+        LOG.error(f"[ERROR] Failed to pack CONFIRM message: {e}")
         # Return an empty byte string or handle error appropriately
         return b''
 
@@ -134,307 +199,1012 @@ def build_bye(msg_id, display_name):
     header = struct.pack('>BH', TYPE_BYE, msg_id)
     return header + dname_bytes
 
-# --- Client Handler Thread with Command-Based Triggers ---
-def client_handler(handler_sock, client_addr, initial_data, initial_msg_id):
-    """Handles communication, reacting to special client commands/content."""
-    thread_name = f"Handler-{client_addr[0]}:{client_addr[1]}"
-    print_log(thread_name, f"Started on dynamic port {handler_sock.getsockname()[1]}")
+# --- Packet templates for the messages the server sends all the time ---
+_pack_header = HEADER.pack
+_pack_reply_header = REPLY_HEADER.pack
+
+class PacketTemplate:
+    """
+    Server message whose fixed text ("Server\0", reply texts, NULs) is encoded
+    once. The variable parts are ASCII bytes filled in with bytes %-formatting,
+    so a packet costs a header pack and one concatenation instead of an
+    encode and a copy per field.
+    """
+    __slots__ = ('msg_type', 'body')
 
-    server_msg_id_counter = 0
-    client_state = {'display_name': None}
-    authenticated = False
+    def __init__(self, msg_type, body):
+        self.msg_type = msg_type
+        self.body = body.encode('ascii') # %b marks a variable part
 
-    try:
-        # --- Initial AUTH processing ---
-        parsed_auth = parse_message(initial_data, client_addr, "InitialAUTH")
-        if parsed_auth and parsed_auth['type'] == TYPE_AUTH:
-            username_lower = parsed_auth.get('username', '').lower()
-            secret_lower = parsed_auth.get('secret', '').lower() # Assuming secret might trigger tests too
-            client_state['display_name'] = parsed_auth.get('display_name', 'Unknown')
-            print_log(thread_name, f"AUTH received for user '{parsed_auth.get('username','')}', display name '{client_state['display_name']}'")
-
-            # --- AUTH Test Triggers based on Username/Secret ---
-            reply_success = True
-            reply_content = "Authentication successful."
-            simulate_timeout = False
-            simulate_delay_sec = 0
-
-            if "failauth" in username_lower:
-                print_log(thread_name, "*** Simulating AUTH REPLY NOK triggered by username ***")
-                reply_success = False
-                reply_content = "Auth failed (username trigger)."
-            elif "timeoutauth" in username_lower:
-                print_log(thread_name, "*** Simulating AUTH REPLY Timeout triggered by username ***")
-                simulate_timeout = True
-            elif "delayauth" in username_lower:
-                 print_log(thread_name, "*** Simulating AUTH REPLY Delay (6s) triggered by username ***")
-                 simulate_delay_sec = 6
-            elif username_lower == "nerd":
-                 print_log(thread_name, "*** Simulating AUTH REPLY NOK triggered by username 'nerd' ***")
-                 reply_success = False
-                 reply_content = "Nerds are not allowed here!" # Môžeš dať inú správu ako v TCP
-            # Add more triggers based on secret if needed, e.g.
-            # elif "badsecret" in secret_lower: reply_success = False; reply_content = "Invalid secret trigger."
-
-            if simulate_timeout:
-                # Just don't send the reply
-                pass
+    def build(self, msg_id, *values):
+        return _pack_header(self.msg_type, msg_id) + self.body % values
+
+class ReplyTemplate(PacketTemplate):
+    """REPLY variant: the result byte is fixed, build() also takes the Ref_MessageID."""
+    __slots__ = ('result',)
+
+    def __init__(self, success, body):
+        super().__init__(TYPE_REPLY, body)
+        self.result = 0x01 if success else 0x00
+
+    def build(self, msg_id, ref_msg_id, *values):
+        return _pack_reply_header(TYPE_REPLY, msg_id, self.result, ref_msg_id) + self.body % values
+
+AUTH_OK = ReplyTemplate(True, "Authentication successful.\0")
+SERVER_BUSY = ReplyTemplate(False, "Server busy, try again later.\0")
+JOIN_OK = ReplyTemplate(True, "Join to '%b' successful.\0")
+JOINED_DEFAULT = PacketTemplate(TYPE_MSG, "Server\0%b has joined default.\0")
+JOINED = PacketTemplate(TYPE_MSG, "Server\0%b has joined %b\0")
+GOT_MSG = PacketTemplate(TYPE_MSG, "Server\0Got your MSG: '%b...'\0")
+IDLE_ERR = PacketTemplate(TYPE_ERR, "Server\0Session idle for too long.\0")
+SERVER_BYE = PacketTemplate(TYPE_BYE, "Server\0")
+PING = PacketTemplate(TYPE_PING, "")
+
+# --- Per-client session with Command-Based Triggers ---
+IDLE_TIMEOUT = 60 # Seconds without a datagram from the client before the server ends its session
+RECV_BATCH = 64 # Datagrams read from one socket per readiness event, so busy clients cannot starve others
+PORT_POOL = 64 # Idle dynamic-port sockets kept bound for the next sessions
+MAX_SESSIONS = 10000 # Dynamic-port sockets (= sessions) open at once
+AUTH_RATE = 0 # New sessions per second, 0 = unlimited
+PING_INTERVAL = 0 # Seconds between keepalive PINGs to a session, 0 = no PINGs
+KEEPALIVE_SLOTS = 100 # Ticks per PING interval; each tick PINGs one slot's sessions
+CONFIRM_TIMEOUT = 0.25 # Seconds before an unconfirmed server message is sent again (client default: -d 250)
+RETRANSMISSIONS = 3 # Resends before the session is given up (client default: -r 3)
+UNRELIABLE_KINDS = frozenset({'MALFORMED', 'RAW'}) # Scenario datagrams sent once; clients do not CONFIRM them
+
+class MessageIdWindow:
+    """
+    Client MessageIDs a session has already handled: the highest ID plus a
+    bitmask of the WINDOW IDs below it, compared in 16-bit serial arithmetic
+    so wrap-around at 0xFFFF works. Check-and-insert is O(1) and the state
+    is two small ints. IDs older than the window count as duplicates.
+    """
+    __slots__ = ('highest', 'mask')
+    WINDOW = 64
+
+    def __init__(self):
+        self.highest = None
+        self.mask = 0 # Bit n set: highest - n was seen
+
+    def check_and_add(self, msg_id):
+        """Records msg_id; returns True if it was already seen (a duplicate)."""
+        if self.highest is None:
+            self.highest, self.mask = msg_id, 1
+            return False
+        ahead = (msg_id - self.highest) & 0xFFFF
+        if 0 < ahead < 0x8000: # Newer: slide the window forward
+            self.mask = ((self.mask << ahead) | 1) & ((1 << self.WINDOW) - 1) if ahead < self.WINDOW else 1
+            self.highest = msg_id
+            return False
+        behind = (self.highest - msg_id) & 0xFFFF
+        if behind >= self.WINDOW:
+            return True # Too old to tell apart; a late retransmission
+        bit = 1 << behind
+        if self.mask & bit:
+            return True
+        self.mask |= bit
+        return False
+
+class Outstanding:
+    """A server message waiting for its CONFIRM."""
+    __slots__ = ('data', 'attempts', 'timer')
+
+    def __init__(self, data, timer):
+        self.data = data
+        self.attempts = 0
+        self.timer = timer
+
+class KeepaliveWheel:
+    """
+    PINGs every session once per interval from one repeating timer. Sessions
+    are dealt round-robin into KEEPALIVE_SLOTS slots, and each tick (interval
+    / slots) PINGs one slot. 20k sessions then cost a single heap entry and a
+    steady trickle of PINGs, not 20k timers or one burst per interval.
+    """
+
+    def __init__(self, timers, interval, slots=KEEPALIVE_SLOTS):
+        self.timers = timers
+        self.interval = interval
+        self.slots = [set() for _ in range(slots)]
+        self._next_slot = 0 # Where the next session goes
+        self._cursor = 0 # Slot PINGed on the next tick
+        self._tick_at = timers.clock() + interval / slots
+        self._timer = timers.call_at(self._tick_at, self._tick) if interval else None
+
+    def add(self, session):
+        if self._timer is None: return
+        session.keepalive_slot = self._next_slot
+        self.slots[self._next_slot].add(session)
+        self._next_slot = (self._next_slot + 1) % len(self.slots)
+
+    def remove(self, session):
+        if session.keepalive_slot is not None:
+            self.slots[session.keepalive_slot].discard(session)
+            session.keepalive_slot = None
+
+    def _tick(self):
+        slot = self.slots[self._cursor]
+        self._cursor = (self._cursor + 1) % len(self.slots)
+        for session in list(slot): # ping() may close the session, which removes it
+            session.ping()
+        self._tick_at += self.interval / len(self.slots) # Deadlines from the schedule, not from now: no drift
+        self._timer = self.timers.call_at(self._tick_at, self._tick)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+
+class UdpSession:
+    """
+    Protocol state of one client, served on its dynamic port by the event loop.
+    Scenario pauses are delayed sends on the server's timer heap: later sends
+    queue behind them, so the order on the wire matches the old sleeping handler.
+    Every server message except CONFIRM is resent from the same heap until the
+    client CONFIRMs it, like UdpFsm does on the client side.
+    """
+
+    def __init__(self, server, handler_sock, client_addr):
+        self.server = server
+        self.sock = handler_sock
+        self.client_addr = client_addr
+        self.initial_msg_id = None # MessageID of the AUTH that opened the session
+        self.name = f"Handler-{client_addr[0]}:{client_addr[1]}"
+        self.display_name = None
+        self.display_name_raw = b'' # As received, for the join notices
+        self.fsm = ProtocolState(self._TABLE) # protocol_core state machine; the _on_* methods are its actions
+        self.server_msg_id_counter = 0
+        self.seen_msg_ids = MessageIdWindow() # Client retransmissions are re-CONFIRMed, not handled again
+        self.duplicates = 0
+        self.outq = DatagramQueue(handler_sock, self)
+        self.unconfirmed = {} # Server MessageID -> Outstanding
+        self.closed = False
+        self._delayed = collections.deque() # (send_time, data, reliable, on_sent), send_time ascending
+        self._delay_timer = None
+        self.idle = server.idle_reaper.add(self.expire)
+        self.keepalive_slot = None
+        self.ping_msg_id = None # Last PING sent; skipped while it is still unconfirmed
+        self.capture_id = CAPTURE.open_session(UDP, client_addr) if CAPTURE.enabled else None
+        server.keepalive.add(self)
+        METRICS.session_opened('udp')
+        print_log(self.name, f"Started on dynamic port {handler_sock.getsockname()[1]}")
+
+    @property
+    def ending(self):
+        """END_REQUESTED: only CONFIRMs are processed; closes once everything sent was confirmed."""
+        return self.fsm.state == END
+
+    def next_msg_id(self):
+        self.server_msg_id_counter += 1
+        return self.server_msg_id_counter
+
+    # --- Outbound ---
+    def send(self, data, delay=0, reliable=True, on_sent=None):
+        """Sends now, or delay seconds after the previously delayed send.
+
+        reliable=False sends once without waiting for a CONFIRM, for datagrams
+        a conforming client does not CONFIRM (malformed and raw test data).
+        on_sent runs right after the datagram goes out.
+        """
+        if not delay and not self._delayed:
+            self._transmit(data, reliable)
+            if on_sent is not None: on_sent()
+            return
+        timers = self.server.timers
+        base = self._delayed[-1][0] if self._delayed else timers.clock()
+        self._delayed.append((base + delay, data, reliable, on_sent))
+        if self._delay_timer is None:
+            self._delay_timer = timers.call_at(base + delay, self._release)
+
+    def _release(self):
+        """Timer callback: sends every delayed datagram that is due."""
+        self._delay_timer = None
+        if self.closed: return
+        now = self.server.timers.clock()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, data, reliable, on_sent = self._delayed.popleft()
+            self._transmit(data, reliable)
+            if on_sent is not None: on_sent()
+        if self._delayed:
+            self._delay_timer = self.server.timers.call_at(self._delayed[0][0], self._release)
+        elif self.ending:
+            self._close_if_done()
+
+    # --- Reliable delivery ---
+    def _transmit(self, data, reliable=True):
+        """Queues a datagram; reliable ones but CONFIRM stay tracked until the client CONFIRMs them."""
+        self.server.queue(self.outq, data, self.client_addr)
+        if self.capture_id is not None: CAPTURE.record(self.capture_id, UDP, OUT, data)
+        timeout = self.server.confirm_timeout
+        if not reliable or data[0] == TYPE_CONFIRM or not timeout: return
+        msg_id = (data[1] << 8) | data[2]
+        if msg_id not in self.unconfirmed: # A scenario duplicate rides on the first copy's timer
+            self.unconfirmed[msg_id] = Outstanding(data, self.server.timers.call_later(timeout, self._retransmit, msg_id))
+
+    def _retransmit(self, msg_id):
+        """Timer callback: resends an unconfirmed message, or gives the session up."""
+        entry = self.unconfirmed.get(msg_id)
+        if entry is None or self.closed: return
+        if entry.attempts >= self.server.retransmissions:
+            del self.unconfirmed[msg_id]
+            METRICS.event('udp', 'delivery_failed')
+            if entry.data[0] == TYPE_PING: METRICS.event('udp', 'ping_failed')
+            print_log(self.name, f"ServerMsgID={msg_id} not confirmed after {entry.attempts} retransmission(s). Closing.", WARNING)
+            self.close()
+            return
+        entry.attempts += 1
+        METRICS.event('udp', 'server_retransmit')
+        LOG.debug("[%s] Retransmitting ServerMsgID=%d (attempt %d)", self.name, msg_id, entry.attempts)
+        self.server.queue(self.outq, entry.data, self.client_addr)
+        if self.capture_id is not None: CAPTURE.record(self.capture_id, UDP, OUT, entry.data)
+        entry.timer = self.server.timers.call_later(self.server.confirm_timeout, self._retransmit, msg_id)
+
+    def _confirmed(self, ref_msg_id):
+        entry = self.unconfirmed.pop(ref_msg_id, None)
+        if entry is None: return # Late or duplicate CONFIRM
+        entry.timer.cancel()
+        if entry.data[0] == TYPE_PING: METRICS.event('udp', 'ping_confirmed')
+        if self.ending: self._close_if_done()
+
+    # --- Lifecycle ---
+    def end(self):
+        """Stops processing input except CONFIRMs; closes once everything sent was confirmed."""
+        self.fsm.enter(END)
+        self._close_if_done()
+
+    def _close_if_done(self):
+        if not self._delayed and not self.unconfirmed:
+            self.close()
+
+    # --- Channels (only when the server shares a ChannelRegistry with other transports) ---
+    def deliver(self, data, log_prefix=None):
+        """Channel member entry point: a text MSG line from the registry, sent as a binary MSG."""
+        if self.ending: return
+        body = datagram_body(data)
+        if body is None:
+            LOG.debug("[%s] Dropped broadcast UDP cannot carry: %r", self.name, data)
+            return
+        self.send(_pack_header(TYPE_MSG, self.next_msg_id()) + body)
+
+    def _announce(self, channel, text):
+        """Sends a Server notice to everyone in channel except this client."""
+        self.server.channels.broadcast(channel, f"MSG FROM Server IS {text}\r\n".encode(), exclude=self)
+
+    def _enter_channel(self, channel):
+        previous = self.server.channels.join(self, channel)
+        if previous is not None and previous != channel:
+            self._announce(previous, f"{self.display_name} left {previous}.")
+        self._announce(channel, f"{self.display_name} joined {channel}.")
+
+    def ping(self):
+        """Keepalive tick. The PING is retransmitted until CONFIRMed; giving up ends the session like any lost message."""
+        if not self.fsm.authenticated: return # Not yet, or ending
+        if self.ping_msg_id in self.unconfirmed: return # The previous PING is still being retransmitted
+        self.ping_msg_id = msg_id = self.next_msg_id()
+        self.send(PING.build(msg_id))
+        METRICS.event('udp', 'ping_sent')
+        LOG.debug("[%s] Sent PING (ID=%d)", self.name, msg_id)
+
+    def expire(self):
+        """Idle-reaper callback: BYE once authenticated, ERR before; ends when that is confirmed."""
+        if self.closed: return
+        METRICS.event('udp', 'idle_expired')
+        print_log(self.name, f"Client idle for {self.server.idle_reaper.timeout:g}s. Ending session.")
+        if self.ending: self.close(); return # Already waiting for CONFIRMs that do not come
+        msg_id = self.next_msg_id()
+        self.send((SERVER_BYE if self.fsm.authenticated else IDLE_ERR).build(msg_id))
+        self.end()
+
+    def close(self):
+        if self.closed: return
+        self.closed = True
+        self.fsm.enter(END)
+        print_log(self.name, f"Closing handler socket ({self.duplicates} duplicate(s) received)." if self.duplicates else "Closing handler socket.")
+        if self._delay_timer is not None: self._delay_timer.cancel()
+        self.idle.cancel()
+        self.server.keepalive.remove(self)
+        channel = self.server.channels.leave(self) if self.server.channels is not None else None
+        if channel is not None: self._announce(channel, f"{self.display_name} left {channel}.")
+        self._delayed.clear()
+        for entry in self.unconfirmed.values(): entry.timer.cancel()
+        self.unconfirmed.clear()
+        self.outq.flush() # Last replies (BYE, ERR, CONFIRM) go out before the socket closes
+        self.outq.items.clear()
+        self.server.unregister(self) # The socket goes back to the port pool
+        if self.capture_id is not None: CAPTURE.record(self.capture_id, UDP, CLOSE)
+        METRICS.session_closed('udp')
+
+    def fail(self, e):
+        """Unexpected error while handling a datagram: try to send ERR, then close."""
+        print_log(self.name, f"Error in handler loop: {e}", ERROR)
+        try:
+            err_msg = build_err(self.next_msg_id(), "Server", f"Handler error: {type(e).__name__}")
+            self.server.queue(self.outq, err_msg, self.client_addr)
+            if self.capture_id is not None: CAPTURE.record(self.capture_id, UDP, OUT, err_msg)
+        except Exception: pass # Ignore error during error sending
+        self.close()
+
+    # --- Initial AUTH processing ---
+    def start(self, initial_data, initial_msg_id):
+        self.initial_msg_id = initial_msg_id
+        self.seen_msg_ids.check_and_add(initial_msg_id)
+        if self.capture_id is not None: CAPTURE.record(self.capture_id, UDP, IN, initial_data)
+        parsed_auth = parse_message(initial_data, self.client_addr, "InitialAUTH")
+        if not (parsed_auth and parsed_auth.type == TYPE_AUTH):
+            print_log(self.name, f"Initial message was not AUTH. Closing handler.")
+            self.close()
+            return
+        self.fsm.dispatch(self, 'AUTH', parsed_auth) # The listener has CONFIRMed it
+        if self.fsm.state == AUTH_WAIT and not self._delayed:
+            self.end() # No REPLY at all (timeoutauth); a REPLY NOK ends it in _auth_replied
+
+    # --- One datagram on the dynamic port ---
+    def handle(self, data, received_ns):
+        self.idle.touch()
+        METRICS.add_bytes('udp', 'in', len(data))
+        if self.capture_id is not None: CAPTURE.record(self.capture_id, UDP, IN, data)
+        LOG.debug("[%s] Received %d bytes", self.name, len(data))
+        parsed = parse_message(data, self.client_addr, self.name)
+        if not parsed: return
+
+        msg_type = parsed.type
+        kind = TYPE_NAMES.get(msg_type, 'UNKNOWN')
+        METRICS.message('udp', 'in', kind, self.fsm.state)
+        if msg_type == TYPE_CONFIRM:
+            LOG.debug("[%s] CONFIRM received for ServerMsgID=%d", self.name, parsed.ref_msg_id)
+            self._confirmed(parsed.ref_msg_id)
+            return
+        if self.seen_msg_ids.check_and_add(parsed.msg_id):
+            # The client missed our CONFIRM (or a trigger withheld it): confirm again, don't redo the work
+            self.duplicates += 1
+            METRICS.retransmit('udp')
+            self.send(build_confirm(parsed.msg_id))
+            LOG.debug("[%s] Re-sent CONFIRM for duplicate ClientMsgID=%d", self.name, parsed.msg_id)
+            return
+        self.fsm.dispatch(self, kind, parsed, received_ns) # Ignored once ending: only CONFIRMs count then
+
+    def _confirm(self, parsed, received_ns):
+        self.send(build_confirm(parsed.msg_id))
+        METRICS.observe('udp', TYPE_NAMES.get(parsed.type, 'UNKNOWN'), received_ns)
+        LOG.debug("[%s] Sent CONFIRM for received ClientMsgID=%d", self.name, parsed.msg_id)
+
+    # --- State Machine Actions (protocol_core.TABLE picks one per state and message kind) ---
+    def _on_auth(self, parsed_auth, _):
+        self.display_name = parsed_auth.display_name
+        self.display_name_raw = parsed_auth.raw('display_name')
+        print_log(self.name, f"AUTH received for user '{parsed_auth.username}', display name '{self.display_name}'")
+        scenario = self.server.scenarios.match('AUTH', parsed_auth)
+        if scenario is not None:
+            self._run_scenario(scenario, parsed_auth) # Without a REPLY OK (timeoutauth) start() ends the session
+        else:
+            self._auth_standard(parsed_auth)
+
+    def _auth_standard(self, parsed_auth, step=STANDARD):
+        initial_msg_id = self.initial_msg_id
+        reply_msg_id = self.next_msg_id() # From the counter: a random one could collide with a tracked ID
+        reply_msg = AUTH_OK.build(reply_msg_id, initial_msg_id)
+        self.send(reply_msg, step.delay, on_sent=functools.partial(self._auth_replied, True))
+        if step.duplicate is not None:
+            self.send(reply_msg, step.duplicate) # Same reply again
+        LOG.debug("[%s] Sent REPLY OK for AUTH (ID=%d, RefID=%d)", self.name, reply_msg_id, initial_msg_id)
+
+        if self.server.channels is not None: self._enter_channel(DEFAULT_CHANNEL)
+        msg_id = self.next_msg_id()
+        self.send(JOINED_DEFAULT.build(msg_id, self.display_name_raw), 0.1)
+        LOG.debug("[%s] Sent MSG join notice (ID=%d)", self.name, msg_id)
+
+    def _auth_replied(self, success):
+        """The AUTH REPLY is out: OPEN after OK; after NOK the session ends (a new AUTH goes to the listener)."""
+        self.fsm.replied(success)
+        if not success:
+            self.end()
+
+    def _on_join(self, parsed, received_ns):
+        self.display_name = parsed.display_name # As TCP does: channel notices use the name the client uses now
+        self.display_name_raw = parsed.raw('display_name')
+        scenario = self.server.scenarios.match('JOIN', parsed)
+        if scenario is not None:
+            self._run_scenario(scenario, parsed, received_ns)
+            return
+        self._confirm(parsed, received_ns)
+        self._join_standard(parsed)
+
+    def _join_standard(self, parsed, step=STANDARD):
+        name = self.name
+        LOG.debug("[%s] JOIN received: Channel='%s', DName='%s'", name, parsed.channel_id, parsed.display_name)
+        # Standard Reply OK for JOIN
+        msg_id = self.next_msg_id()
+        reply_msg = JOIN_OK.build(msg_id, parsed.msg_id, parsed.raw('channel_id'))
+        self.send(reply_msg, step.delay, on_sent=functools.partial(self.fsm.replied, True))
+        LOG.debug("[%s] Sent standard REPLY OK for JOIN (ID=%d)", name, msg_id)
+
+        if step.duplicate is not None:
+           print_log(name, "*** Sending Duplicate JOIN REPLY now ***")
+           self.send(reply_msg, step.duplicate) # Same reply again
+
+        if self.server.channels is not None: self._enter_channel(parsed.channel_id.lower()) # Same names as TCP clients use
+
+        # Standard joining channel message
+        msg_id = self.next_msg_id()
+        self.send(JOINED.build(msg_id, self.display_name_raw or b'Unknown', parsed.raw('channel_id')), 0.1)
+        LOG.debug("[%s] Sent standard MSG join notice (ID=%d)", name, msg_id)
+
+    def _on_msg(self, parsed, received_ns):
+        self.display_name = parsed.display_name # Follows /rename on the client
+        self.display_name_raw = parsed.raw('display_name')
+        scenario = self.server.scenarios.match('MSG', parsed)
+        if scenario is not None:
+            self._run_scenario(scenario, parsed, received_ns)
+            return
+        self._confirm(parsed, received_ns)
+        self._msg_standard(parsed)
+
+    def _msg_standard(self, parsed, step=STANDARD):
+        name = self.name
+        LOG.debug("[%s] MSG received: From='%s', Content='%.50s...'", name, parsed.display_name, parsed.content)
+        channels = self.server.channels
+        if channels is not None: # Shared with TCP clients: the channel gets the MSG instead of an echo
+            channel = channels.channel_of(self)
+            count = channels.broadcast(channel, text_line(parsed), exclude=self)
+            LOG.debug("[%s] Broadcast MSG to %d member(s) of '%s'", name, count, channel)
+            if step.duplicate is None: return
+        # Standard reply MSG
+        msg_id = self.next_msg_id()
+        server_msg_bytes = GOT_MSG.build(msg_id, parsed.raw('content')[:20])
+        self.send(server_msg_bytes, step.delay)
+        LOG.debug("[%s] Sent standard reply MSG (ID=%d)", name, msg_id)
+
+        if step.duplicate is not None:
+            print_log(name, "*** Sending Duplicate reply MSG now ***")
+            self.send(server_msg_bytes, step.duplicate) # Same reply again
+
+    # --- Test scenarios (scenarios.py) ---
+    def _run_scenario(self, scenario, parsed, received_ns=None):
+        """Runs a scenario's actions instead of the standard handling of parsed."""
+        print_log(self.name, f"*** Scenario '{scenario.name}' triggered by {scenario.kind} {scenario.field} ***")
+        if scenario.kind != 'AUTH': # The listener has CONFIRMed the AUTH
+            if scenario.confirm: self._confirm(parsed, received_ns)
+            else: print_log(self.name, f"*** Leaving ClientMsgID={parsed.msg_id} unconfirmed ***")
+        for step in scenario.steps:
+            if step.action == 'standard':
+                self._STANDARD[scenario.kind](self, parsed, step)
+            elif step.action == 'reply':
+                self._reply_step(scenario.kind, parsed, step)
             else:
-                if simulate_delay_sec > 0:
-                    time.sleep(simulate_delay_sec)
-
-                #server_msg_id_counter += 1
-                random_msg_id = random.randint(1, 0xFFFF) # Náhodné ID od 1 do 65535
-                reply_msg = build_reply(random_msg_id, reply_success, initial_msg_id, reply_content)
-                handler_sock.sendto(reply_msg, client_addr)
-                print_log(thread_name, f"Sent REPLY {'OK' if reply_success else 'NOK'} for AUTH (ID={server_msg_id_counter}, RefID={initial_msg_id})")
-
-                if reply_success:
-                    authenticated = True
-                    time.sleep(0.1)
-                    server_msg_id_counter += 1
-                    join_notice_content = f"{client_state['display_name']} has joined default."
-                    join_notice_msg = build_msg(server_msg_id_counter, "Server", join_notice_content)
-                    handler_sock.sendto(join_notice_msg, client_addr)
-                    print_log(thread_name, f"Sent MSG join notice (ID={server_msg_id_counter})")
-
-        else: # Initial message not AUTH
-             print_log(thread_name, f"Initial message was not AUTH. Closing handler.")
-             return
-
-        # --- Main communication loop ---
-        while authenticated:
-            try:
-                handler_sock.settimeout(60)
-                data, addr = handler_sock.recvfrom(BUFFER_SIZE)
-                if not data or addr != client_addr: continue
-
-                print_log(thread_name, f"Received {len(data)} bytes")
-                parsed = parse_message(data, client_addr, thread_name)
-                if not parsed: continue
-
-                msg_type = parsed['type']
-                send_confirm = True
-                send_standard_reply = True # Flag to control if standard processing occurs
-
-                # --- Command-Based Test Triggers ---
-
-                # A) Triggers based on received message TYPE and specific content
-                if msg_type == TYPE_JOIN:
-                    channel_id_lower = parsed.get('channel_id', '').lower()
-                    if "timeoutjoin" in channel_id_lower:
-                        print_log(thread_name, "*** Simulating JOIN REPLY Timeout triggered by ChannelID ***")
-                        # Send CONFIRM, but no REPLY
-                        send_standard_reply = False
-                    elif "failjoin" in channel_id_lower:
-                         print_log(thread_name, "*** Simulating JOIN REPLY NOK triggered by ChannelID ***")
-                         server_msg_id_counter += 1
-                         reply_msg = build_reply(server_msg_id_counter, False, parsed['msg_id'], "Join failed (channel trigger).")
-                         handler_sock.sendto(reply_msg, client_addr)
-                         print_log(thread_name, f"Sent REPLY NOK for JOIN (ID={server_msg_id_counter})")
-                         send_standard_reply = False # Don't send the success reply too
-                    elif "duplicatejoin" in channel_id_lower:
-                         print_log(thread_name, "*** Simulating Duplicate JOIN REPLY triggered by ChannelID ***")
-                         # Send standard success reply first (later in the code)
-                         # Will send second reply after standard processing
-                         pass # Standard processing will send first reply
-
-                elif msg_type == TYPE_MSG:
-                    content_lower = parsed.get('content', '').lower()
-                    if "noconfirm" in content_lower:
-                        print_log(thread_name, "*** Simulating CONFIRM Loss for MSG triggered by content ***")
-                        send_confirm = False
-                        # Still process standard reply if needed
-                    elif "duplicatemsg" in content_lower:
-                        print_log(thread_name, "*** Simulating Duplicate Server MSG triggered by content ***")
-                        # Standard processing will send first reply
-                        # Will send second reply after standard processing
-                        pass
-                    elif "servererr" in content_lower:
-                         print_log(thread_name, "*** Sending ERR triggered by MSG content ***")
-                         server_msg_id_counter += 1
-                         err_msg = build_err(server_msg_id_counter, "Server", "ERR triggered by client.")
-                         handler_sock.sendto(err_msg, client_addr)
-                         print_log(thread_name, f"Sent ERR (ID={server_msg_id_counter}). Closing.")
-                         send_confirm = True # Confirm the trigger message
-                         send_standard_reply = False
-                         break # Exit loop
-                    elif "serverbye" in content_lower:
-                         print_log(thread_name, "*** Sending BYE triggered by MSG content ***")
-                         server_msg_id_counter += 1
-                         bye_msg = build_bye(server_msg_id_counter, "Server")
-                         handler_sock.sendto(bye_msg, client_addr)
-                         print_log(thread_name, f"Sent BYE (ID={server_msg_id_counter}). Closing.")
-                         send_confirm = True # Confirm the trigger message
-                         send_standard_reply = False
-                         break # Exit loop
-                    elif "malformed" in content_lower:
-                         print_log(thread_name, f"*** Sending Malformed MSG triggered by MSG content ***")
-                         server_msg_id_counter += 1
-                         malformed_msg_bytes = build_msg(server_msg_id_counter, "Server", "This message is malformed")[:-1] # Remove null
-                         handler_sock.sendto(malformed_msg_bytes, client_addr)
-                         print_log(thread_name, f"Sent Malformed MSG (ID={server_msg_id_counter}).")
-                         send_confirm = False # Don't confirm the trigger message
-                         send_standard_reply = False
-                         # Don't break, let client handle it
-
-                # B) Send CONFIRM if not suppressed
-                if msg_type != TYPE_CONFIRM and send_confirm:
-                    confirm_pkt = build_confirm(parsed['msg_id'])
-                    handler_sock.sendto(confirm_pkt, client_addr)
-                    print_log(thread_name, f"Sent CONFIRM for received ClientMsgID={parsed['msg_id']}")
-
-                # --- Standard Message Processing (if not skipped by a trigger) ---
-                if send_standard_reply:
-                    if msg_type == TYPE_JOIN:
-                        channel_id_lower = parsed.get('channel_id', '').lower() # Get again for duplicate check
-                        print_log(thread_name, f"JOIN received: Channel='{parsed.get('channel_id','')}', DName='{parsed.get('display_name', '')}'")
-                        # Standard Reply OK for JOIN
-                        server_msg_id_counter += 1
-                        reply_content = f"Join to '{parsed.get('channel_id','')}' successful."
-                        reply_msg = build_reply(server_msg_id_counter, True, parsed['msg_id'], reply_content)
-                        handler_sock.sendto(reply_msg, client_addr)
-                        print_log(thread_name, f"Sent standard REPLY OK for JOIN (ID={server_msg_id_counter})")
-
-                        # Check for duplicate trigger *after* sending first reply
-                        if "duplicatejoin" in channel_id_lower:
-                           print_log(thread_name, "*** Sending Duplicate JOIN REPLY now ***")
-                           time.sleep(0.1)
-                           handler_sock.sendto(reply_msg, client_addr) # Send same reply again
-
-                        # Standard joining channel message
-                        time.sleep(0.1)
-                        server_msg_id_counter += 1
-                        join_notice_content = f"{client_state.get('display_name', 'Unknown')} has joined {parsed.get('channel_id','')}"
-                        join_notice_msg = build_msg(server_msg_id_counter, "Server", join_notice_content)
-                        handler_sock.sendto(join_notice_msg, client_addr)
-                        print_log(thread_name, f"Sent standard MSG join notice (ID={server_msg_id_counter})")
-
-                    elif msg_type == TYPE_MSG:
-                        content_lower = parsed.get('content', '').lower() # Get again for duplicate check
-                        print_log(thread_name, f"MSG received: From='{parsed.get('display_name', '')}', Content='{parsed.get('content', '')[:50]}...'")
-                        # Standard reply MSG
-                        server_msg_id_counter += 1
-                        reply_content = f"Got your MSG: '{parsed.get('content', '')[:20]}...'"
-                        server_msg_bytes = build_msg(server_msg_id_counter, "Server", reply_content)
-                        handler_sock.sendto(server_msg_bytes, client_addr)
-                        print_log(thread_name, f"Sent standard reply MSG (ID={server_msg_id_counter})")
-
-                        # Check for duplicate trigger *after* sending first reply
-                        if "duplicatemsg" in content_lower:
-                            print_log(thread_name, "*** Sending Duplicate reply MSG now ***")
-                            time.sleep(0.1)
-                            handler_sock.sendto(server_msg_bytes, client_addr) # Send same reply again
-
-                    elif msg_type == TYPE_BYE:
-                        print_log(thread_name, f"BYE received from '{parsed.get('display_name', '')}'. Closing connection.")
-                        break # Standard processing is just to break
-
-                    elif msg_type == TYPE_CONFIRM:
-                        print_log(thread_name, f"CONFIRM received for ServerMsgID={parsed['ref_msg_id']}")
-                        pass # No standard action needed
-
-                    elif msg_type != TYPE_JOIN: # Avoid double logging for JOIN already handled
-                         print_log(thread_name, f"Received unhandled message type in handler: {hex(msg_type)}")
-
-
-            # --- Error Handling for the loop ---
-            except socket.timeout: print_log(thread_name, "Client timed out."); break
-            except ConnectionResetError: print_log(thread_name, "Connection reset."); break
-            except Exception as e:
-                print_log(thread_name, f"Error in handler loop: {e}")
-                # Attempt to send ERR
-                try:
-                    server_msg_id_counter += 1
-                    err_msg = build_err(server_msg_id_counter, "Server", f"Handler error: {type(e).__name__}")
-                    handler_sock.sendto(err_msg, client_addr)
-                except Exception: pass # Ignore error during error sending
-                break
-
-    finally:
-        print_log(thread_name, "Closing handler socket.")
-        handler_sock.close()
-
-# --- Message Parser (same as before, ensure it handles missing fields gracefully) ---
+                data = self._scenario_datagram(step, parsed)
+                self.send(data, step.delay, reliable=step.kind not in UNRELIABLE_KINDS)
+                LOG.debug("[%s] Sent scenario %s (%d bytes)", self.name, step.kind, len(data))
+        if scenario.ends:
+            self.end()
+
+    def _reply_step(self, kind, parsed, step):
+        success = step.kind == 'OK'
+        msg_id = self.next_msg_id()
+        ref_msg_id = self.initial_msg_id if kind == 'AUTH' else parsed.msg_id
+        # The state moves when the REPLY is out, not when a delayed one is queued
+        replied = self._auth_replied if kind == 'AUTH' else self.fsm.replied
+        self.send(build_reply(msg_id, success, ref_msg_id, step.render(parsed)), step.delay,
+                  on_sent=functools.partial(replied, success))
+        LOG.debug("[%s] Sent REPLY %s for %s (ID=%d, RefID=%d)", self.name, step.kind, kind, msg_id, ref_msg_id)
+        if success and kind != 'MSG' and self.server.channels is not None:
+            self._enter_channel(DEFAULT_CHANNEL if kind == 'AUTH' else parsed.channel_id.lower())
+
+    def _scenario_datagram(self, step, parsed):
+        kind = step.kind
+        if kind == 'RAW':
+            return step.render(parsed).encode('ascii') # The whole datagram, header included
+        msg_id = self.next_msg_id()
+        if kind == 'BYE':
+            return build_bye(msg_id, step.sender)
+        if kind == 'ERR':
+            return build_err(msg_id, step.sender, step.render(parsed))
+        data = build_msg(msg_id, step.sender, step.render(parsed))
+        return data[:-1] if kind == 'MALFORMED' else data # MALFORMED: without the content's NUL
+
+    def _on_bye(self, parsed, received_ns):
+        self._confirm(parsed, received_ns)
+        print_log(self.name, f"BYE received from '{parsed.display_name}'. Closing connection.")
+        self.end()
+
+    def _on_err(self, parsed, received_ns):
+        self._confirm(parsed, received_ns)
+        print_log(self.name, f"ERR received from '{parsed.display_name}': '{parsed.content}'. Closing connection.")
+        self.end()
+
+    def _on_ping(self, parsed, received_ns):
+        self._confirm(parsed, received_ns)
+
+    def _on_unknown(self, parsed, received_ns):
+        self._on_violation(parsed, received_ns, text=f"Unknown message type {hex(parsed.raw_type)}.")
+
+    def _on_violation(self, parsed, received_ns, text):
+        """A message the current state does not allow: CONFIRM it, answer ERR and end."""
+        self._confirm(parsed, received_ns)
+        print_log(self.name, f"Protocol violation in state {self.fsm.state}: {text}", WARNING)
+        msg_id = self.next_msg_id()
+        self.send(build_err(msg_id, "Server", text))
+        self.end()
+
+    def _on_ignore(self, parsed, arg):
+        pass
+
+    _TABLE = compile_table({
+        'auth': _on_auth,
+        'join': _on_join,
+        'msg': _on_msg,
+        'err': _on_err,
+        'bye': _on_bye,
+        'ping': _on_ping,
+        'malformed': _on_unknown, # Malformed datagrams are dropped by parse_message already
+        'unknown': _on_unknown,
+        'violation': _on_violation,
+        'ignore': _on_ignore,
+    })
+    _STANDARD = {'AUTH': _auth_standard, 'JOIN': _join_standard, 'MSG': _msg_standard}
+
+# --- Message Parser (udp_wire does the parsing; this adds the logging) ---
 def parse_message(data, addr, log_context="Parser"):
+    """Parsed message, or None if the datagram is malformed. Unknown types parse as udp_wire.Unknown."""
     try:
-        if len(data) < 3: raise ValueError(f"Msg from {addr} too short ({len(data)}B)")
-        msg_type = data[0]; msg_id = read_ushort_be(data, 1); offset = 3
-        result = {'raw_type': msg_type, 'msg_id': msg_id}
-        if msg_type == TYPE_CONFIRM:
-            if len(data) < 5: raise ValueError("CONFIRM too short")
-            result['type'] = TYPE_CONFIRM; result['ref_msg_id'] = read_ushort_be(data, offset)
-        elif msg_type == TYPE_REPLY: # Client shouldn't receive REPLY in this simulation
-             result['type'] = TYPE_UNKNOWN; print_log(log_context, f"Client received unexpected REPLY from {addr}")
-        elif msg_type == TYPE_AUTH:
-            result['type'] = TYPE_AUTH
-            result['username'], offset = read_string(data, offset)
-            result['display_name'], offset = read_string(data, offset)
-            result['secret'], offset = read_string(data, offset)
-        elif msg_type == TYPE_JOIN:
-            result['type'] = TYPE_JOIN
-            result['channel_id'], offset = read_string(data, offset)
-            result['display_name'], offset = read_string(data, offset)
-        elif msg_type == TYPE_MSG:
-            result['type'] = TYPE_MSG
-            result['display_name'], offset = read_string(data, offset)
-            result['content'], offset = read_string(data, offset)
-        elif msg_type == TYPE_ERR:
-            result['type'] = TYPE_ERR
-            result['display_name'], offset = read_string(data, offset)
-            result['content'], offset = read_string(data, offset)
-        elif msg_type == TYPE_BYE:
-            result['type'] = TYPE_BYE
-            result['display_name'], offset = read_string(data, offset)
-        elif msg_type == TYPE_PING: result['type'] = TYPE_PING
-        else: result['type'] = TYPE_UNKNOWN; print_log(log_context, f"Unknown type {hex(msg_type)} from {addr}")
-        return result
-    except (ValueError, IndexError, UnicodeDecodeError, struct.error) as e:
-        print_log(log_context, f"Parse error from {addr}: {e}")
+        msg = parse_datagram(data)
+    except (ValueError, struct.error) as e:
+        print_log(log_context, f"Parse error from {addr}: {e}", WARNING)
         # Maybe try to send ERR? Difficult if parsing failed.
         return None # Indicate parsing failure
+    if type(msg) is Unknown: print_log(log_context, f"Unknown type {hex(msg.raw_type)} from {addr}", WARNING)
+    return msg
 
 
-# --- Main Server (unchanged from previous version) ---
-def run_server(host='0.0.0.0', port=DEFAULT_PORT):
-    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    listen_sock.bind((host, port))
-    print_log("Server", f"Listening on UDP {host}:{port}")
-    active_threads = []
-    running = True
-    def signal_handler(sig, frame):
-        nonlocal running; print_log("Server", "Shutdown signal..."); running = False; listen_sock.close()
-    signal.signal(signal.SIGINT, signal_handler); signal.signal(signal.SIGTERM, signal_handler)
-    while running:
+# --- Dynamic ports and admission ---
+class PortPool:
+    """
+    Pre-bound dynamic-port sockets. A session takes one on AUTH and gives it
+    back when it closes, so reconnect storms reuse ports instead of binding a
+    socket per AUTH. At most `limit` sockets are handed out at once; up to
+    `size` idle ones stay bound.
+    """
+
+    def __init__(self, host, size=PORT_POOL, limit=MAX_SESSIONS):
+        self.host = host
+        self.size = size
+        self.limit = limit
+        self.in_use = 0
+        self.idle = collections.deque() # FIFO: a port rests as long as possible before it is reused
+        for _ in range(min(size, limit)):
+            self.idle.append(self._bind())
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            # print_log("Server", "Waiting on listener...") # Optional log
-            listen_sock.settimeout(1.0)
-            try: data, client_addr = listen_sock.recvfrom(BUFFER_SIZE)
-            except socket.timeout: continue
-            print_log("Server", f"Received {len(data)} bytes from {client_addr} on listener")
-            if len(data) < 3: continue
-            msg_type = data[0]; initial_msg_id = read_ushort_be(data, 1)
-            if msg_type == TYPE_AUTH:
-                 confirm_pkt = build_confirm(initial_msg_id)
-                 listen_sock.sendto(confirm_pkt, client_addr)
-                 print_log("Server", f"Sent CONFIRM for AUTH (RefID={initial_msg_id}) from listener")
-                 handler_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM); handler_sock.bind((host, 0))
-                 dynamic_port = handler_sock.getsockname()[1]
-                 print_log("Server", f"Allocated dynamic port {dynamic_port} for {client_addr}")
-                 handler_thread = threading.Thread(target=client_handler, args=(handler_sock, client_addr, data, initial_msg_id), daemon=True)
-                 active_threads.append(handler_thread); handler_thread.start()
-                 active_threads = [t for t in active_threads if t.is_alive()] # Cleanup finished
-            else: print_log("Server", f"Ignoring non-AUTH msg type {hex(msg_type)} on listener")
+            sock.bind((self.host, 0))
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def acquire(self):
+        """Socket for a new session, or None at the limit. Raises OSError if binding fails."""
+        if self.in_use >= self.limit: return None
+        if self.idle:
+            sock = self.idle.popleft()
+            stale = 0
+            while True: # Datagrams a previous client sent after its session ended
+                try: sock.recv(1)
+                except OSError: break
+                stale += 1
+            if stale: LOG.debug("[Server] Dropped %d stale datagram(s) on port %d", stale, sock.getsockname()[1])
+        else:
+            sock = self._bind()
+        self.in_use += 1
+        return sock
+
+    def release(self, sock):
+        self.in_use -= 1
+        if len(self.idle) < self.size: self.idle.append(sock)
+        else: sock.close()
+
+    def close(self):
+        while self.idle:
+            self.idle.popleft().close()
+
+class RateLimit:
+    """Token bucket: `rate` events per second on average, bursts of up to max(rate, 1). 0 allows everything."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'clock')
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.burst = self.tokens = max(rate, 1)
+        self.clock = clock
+        self.stamp = clock()
+
+    def allow(self):
+        if not self.rate: return True
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+
+class LoopSelector:
+    """
+    The part of the selectors API that UdpServer uses, on top of an asyncio
+    loop's add_reader/add_writer. Readiness is passed to dispatch(data, events)
+    instead of being returned from select().
+    """
+
+    def __init__(self, loop, dispatch):
+        self.loop = loop
+        self.dispatch = dispatch
+        self._fds = set()
+
+    def register(self, sock, events, data):
+        fd = sock.fileno()
+        self._fds.add(fd)
+        self.loop.add_reader(fd, self.dispatch, data, selectors.EVENT_READ)
+        if events & selectors.EVENT_WRITE: self.loop.add_writer(fd, self.dispatch, data, selectors.EVENT_WRITE)
+        else: self.loop.remove_writer(fd)
+
+    modify = register
+
+    def unregister(self, sock):
+        fd = sock.fileno()
+        self._fds.discard(fd)
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+
+    def close(self):
+        for fd in self._fds:
+            self.loop.remove_reader(fd)
+            self.loop.remove_writer(fd)
+        self._fds.clear()
+
+
+# --- Main Server: one selector loop for the listener and every dynamic port ---
+class UdpServer:
+    """
+    Listener and all client sessions multiplexed on one selector (epoll on Linux), in one thread.
+
+    Each readiness event reads up to RECV_BATCH datagrams with recvfrom_into
+    into preallocated pool buffers, then parses them in place via memoryview.
+    Replies and CONFIRMs are queued per socket and sent in one pass once
+    the events of a select() call have been handled.
+
+    serve_forever() runs the selector loop itself. attach() instead serves
+    from a running asyncio loop, next to the TCP server; with a shared
+    ChannelRegistry the sessions are channel members like TCP connections.
+    """
+
+    def __init__(self, host='0.0.0.0', port=DEFAULT_PORT, confirm_timeout=CONFIRM_TIMEOUT, retransmissions=RETRANSMISSIONS,
+                 port_pool=PORT_POOL, max_sessions=MAX_SESSIONS, auth_rate=AUTH_RATE, idle_timeout=IDLE_TIMEOUT,
+                 impairment=None, reuse_port=False, ping_interval=PING_INTERVAL, timers=None, channels=None, scenarios=None):
+        self.host = host
+        self.impairment = impairment # udp_impairment.Impairment, or None for a perfect network
+        self.confirm_timeout = confirm_timeout # 0 sends every message once, untracked
+        self.retransmissions = retransmissions
+        self.channels = channels # ChannelRegistry; None keeps the standalone "Got your MSG" echo
+        self.scenarios = scenarios if scenarios is not None else default_scenarios().matcher('udp')
+        self.selector = selectors.DefaultSelector()
+        self.timers = TimerHeap() if timers is None else timers # A LoopTimerHeap when attached to an asyncio loop
+        self.idle_reaper = IdleReaper(self.timers, idle_timeout) # 0 keeps idle sessions forever
+        CAPTURE.attach(self.timers)
+        self.keepalive = KeepaliveWheel(self.timers, ping_interval)
+        self.sessions = {} # fileno of the dynamic-port socket -> UdpSession
+        self.by_addr = {} # client address -> UdpSession, so a repeated AUTH finds its session
+        self.ports = PortPool(host, port_pool, max_sessions)
+        self.auth_limit = RateLimit(auth_rate, self.timers.clock)
+        self.running = True
+        self._pool = [bytearray(BUFFER_SIZE) for _ in range(RECV_BATCH)]
+        self._views = [memoryview(buf) for buf in self._pool]
+        self._received = [None] * RECV_BATCH # (nbytes, addr) per pool slot of the current batch
+        self._dirty = [] # DatagramQueues with datagrams waiting for the send pass
+        self.send_soon = None # Schedules the send pass when an event loop other than serve_forever() drives us
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port: # Worker mode: every worker binds the same listener port
+            self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listen_sock.bind((host, port))
+        self.listen_sock.setblocking(False)
+        self.listen_outq = DatagramQueue(self.listen_sock, None)
+        self.selector.register(self.listen_sock, selectors.EVENT_READ, None)
+
+    def open_session(self, client_addr, data, initial_msg_id):
+        """Starts a session on a pooled dynamic port. Returns False if admission refused it."""
+        if not self.auth_limit.allow(): return False
+        handler_sock = self.ports.acquire()
+        if handler_sock is None: return False
+        print_log("Server", f"Allocated dynamic port {handler_sock.getsockname()[1]} for {client_addr}")
+        session = UdpSession(self, handler_sock, client_addr)
+        self.sessions[handler_sock.fileno()] = session
+        self.by_addr[client_addr] = session
+        self.selector.register(handler_sock, selectors.EVENT_READ, session)
+        session.start(data, initial_msg_id)
+        return True
+
+    def unregister(self, session):
+        if self.sessions.pop(session.sock.fileno(), None) is not None:
+            self.selector.unregister(session.sock)
+            if self.by_addr.get(session.client_addr) is session:
+                del self.by_addr[session.client_addr]
+            self.ports.release(session.sock)
+
+    # --- Outbound batching ---
+    def queue(self, outq, data, addr):
+        if self.impairment is not None:
+            self._impaired_queue(outq, data, addr)
+            return
+        if not outq.items:
+            if not self._dirty and self.send_soon is not None: self.send_soon()
+            self._dirty.append(outq)
+        outq.items.append((data, addr))
+
+    # --- Network impairment (only with an Impairment configured) ---
+    def _impaired_queue(self, outq, data, addr):
+        for delay in self.impairment.outbound():
+            if delay:
+                self.timers.call_later(delay, self._queue_late, outq, data, addr)
+            else:
+                self._enqueue(outq, data, addr)
+
+    def _queue_late(self, outq, data, addr):
+        session = outq.key_data
+        if session is not None and session.closed: return # Its socket may serve another client by now
+        self._enqueue(outq, data, addr)
+
+    def _enqueue(self, outq, data, addr):
+        if not outq.items:
+            if not self._dirty and self.send_soon is not None: self.send_soon()
+            self._dirty.append(outq)
+        outq.items.append((data, addr))
+
+    def _impaired_receive(self, deliver, data, key, received_ns):
+        """Passes a datagram to deliver(data, key, received_ns) now, later, twice or never."""
+        for delay in self.impairment.inbound():
+            if delay:
+                self.timers.call_later(delay, self._deliver_late, deliver, bytes(data), key) # The pool buffer is reused
+            else:
+                deliver(data, key, received_ns)
+
+    @staticmethod
+    def _deliver_late(deliver, data, key):
+        deliver(data, key, time.perf_counter_ns()) # Simulated latency is not server latency
+
+    def _send_pass(self):
+        dirty, self._dirty = self._dirty, []
+        for outq in dirty:
+            if outq.items and not outq.flush():
+                self.selector.modify(outq.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, outq.key_data)
+
+    def _on_writable(self, outq):
+        if outq.flush():
+            self.selector.modify(outq.sock, selectors.EVENT_READ, outq.key_data)
+
+    # --- Inbound ---
+    def _recv_batch(self, sock):
+        """Fills pool buffers from sock until it would block; returns how many datagrams were read."""
+        pool, received = self._pool, self._received
+        count = 0
+        while count < RECV_BATCH:
+            try: received[count] = sock.recvfrom_into(pool[count])
+            except (BlockingIOError, InterruptedError): break
+            except OSError:
+                if not count: raise
+                break # Handle what was read; the error surfaces again if it persists
+            count += 1
+        return count
+
+    def _on_listener(self):
+        try: count = self._recv_batch(self.listen_sock)
+        except OSError as e: print_log("Server", f"Listener socket error: {e}", ERROR); return
+        received_ns = time.perf_counter_ns()
+        for i in range(count):
+            nbytes, client_addr = self._received[i]
+            METRICS.add_bytes('udp', 'in', nbytes)
+            LOG.debug("[Server] Received %d bytes from %s on listener", nbytes, client_addr)
+            if nbytes < 3: continue
+            if self.impairment is None: self._listener_datagram(self._views[i][:nbytes], client_addr, received_ns)
+            else: self._impaired_receive(self._listener_datagram, self._views[i][:nbytes], client_addr, received_ns)
+
+    def _listener_datagram(self, data, client_addr, received_ns):
+        msg_type = data[0]; initial_msg_id = read_ushort_be(data, 1)
+        METRICS.message('udp', 'in', TYPE_NAMES.get(msg_type, 'UNKNOWN'), 'START')
+        if msg_type == TYPE_CONFIRM: return # For a SERVER_BUSY reply, which is sent only once
+        if msg_type != TYPE_AUTH:
+            print_log("Server", f"Ignoring non-AUTH msg type {hex(msg_type)} on listener", WARNING)
+            return
+        self.queue(self.listen_outq, build_confirm(initial_msg_id), client_addr)
+        METRICS.observe('udp', 'AUTH', received_ns)
+        LOG.debug("[Server] Sent CONFIRM for AUTH (RefID=%d) from listener", initial_msg_id)
+        session = self.by_addr.get(client_addr)
+        if session is not None:
+            if session.initial_msg_id == initial_msg_id: # Our CONFIRM was lost or late; the session goes on
+                METRICS.event('udp', 'auth_duplicate')
+                LOG.debug("[Server] Repeated AUTH (ID=%d) from %s; session exists", initial_msg_id, client_addr)
+                return
+            print_log("Server", f"New AUTH from {client_addr} replaces its session")
+            session.close()
+        try:
+            if self.open_session(client_addr, data, initial_msg_id): return
+            reason = "session limit or AUTH rate reached"
         except OSError as e:
-             if running: print_log("Server", f"Listener socket error: {e}")
-             else: print_log("Server", "Listener socket closed.")
-             break
-        except Exception as e: print_log("Server", f"Main loop error: {e}"); time.sleep(1)
-    print_log("Server", "Shutting down handlers..."); shutdown_start = time.time()
-    for t in active_threads:
-        join_timeout = max(0.1, 5.0 - (time.time() - shutdown_start)); t.join(timeout=join_timeout)
-        if t.is_alive(): print_log("Server", f"Warning: Thread {t.name} did not exit.")
+            reason = str(e)
+        METRICS.event('udp', 'auth_refused')
+        print_log("Server", f"Refused session for {client_addr}: {reason}", WARNING)
+        self.queue(self.listen_outq, SERVER_BUSY.build(random.randint(1, 0xFFFF), initial_msg_id), client_addr)
+
+    def _on_session(self, session):
+        try: count = self._recv_batch(session.sock)
+        except ConnectionResetError: print_log(session.name, "Connection reset.", WARNING); session.close(); return
+        except OSError as e: session.fail(e); return
+        received_ns = time.perf_counter_ns()
+        client_addr, views, received = session.client_addr, self._views, self._received
+        for i in range(count):
+            if session.closed: return
+            nbytes, addr = received[i]
+            if not nbytes or addr != client_addr: continue
+            if self.impairment is not None:
+                self._impaired_receive(self._session_datagram, views[i][:nbytes], session, received_ns)
+                continue
+            try: session.handle(views[i][:nbytes], received_ns)
+            except Exception as e: session.fail(e); return
+
+    @staticmethod
+    def _session_datagram(data, session, received_ns):
+        if session.closed: return
+        try: session.handle(data, received_ns)
+        except Exception as e: session.fail(e)
+
+    def _dispatch(self, session, events):
+        """One readiness event; session is None for the listener."""
+        if session is not None and session.closed: return
+        if events & selectors.EVENT_WRITE:
+            self._on_writable(self.listen_outq if session is None else session.outq)
+        if not events & selectors.EVENT_READ: return
+        if session is None: self._on_listener()
+        else: self._on_session(session)
+
+    def serve_forever(self):
+        timers, selector, dispatch = self.timers, self.selector, self._dispatch
+        while self.running:
+            deadline = timers.next_deadline()
+            timeout = 1.0 if deadline is None else min(1.0, max(0.0, deadline - timers.clock()))
+            for key, events in selector.select(timeout):
+                dispatch(key.data, events)
+            timers.run_due()
+            self._send_pass()
+        self.close()
+
+    def attach(self, loop):
+        """
+        Serves from the asyncio loop instead of serve_forever(). The server must
+        have been created with a LoopTimerHeap of that loop. The first datagram
+        queued after a send pass schedules the next one with call_soon, so the
+        datagrams queued while a batch of loop callbacks runs go out together.
+        """
+        self.selector.close()
+        self.selector = LoopSelector(loop, self._dispatch)
+        self.selector.register(self.listen_sock, selectors.EVENT_READ, None)
+        self.send_soon = functools.partial(loop.call_soon, self._send_pass)
+
+    def close(self):
+        print_log("Server", f"Shutting down {len(self.sessions)} session(s)...")
+        for session in list(self.sessions.values()):
+            session.close()
+        self.listen_outq.flush()
+        self.keepalive.close()
+        self.ports.close()
+        self.selector.close()
+        self.listen_sock.close()
+
+def run_server(host='0.0.0.0', port=DEFAULT_PORT, metrics_port=0, confirm_timeout=CONFIRM_TIMEOUT, retransmissions=RETRANSMISSIONS,
+               port_pool=PORT_POOL, max_sessions=MAX_SESSIONS, auth_rate=AUTH_RATE, idle_timeout=IDLE_TIMEOUT,
+               impairment=None, worker=None, ping_interval=PING_INTERVAL, scenarios=None):
+    if metrics_port: start_http_server(metrics_port)
+    raise_fd_limit()
+    server = UdpServer(host, port, confirm_timeout, retransmissions, port_pool, max_sessions, auth_rate, idle_timeout,
+                       impairment, reuse_port=worker is not None, ping_interval=ping_interval, scenarios=scenarios)
+    print_log("Server", f"Listening on UDP {host}:{port}" + (f", worker {worker} pid {os.getpid()}" if worker is not None else ""))
+    def signal_handler(sig, frame):
+        print_log("Server", "Shutdown signal..."); server.running = False
+    signal.signal(signal.SIGINT, signal_handler); signal.signal(signal.SIGTERM, signal_handler)
+    server.serve_forever()
     print_log("Server", "Shutdown complete.")
 
+# --- run_workers function (multi-process mode) ---
+def run_workers(host='0.0.0.0', port=DEFAULT_PORT, workers=None, metrics_port=0, impairment=None, **options):
+    """
+    Forks one server loop per worker, all bound to the listener port with SO_REUSEPORT.
+    Workers share nothing: each has its own port pool, sessions and limits.
+    workers defaults to the number of CPUs.
+    """
+    workers = workers or os.cpu_count() or 1
+    children = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                random.seed() # Distinct busy-REPLY MessageIDs and scenario texts per worker
+                if impairment is not None: impairment.reseed(f"worker{index}")
+                run_server(host, port, metrics_port + index if metrics_port else 0, impairment=impairment,
+                           worker=index, **options)
+            except Exception as e:
+                print_log("Server", f"Worker {index} failed: {e}", ERROR)
+                code = 1
+            finally:
+                CAPTURE.close()
+                LOG.close() # os._exit skips interpreter cleanup
+                sys.stdout.flush()
+                os._exit(code)
+        children.append(pid)
+    print_log("Server", f"Started {workers} worker processes: {children}")
+
+    def signal_handler(sig, frame):
+        print_log("Server", f"Shutdown signal, stopping {len(children)} workers...")
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    print_log("Server", "All workers stopped.")
+
+def add_session_arguments(parser):
+    group = parser.add_argument_group("UDP sessions")
+    group.add_argument('--confirm-timeout', type=int, default=int(CONFIRM_TIMEOUT * 1000), metavar='MS',
+                       help=f"resend unconfirmed server messages after MS ms; 0 sends once (default {int(CONFIRM_TIMEOUT * 1000)})")
+    group.add_argument('--retransmissions', type=int, default=RETRANSMISSIONS, metavar='N',
+                       help=f"resends before a session is given up (default {RETRANSMISSIONS})")
+    group.add_argument('--port-pool', type=int, default=PORT_POOL, metavar='N',
+                       help=f"idle dynamic-port sockets kept pre-bound (default {PORT_POOL})")
+    group.add_argument('--max-sessions', type=int, default=MAX_SESSIONS, metavar='N',
+                       help=f"sessions open at once; further AUTHs get REPLY NOK (default {MAX_SESSIONS})")
+    group.add_argument('--auth-rate', type=float, default=AUTH_RATE, metavar='N',
+                       help="new sessions per second, bursts up to N; 0 = unlimited (default 0)")
+    group.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, metavar='S',
+                       help=f"end sessions idle for S seconds with BYE (ERR before AUTH succeeded); 0 = never (default {IDLE_TIMEOUT})")
+    group.add_argument('--ping-interval', type=float, default=PING_INTERVAL, metavar='S',
+                       help="PING every authenticated session every S seconds, spread evenly; an unconfirmed "
+                            "PING is retransmitted like any message; 0 = never (default 0)")
+
+def session_options(args):
+    """UdpServer/run_server keyword arguments from the add_session_arguments options."""
+    return dict(confirm_timeout=args.confirm_timeout / 1000, retransmissions=args.retransmissions,
+                port_pool=args.port_pool, max_sessions=args.max_sessions, auth_rate=args.auth_rate,
+                idle_timeout=args.idle_timeout, ping_interval=args.ping_interval)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="IPK25 Mock UDP Server")
+    parser.add_argument('--host', default='0.0.0.0', help="address to bind (default 0.0.0.0)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"listener port (default {DEFAULT_PORT})")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="fork N server processes sharing the listener via SO_REUSEPORT; "
+                             "the session limits apply per worker (default 1)")
+    add_session_arguments(parser)
+    add_scenario_arguments(parser)
+    add_capture_arguments(parser) # Workers append to the same file
+    add_impairment_arguments(parser)
+    add_log_arguments(parser)
+    add_metrics_arguments(parser) # With --workers, worker i serves on PORT + i
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
 if __name__ == "__main__":
-    run_server()
\ No newline at end of file
+    args = parse_args()
+    configure_from_args(args)
+    options = session_options(args)
+    options['scenarios'] = scenarios_from_args(args).matcher('udp')
+    capture_from_args(args)
+    if args.workers > 1:
+        run_workers(args.host, args.port, args.workers, args.metrics_port, impairment_from_args(args), **options)
+    else:
+        run_server(args.host, args.port, args.metrics_port, impairment=impairment_from_args(args), **options)
\ No newline at end of file
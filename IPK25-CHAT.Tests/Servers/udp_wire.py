@@ -0,0 +1,202 @@
+"""
+========================================
+ IPK25 UDP wire format
+========================================
+
+Parses the binary IPK25 UDP datagrams into slotted message objects.
+
+  Type (1B) | MessageID (2B, network order) | type-specific fields
+
+Headers are unpacked with precompiled struct.Struct objects, and the type
+byte selects the field parser from a dispatch table. One precompiled regex
+match per layout checks and locates the NUL-terminated ASCII string
+fields. Nothing is decoded until a handler reads a field, so messages that
+are only counted or confirmed never pay for decoding.
+
+parse_datagram() accepts bytes, bytearray or memoryview. A message keeps a
+reference to its datagram until its fields are read, so messages parsed from
+a pooled receive buffer must be handled before that buffer is refilled.
+
+build_auth() and build_join() encode the client-only messages for the load
+generator; the servers build what they send in udp_ipk25_server.
+"""
+
+import re
+import struct
+
+# --- Protocol Constants ---
+TYPE_CONFIRM = 0x00
+TYPE_REPLY = 0x01
+TYPE_AUTH = 0x02
+TYPE_JOIN = 0x03
+TYPE_MSG = 0x04
+TYPE_PING = 0xFD
+TYPE_ERR = 0xFE
+TYPE_BYE = 0xFF
+TYPE_UNKNOWN = 0x10
+TYPE_NAMES = {TYPE_CONFIRM: 'CONFIRM', TYPE_REPLY: 'REPLY', TYPE_AUTH: 'AUTH', TYPE_JOIN: 'JOIN',
+              TYPE_MSG: 'MSG', TYPE_PING: 'PING', TYPE_ERR: 'ERR', TYPE_BYE: 'BYE'}
+
+HEADER = struct.Struct('>BH') # Type | MessageID (CONFIRM: Type | Ref_MessageID)
+REPLY_HEADER = struct.Struct('>BHBH') # Type | MessageID | Result | Ref_MessageID
+
+_unpack_header = HEADER.unpack_from
+_unpack_reply = REPLY_HEADER.unpack_from
+
+
+class Message:
+    """Base of all parsed messages: the type byte and MessageID."""
+    __slots__ = ('msg_id',)
+    type = TYPE_UNKNOWN
+    FIELDS = () # Names of the lazily decoded string fields, in wire order
+
+    def __repr__(self):
+        values = ', '.join(f"{name}={getattr(self, name)!r}" for name in ('msg_id',) + self.FIELDS)
+        return f"{type(self).__name__}({values})"
+
+
+class _TextMessage(Message):
+    """
+    Message with NUL-terminated string fields. Parsing keeps the regex match
+    of the field layout. The first field access decodes all fields into a
+    cached list, and later reads index that list.
+    """
+    __slots__ = ('_match', '_values')
+
+    def _decode(self):
+        values = self._values = [raw.decode('ascii') for raw in self._match.groups()]
+        return values
+
+    def raw(self, name):
+        """Field as the ASCII bytes from the wire, for echoing it back without encoding it again."""
+        return self._match.group(self.FIELDS.index(name) + 1)
+
+
+def _text_field(index):
+    def get(self):
+        values = self._values
+        return (values or self._decode())[index]
+    return property(get)
+
+
+class Confirm(Message):
+    __slots__ = ()
+    type = TYPE_CONFIRM
+    ref_msg_id = property(lambda self: self.msg_id) # CONFIRM carries only the referenced ID
+
+class Ping(Message):
+    __slots__ = ()
+    type = TYPE_PING
+
+class Unknown(Message):
+    __slots__ = ('raw_type',)
+
+class Auth(_TextMessage):
+    __slots__ = ()
+    FIELDS = ('username', 'display_name', 'secret')
+    username = _text_field(0)
+    display_name = _text_field(1)
+    secret = _text_field(2)
+    type = TYPE_AUTH
+
+class Join(_TextMessage):
+    __slots__ = ()
+    FIELDS = ('channel_id', 'display_name')
+    channel_id = _text_field(0)
+    display_name = _text_field(1)
+    type = TYPE_JOIN
+
+class Msg(_TextMessage):
+    __slots__ = ()
+    FIELDS = ('display_name', 'content')
+    display_name = _text_field(0)
+    content = _text_field(1)
+    type = TYPE_MSG
+
+class Err(Msg):
+    __slots__ = ()
+    type = TYPE_ERR
+
+class Bye(_TextMessage):
+    __slots__ = ()
+    FIELDS = ('display_name',)
+    display_name = _text_field(0)
+    type = TYPE_BYE
+
+class Reply(_TextMessage):
+    __slots__ = ('success', 'ref_msg_id')
+    FIELDS = ('content',)
+    content = _text_field(0)
+    type = TYPE_REPLY
+
+
+# --- Field parsers (one per type byte) ---
+def _fields_pattern(count):
+    """count NUL-terminated ASCII strings; one C-level match checks and locates them all."""
+    return re.compile(rb'([\x01-\x7f]*)\x00' * count)
+
+def _text_parser(cls, offset=3):
+    match = _fields_pattern(len(cls.FIELDS)).match
+    new = cls.__new__
+    def parse(data, msg_id):
+        m = match(data, offset)
+        if m is None: raise ValueError(f"{TYPE_NAMES[cls.type]} field not a NUL-terminated ASCII string")
+        msg = new(cls)
+        msg.msg_id = msg_id
+        msg._match = m
+        msg._values = None
+        return msg
+    return parse
+
+def _confirm(data, msg_id):
+    msg = Confirm.__new__(Confirm)
+    msg.msg_id = msg_id
+    return msg
+
+def _ping(data, msg_id):
+    msg = Ping.__new__(Ping)
+    msg.msg_id = msg_id
+    return msg
+
+_reply_fields = _text_parser(Reply, REPLY_HEADER.size)
+def _reply(data, msg_id):
+    if len(data) < REPLY_HEADER.size: raise ValueError("REPLY too short")
+    msg = _reply_fields(data, msg_id)
+    _, _, result, msg.ref_msg_id = _unpack_reply(data)
+    msg.success = result == 0x01
+    return msg
+
+# Type byte -> parser of the rest of the datagram
+PARSERS = {
+    TYPE_CONFIRM: _confirm,
+    TYPE_REPLY: _reply,
+    TYPE_AUTH: _text_parser(Auth),
+    TYPE_JOIN: _text_parser(Join),
+    TYPE_MSG: _text_parser(Msg),
+    TYPE_ERR: _text_parser(Err),
+    TYPE_BYE: _text_parser(Bye),
+    TYPE_PING: _ping,
+}
+
+
+def parse_datagram(data):
+    """Parses one datagram. Raises ValueError if it is truncated or a field is malformed."""
+    if len(data) < 3: raise ValueError(f"too short ({len(data)}B)")
+    msg_type, msg_id = _unpack_header(data)
+    parser = PARSERS.get(msg_type)
+    if parser is None:
+        msg = Unknown.__new__(Unknown)
+        msg.msg_id = msg_id
+        msg.raw_type = msg_type
+        return msg
+    return parser(data, msg_id)
+
+
+# --- Client-side encoders ---
+def build_auth(msg_id, username, display_name, secret):
+    return HEADER.pack(TYPE_AUTH, msg_id) + b'\x00'.join(
+        (username.encode('ascii'), display_name.encode('ascii'), secret.encode('ascii'), b''))
+
+def build_join(msg_id, channel_id, display_name):
+    return HEADER.pack(TYPE_JOIN, msg_id) + b'\x00'.join(
+        (channel_id.encode('ascii'), display_name.encode('ascii'), b''))
@@ -0,0 +1,48 @@
+"""
+========================================
+ IPK25 TCP <-> UDP message bridge
+========================================
+
+Translates chat messages between the two IPK25 wire formats for a server
+that routes between TCP and UDP clients:
+
+  MSG FROM {DisplayName} IS {MessageContent}\r\n
+  0x04 | MessageID | DisplayName \0 | MessageContent \0
+
+The channel registry carries the text form, because that is what TCP members
+write as-is and what WorkerRelay forwards. A UDP member turns a line into
+the body of a binary MSG (everything after the header), and puts its own
+MessageID in front of it. One broadcast hands the same bytes object to
+every member, so the last translation is cached by identity, and a channel
+with many UDP members parses each line once.
+"""
+
+import re
+
+# Lines the server encoded itself, so keywords are always upper case
+_MSG_LINE = re.compile(rb'MSG FROM ([\x21-\x7e]+) IS ([\x01-\x7f]*)\r\n', re.S).fullmatch
+
+_last = (None, None) # (line, body) of the previous translation; one tuple so readers never see half of it
+
+
+def datagram_body(line):
+    """
+    Display name and content of a text MSG line as NUL-terminated UDP fields,
+    or None if the line is no MSG or cannot be carried over UDP (non-ASCII, NUL).
+    """
+    global _last
+    last_line, body = _last
+    if line is last_line:
+        return body
+    match = _MSG_LINE(line)
+    body = match.group(1) + b'\x00' + match.group(2) + b'\x00' if match else None
+    _last = (line, body)
+    return body
+
+
+def text_line(msg):
+    """CRLF-terminated text MSG line for a parsed udp_wire Msg, built from its raw fields."""
+    content = msg.raw('content')
+    if b'\r' in content: # A CRLF inside the content would end the line early for TCP readers
+        content = content.replace(b'\r', b'')
+    return b'MSG FROM %b IS %b\r\n' % (msg.raw('display_name'), content)